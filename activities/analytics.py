@@ -1,8 +1,48 @@
-import pandas as pd
-from datetime import datetime, timedelta
-from django.db.models import Sum, Count, Avg, Q
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+import numpy as np
+from django.db.models import Sum, Count, Avg, Max, Min, F, Q
+from django.db.models.functions import Coalesce, Substr
 from django.utils import timezone
-from .models import Activity
+from . import courses, curves, geo, records, rollups, training_load
+from .analytics_cache import cached_analytics, get_generation
+from .frames import DAY_NAMES, ActivityFrame, value_columns
+from .models import Activity, ActivitySummary, Course, PersonalRecord, StravaProfile, format_duration
+from .responses import to_rows
+from .units import convert, convert_row, readable
+
+
+# SI fields of each result -> (readable field prefix, quantity), see units.convert
+TOTALS_UNITS = {
+    'total_distance': ('total_distance', 'distance'),
+    'total_time': ('total_time', 'duration'),
+    'avg_distance': ('avg_distance', 'distance'),
+    'avg_speed': ('avg_speed', 'speed'),
+}
+WEEK_UNITS = {
+    'distance': ('distance', 'distance'),
+    'moving_time': ('time', 'duration'),
+}
+MONTH_UNITS = dict(WEEK_UNITS, speed=('avg_speed', 'speed'))
+CURVE_UNITS = {
+    'speed': ('speed', 'speed'),
+    'pace': ('pace', 'pace'),
+}
+NEARBY_UNITS = {
+    'distance': ('distance', 'distance'),
+    'offset': ('from_point', 'distance'),
+}
+COURSE_UNITS = {
+    'distance': ('distance', 'distance'),
+}
+EFFORT_UNITS = {
+    'average_speed': ('average_speed', 'speed'),
+    'pace': ('pace', 'pace'),
+}
+DAY_UNITS = {
+    'distance': ('avg_distance', 'distance'),
+    'moving_time': ('avg_time', 'duration'),
+    'speed': ('avg_speed', 'speed'),
+}
 
 
 class StravaAnalytics:
@@ -10,12 +50,37 @@ class StravaAnalytics:
     
     def __init__(self, user=None):
         if user and user.is_authenticated:
+            self.user = user
             self.activities = Activity.objects.filter(user=user)
         else:
+            self.user = None
             self.activities = Activity.objects.none()
+        self._summaries_ready = None
+        self._generation = None
     
-    def get_activities_dataframe(self, activity_type=None, start_date=None, end_date=None):
-        """Convert activities to pandas DataFrame for analysis"""
+    @property
+    def generation(self):
+        """The user's data generation, read once per instance"""
+        if self._generation is None:
+            self._generation = get_generation(self.user) if self.user else 0
+        return self._generation
+    
+    def _use_summaries(self):
+        """Whether the user's ActivitySummary rollups can answer a query"""
+        if self._summaries_ready is None:
+            self._summaries_ready = self.user is not None and rollups.ensure_ready(self.user)
+        return self._summaries_ready
+    
+    def _summaries(self, period_type):
+        return ActivitySummary.objects.filter(user=self.user, period_type=period_type)
+    
+    def get_activity_frame(self, activity_type=None, start_date=None, end_date=None):
+        """
+        Load activities into a column store whose derived columns are computed on demand
+        
+        The built-in trends are aggregated in SQL; this is the pandas path for
+        analyses the database cannot express, such as percentiles.
+        """
         queryset = self.activities
         
         if activity_type:
@@ -27,41 +92,26 @@ class StravaAnalytics:
         if end_date:
             queryset = queryset.filter(start_date__lte=end_date)
         
-        # Convert to list of dictionaries
-        activities_data = list(queryset.values(
-            'id', 'name', 'activity_type', 'start_date', 'distance',
-            'moving_time', 'elapsed_time', 'average_speed', 'max_speed',
-            'total_elevation_gain', 'average_heartrate', 'max_heartrate',
-            'calories'
-        ))
-        
-        if not activities_data:
-            return pd.DataFrame()
-        
-        df = pd.DataFrame(activities_data)
-        
-        # Convert distance to km and speed to km/h
-        df['distance_km'] = df['distance'] / 1000
-        df['distance_miles'] = df['distance'] / 1609.34
-        df['average_speed_kmh'] = df['average_speed'].fillna(0) * 3.6
-        df['average_speed_mph'] = df['average_speed'].fillna(0) * 2.237
-        df['max_speed_kmh'] = df['max_speed'].fillna(0) * 3.6
-        df['moving_time_hours'] = df['moving_time'] / 3600
-        
-        # Calculate pace (minutes per km)
-        df['pace_min_per_km'] = (df['moving_time'] / 60) / df['distance_km']
-        
-        # Add date fields for grouping
-        df['date'] = pd.to_datetime(df['start_date']).dt.date
-        df['year'] = pd.to_datetime(df['start_date']).dt.year
-        df['month'] = pd.to_datetime(df['start_date']).dt.month
-        df['week'] = pd.to_datetime(df['start_date']).dt.isocalendar().week
-        df['day_of_week'] = pd.to_datetime(df['start_date']).dt.day_name()
-        
-        return df
+        return ActivityFrame.from_queryset(queryset)
     
-    def get_summary_stats(self, period='all', activity_type=None):
-        """Get summary statistics for activities"""
+    def get_activities_dataframe(self, activity_type=None, start_date=None, end_date=None):
+        """Convert activities to pandas DataFrame for analysis"""
+        return self.get_activity_frame(activity_type, start_date, end_date).to_dataframe()
+    
+    @cached_analytics(time_sensitive=True)
+    def get_summary_stats(self, period='all', activity_type=None, units=None):
+        """
+        Get summary statistics for activities
+        
+        Args:
+            period: 'all', 'week', 'month' or 'year'
+            activity_type: Only count activities of this type
+            units: 'metric' or 'imperial' to return only that unit system;
+                by default both are returned alongside the SI values
+        """
+        if period == 'all' and not activity_type and self._use_summaries():
+            return self._add_summary_units(self._summary_stats_from_rollups(), units)
+        
         queryset = self.activities
         
         if activity_type:
@@ -90,18 +140,43 @@ class StravaAnalytics:
             avg_heartrate=Avg('average_heartrate')
         )
         
-        # Convert to more readable units
-        stats['total_distance_km'] = (stats['total_distance'] or 0) / 1000
-        stats['total_distance_miles'] = (stats['total_distance'] or 0) / 1609.34
-        stats['total_time_hours'] = (stats['total_time'] or 0) / 3600
-        stats['avg_distance_km'] = (stats['avg_distance'] or 0) / 1000
-        stats['avg_speed_kmh'] = (stats['avg_speed'] or 0) * 3.6
-        stats['avg_speed_mph'] = (stats['avg_speed'] or 0) * 2.237
+        return self._add_summary_units(stats, units)
+    
+    def _summary_stats_from_rollups(self):
+        """All-time summary statistics from the yearly rollups"""
+        totals = self._summaries('year').aggregate(
+            total_activities=Sum('total_activities'),
+            total_distance=Sum('total_distance'),
+            total_time=Sum('total_moving_time'),
+            total_elevation=Sum('total_elevation_gain'),
+            total_calories=Sum('total_calories'),
+            speed_sum=Sum('speed_sum'),
+            speed_count=Sum('speed_count'),
+            heartrate_sum=Sum('heartrate_sum'),
+            heartrate_count=Sum('heartrate_count'),
+        )
         
-        return stats
+        count = totals['total_activities'] or 0
+        return {
+            'total_activities': count,
+            'total_distance': totals['total_distance'],
+            'total_time': totals['total_time'],
+            'total_elevation': totals['total_elevation'],
+            'total_calories': totals['total_calories'],
+            'avg_distance': totals['total_distance'] / count if count else None,
+            'avg_speed': totals['speed_sum'] / totals['speed_count'] if totals['speed_count'] else None,
+            'avg_heartrate': (
+                totals['heartrate_sum'] / totals['heartrate_count'] if totals['heartrate_count'] else None
+            ),
+        }
+    
+    def _add_summary_units(self, stats, units=None):
+        """Add readable-unit versions of the summary statistics"""
+        return convert_row(stats, TOTALS_UNITS, units, keep_source=units is None)
     
-    def get_activity_type_breakdown(self, period='all'):
-        """Get breakdown of activities by type"""
+    @cached_analytics(time_sensitive=True)
+    def get_activity_type_breakdown(self, period='all', units=None):
+        """Get breakdown of activities by type, in one or both unit systems"""
         queryset = self.activities
         
         # Apply date filtering
@@ -123,153 +198,566 @@ class StravaAnalytics:
             avg_distance=Avg('distance'),
             avg_speed=Avg('average_speed')
         ).order_by('-count')
+        columns = value_columns(
+            breakdown, ['activity_type', 'count', 'total_distance', 'total_time', 'avg_distance', 'avg_speed']
+        )
         
-        # Convert to readable units
-        for item in breakdown:
-            item['total_distance_km'] = (item['total_distance'] or 0) / 1000
-            item['total_distance_miles'] = (item['total_distance'] or 0) / 1609.34
-            item['total_time_hours'] = (item['total_time'] or 0) / 3600
-            item['avg_distance_km'] = (item['avg_distance'] or 0) / 1000
-            item['avg_distance_miles'] = (item['avg_distance'] or 0) / 1609.34
-            item['avg_speed_kmh'] = (item['avg_speed'] or 0) * 3.6
-            item['avg_speed_mph'] = (item['avg_speed'] or 0) * 2.237
-        
-        return list(breakdown)
+        return to_rows(convert(columns, TOTALS_UNITS, units, keep_source=units is None))
     
-    def get_monthly_trends(self, activity_type=None):
-        """Get monthly activity trends"""
+    @cached_analytics()
+    def get_monthly_trends(self, activity_type=None, units=None):
+        """Get monthly activity trends, in one or both unit systems"""
         queryset = self.activities
         
         if activity_type:
             queryset = queryset.filter(activity_type=activity_type)
         
-        # Get all activities (full history)
-        df = self.get_activities_dataframe(activity_type=activity_type)
-        if df.empty:
-            return []
-        
-        # Group by year-month
-        df['year_month'] = pd.to_datetime(df['start_date']).dt.to_period('M')
-        
-        monthly_stats = df.groupby('year_month').agg({
-            'id': 'count',
-            'distance_km': 'sum',
-            'distance_miles': 'sum',
-            'moving_time_hours': 'sum',
-            'average_speed_kmh': 'mean',
-            'average_speed_mph': 'mean',
-            'calories': 'sum'
-        }).reset_index()
-        
-        monthly_stats.columns = ['month', 'activities', 'distance_km', 'distance_miles', 'time_hours', 'avg_speed_kmh', 'avg_speed_mph', 'calories']
-        monthly_stats['month'] = monthly_stats['month'].astype(str)
+        if not activity_type and self._use_summaries():
+            return to_rows(convert(self._monthly_trends_from_rollups(), MONTH_UNITS, units))
+        
+        # Group by local year and month in the database
+        months = queryset.values('local_year', 'local_month').annotate(
+            activities=Count('id'),
+            distance=Sum('distance'),
+            moving_time=Sum('moving_time'),
+            # A missing speed counts as 0, as it always has in this average
+            speed=Avg(Coalesce('average_speed', 0.0)),
+            calories=Sum('calories'),
+        ).order_by('local_year', 'local_month')
+        months = value_columns(
+            months, ['local_year', 'local_month', 'activities', 'distance', 'moving_time', 'speed', 'calories']
+        )
         
-        return monthly_stats.to_dict('records')
+        return to_rows(convert({
+            'month': [f'{year:04d}-{month:02d}' for year, month in zip(months['local_year'], months['local_month'])],
+            'activities': months['activities'],
+            'distance': months['distance'],
+            'moving_time': months['moving_time'],
+            'speed': months['speed'],
+            'calories': [calories or 0 for calories in months['calories']],
+        }, MONTH_UNITS, units))
     
-    def get_weekly_trends(self, weeks=12, activity_type=None):
-        """Get weekly activity trends"""
+    def _monthly_trends_from_rollups(self):
+        """Monthly trends (in SI units, as columns) from the monthly rollups"""
+        summaries = value_columns(self._summaries('month').order_by('period_start'), [
+            'period_start', 'total_activities', 'total_distance', 'total_moving_time', 'speed_sum', 'total_calories',
+        ])
+        return {
+            'month': [period_start.strftime('%Y-%m') for period_start in summaries['period_start']],
+            'activities': summaries['total_activities'],
+            'distance': summaries['total_distance'],
+            'moving_time': summaries['total_moving_time'],
+            # Matches the grouped query, which counts a missing speed as 0
+            'speed': (np.asarray(summaries['speed_sum'], dtype=np.float64)
+                      / np.asarray(summaries['total_activities'], dtype=np.float64)),
+            'calories': summaries['total_calories'],
+        }
+    
+    @cached_analytics(time_sensitive=True)
+    def get_weekly_trends(self, weeks=12, activity_type=None, units=None):
+        """Get weekly activity trends, in one or both unit systems"""
         queryset = self.activities
         
         if activity_type:
             queryset = queryset.filter(activity_type=activity_type)
         
-        # Get activities from last N weeks
-        weeks_ago = timezone.now() - timedelta(weeks=weeks)
-        start_date = weeks_ago
-        
-        df = self.get_activities_dataframe(activity_type=activity_type, start_date=start_date)
-        if df.empty:
-            return []
-        
-        # Group by year-week
-        df['year_week'] = pd.to_datetime(df['start_date']).dt.to_period('W')
-        
-        weekly_stats = df.groupby('year_week').agg({
-            'id': 'count',
-            'distance_km': 'sum',
-            'distance_miles': 'sum',
-            'moving_time_hours': 'sum',
-            'calories': 'sum'
-        }).reset_index()
+        # Get activities from last N weeks, by local start date
+        first_day = (timezone.now() - timedelta(weeks=weeks)).date()
+        
+        if not activity_type and self._use_summaries():
+            return to_rows(convert(self._weekly_trends_from_rollups(first_day), WEEK_UNITS, units))
+        
+        # Group by local ISO week (Monday to Sunday) in the database
+        week_totals = queryset.filter(local_date__gte=first_day).values('iso_year', 'iso_week').annotate(
+            activities=Count('id'),
+            distance=Sum('distance'),
+            moving_time=Sum('moving_time'),
+            calories=Sum('calories'),
+        ).order_by('iso_year', 'iso_week')
+        week_totals = value_columns(
+            week_totals, ['iso_year', 'iso_week', 'activities', 'distance', 'moving_time', 'calories']
+        )
         
-        weekly_stats.columns = ['week', 'activities', 'distance_km', 'distance_miles', 'time_hours', 'calories']
-        weekly_stats['week'] = weekly_stats['week'].astype(str)
+        week_starts = [
+            date.fromisocalendar(year, week, 1) for year, week in zip(week_totals['iso_year'], week_totals['iso_week'])
+        ]
+        return to_rows(convert({
+            'week': [f'{start.isoformat()}/{(start + timedelta(days=6)).isoformat()}' for start in week_starts],
+            'activities': week_totals['activities'],
+            'distance': week_totals['distance'],
+            'moving_time': week_totals['moving_time'],
+            'calories': [calories or 0 for calories in week_totals['calories']],
+        }, WEEK_UNITS, units))
+    
+    def _weekly_trends_from_rollups(self, first_day):
+        """
+        Weekly trends (in SI units, as columns) since first_day (a local date) from the weekly rollups
+        
+        The week containing first_day is only partly inside the range, so it
+        is aggregated from the raw activities; every later week is a rollup.
+        """
+        partial_start, partial_end = rollups.period_bounds('week', first_day)
+        
+        weeks = []
+        partial = self.activities.filter(
+            local_date__gte=first_day,
+            local_date__lte=partial_end,
+        ).aggregate(
+            activities=Count('id'),
+            distance=Sum('distance'),
+            moving_time=Sum('moving_time'),
+            calories=Sum('calories'),
+        )
+        if partial['activities']:
+            weeks.append((partial_start, partial_end, partial['activities'], partial['distance'],
+                          partial['moving_time'], partial['calories'] or 0))
+        
+        for summary in self._summaries('week').filter(period_start__gt=partial_start).order_by('period_start'):
+            weeks.append((summary.period_start, summary.period_end, summary.total_activities,
+                          summary.total_distance, summary.total_moving_time, summary.total_calories))
+        
+        week_starts, week_ends, counts, distances, moving_times, calories = zip(*weeks) if weeks else ((),) * 6
+        return {
+            'week': [f'{start.isoformat()}/{end.isoformat()}' for start, end in zip(week_starts, week_ends)],
+            'activities': counts,
+            'distance': distances,
+            'moving_time': moving_times,
+            'calories': calories,
+        }
+    
+    @cached_analytics()
+    def get_personal_records(self, activity_type=None, units=None):
+        """
+        Get personal records (longest distance, fastest pace, etc.)
+        
+        Records are read from the PersonalRecord table, which the sync keeps
+        up to date; users without a Strava profile get them computed in one
+        pass over their activities instead.
+        
+        Args:
+            activity_type: Records for one activity type (which includes the
+                5k/10k/half/marathon bests for runs) instead of across all types
+            units: 'metric' or 'imperial' to return only that unit system
+        
+        Returns:
+            dict: record name -> activity, date and value in readable units
+        """
+        scope = activity_type or records.ALL_TYPES
+        
+        if self.user is not None and records.ensure_ready(self.user):
+            stored = PersonalRecord.objects.filter(user=self.user, activity_type=scope).values(
+                'record', 'value', 'start_date', 'activity_id', 'activity__name'
+            )
+            best = {
+                row['record']: (row['value'], row['activity_id'], row['start_date'], row['activity__name'])
+                for row in stored
+            }
+        else:
+            queryset = self.activities
+            if activity_type:
+                queryset = queryset.filter(activity_type=activity_type)
+            computed = records.compute(queryset.order_by().values('id', *records.SOURCE_FIELDS))
+            computed = {name: value for (record_scope, name), value in computed.items() if record_scope == scope}
+            names = dict(Activity.objects.filter(
+                id__in=[activity_id for _, activity_id, _ in computed.values()]
+            ).values_list('id', 'name'))
+            best = {
+                name: (value, activity_id, start_date, names.get(activity_id))
+                for name, (value, activity_id, start_date) in computed.items()
+            }
         
-        return weekly_stats.to_dict('records')
+        return {name: self._format_record(name, *best[name], units=units) for name in sorted(best)}
+    
+    def _format_record(self, name, value, activity_id, start_date, activity_name, units=None):
+        """Serializable form of one record"""
+        record = {
+            'activity_id': activity_id,
+            'activity_name': activity_name,
+            'date': start_date.date().isoformat(),
+            'value': value,
+        }
+        if name == 'longest_distance':
+            record.update(readable('distance', value, 'distance', units))
+        elif name == 'fastest_speed':
+            record.update(readable('speed', value, 'speed', units))
+        elif name == 'most_elevation':
+            record['elevation_m'] = value
+        else:
+            # longest_time and the distance bests are durations in seconds
+            record['time'] = format_duration(round(value))
+        if name in records.DISTANCE_BESTS:
+            meters = records.DISTANCE_BESTS[name]
+            record.update(readable('distance', meters, 'distance', units))
+            record.update(readable('pace', value / meters, 'pace', units))
+        return record
     
-    def get_personal_records(self, activity_type=None):
-        """Get personal records (longest distance, fastest pace, etc.)"""
+    @cached_analytics()
+    def get_day_of_week_stats(self, activity_type=None, units=None):
+        """Get activity statistics by day of week, in one or both unit systems"""
         queryset = self.activities
         
         if activity_type:
             queryset = queryset.filter(activity_type=activity_type)
         
-        if not queryset.exists():
-            return {}
-        
-        records = {}
-        
-        # Longest distance
-        longest = queryset.order_by('-distance').first()
-        if longest:
-            records['longest_distance'] = {
-                'activity': longest,
-                'distance_km': longest.distance_km,
-                'date': longest.start_date.date()
-            }
-        
-        # Longest time
-        longest_time = queryset.order_by('-moving_time').first()
-        if longest_time:
-            records['longest_time'] = {
-                'activity': longest_time,
-                'time': longest_time.moving_time_formatted,
-                'date': longest_time.start_date.date()
-            }
-        
-        # Fastest speed
-        fastest = queryset.filter(average_speed__isnull=False).order_by('-average_speed').first()
-        if fastest:
-            records['fastest_speed'] = {
-                'activity': fastest,
-                'speed_kmh': fastest.average_speed_kmh,
-                'date': fastest.start_date.date()
-            }
-        
-        # Most elevation
-        most_elevation = queryset.filter(
-            total_elevation_gain__isnull=False
-        ).order_by('-total_elevation_gain').first()
-        if most_elevation:
-            records['most_elevation'] = {
-                'activity': most_elevation,
-                'elevation_m': most_elevation.total_elevation_gain,
-                'date': most_elevation.start_date.date()
-            }
+        # ISO weekday numbers (Monday = 1) also sort the days Monday..Sunday
+        days = queryset.values('weekday').annotate(
+            activities=Count('id'),
+            distance=Avg('distance'),
+            moving_time=Avg('moving_time'),
+            speed=Avg(Coalesce('average_speed', 0.0)),
+        ).order_by('weekday')
+        days = value_columns(days, ['weekday', 'activities', 'distance', 'moving_time', 'speed'])
+        
+        return to_rows(convert({
+            'day': [DAY_NAMES[weekday - 1] for weekday in days['weekday']],
+            'avg_activities': days['activities'],
+            'distance': days['distance'],
+            'moving_time': days['moving_time'],
+            'speed': days['speed'],
+        }, DAY_UNITS, units))
+    
+    @cached_analytics(time_sensitive=True)
+    def get_curves(self, channel='power', activity_type=None, window_days=0, activity_id=None, units=None):
+        """
+        Get a mean-maximal curve: the best average power, speed or heart rate for each duration
+        
+        The user's bests come from the stored curve envelopes, which are
+        updated as activity streams are synced rather than recomputed here.
+        
+        Args:
+            channel: 'power' (watts), 'speed' (with pace) or 'heartrate' (bpm)
+            activity_type: Bests of one activity type instead of all types
+            window_days: Only activities from the last 90 or 365 days (0 for all)
+            activity_id: The curve of this one activity instead of the bests
+            units: 'metric' or 'imperial' to return only that unit system
+        
+        Returns:
+            list: One point per duration (seconds) with data, with the value
+                and, for the bests, the activity that set it and its date
+        """
+        if self.user is None:
+            return []
         
-        return records
+        activity_ids = start_times = None
+        if activity_id is not None:
+            if not self.activities.filter(id=activity_id).exists():
+                return []
+            curve = curves.get_activity_curve(activity_id, channel)
+            if curve is None:
+                return []
+        else:
+            if not curves.ensure_ready(self.user):
+                return []
+            curve, activity_ids, start_times = curves.get_envelope(
+                self.user, channel, activity_type or curves.ALL_TYPES, window_days
+            )
+        
+        present = ~np.isnan(curve)
+        values = curve[present].astype(np.float64)
+        columns = {'duration': curves.DURATIONS[present]}
+        
+        if channel == 'speed':
+            columns['speed'] = values
+            # A standstill has no pace
+            with np.errstate(divide='ignore'):
+                columns['pace'] = np.where(values > 0, 1 / values, np.nan)
+            convert(columns, CURVE_UNITS, units)
+        else:
+            columns['watts' if channel == 'power' else 'bpm'] = values
+        
+        if activity_ids is not None:
+            columns['activity_id'] = activity_ids[present]
+            columns['date'] = [
+                datetime.fromtimestamp(start_time, tz=dt_timezone.utc).date().isoformat()
+                for start_time in start_times[present].tolist()
+            ]
+        return to_rows(columns)
     
-    def get_day_of_week_stats(self, activity_type=None):
-        """Get activity statistics by day of week"""
-        df = self.get_activities_dataframe(activity_type=activity_type)
+    @cached_analytics()
+    def get_nearby_activities(self, latitude, longitude, radius_km=1.0, point='start', activity_type=None, limit=50, units=None):
+        """
+        Get the activities starting (or ending) within a radius of a point, nearest first
+        
+        Candidates are read from the (user, geohash) index as prefix ranges
+        of the cells around the point, then filtered by great-circle
+        distance, so only activities near the point are read.
+        
+        Args:
+            latitude, longitude: The point, in degrees
+            radius_km: Search radius in kilometers
+            point: 'start' or 'end' of the activities
+            activity_type: Only activities of this type
+            limit: Maximum number of activities returned
+            units: 'metric' or 'imperial' to return only that unit system
+        
+        Returns:
+            list: Activities with their distance from the point (from_point_*)
+        """
+        geohash_field = f'{point}_geohash'
+        latitude_field, longitude_field = f'{point}_latitude', f'{point}_longitude'
+        queryset = self.activities.order_by()
+        if activity_type:
+            queryset = queryset.filter(activity_type=activity_type)
         
-        if df.empty:
+        # One index range per cell, combined with UNION ALL: an OR of the
+        # ranges would be planned as a scan of all the user's activities
+        prefixes = geo.search_prefixes(latitude, longitude, radius_km)
+        if prefixes:
+            ranges = [
+                queryset.filter(**{
+                    f'{geohash_field}__gte': prefix, f'{geohash_field}__lt': prefix + geo.PREFIX_END,
+                }).values_list('id', latitude_field, longitude_field)
+                for prefix in prefixes
+            ]
+            candidates = list(ranges[0].union(*ranges[1:], all=True))
+        else:
+            candidates = list(queryset.filter(**{f'{geohash_field}__gt': ''}).values_list(
+                'id', latitude_field, longitude_field
+            ))
+        if not candidates:
             return []
         
-        day_stats = df.groupby('day_of_week').agg({
-            'id': 'count',
-            'distance_km': 'mean',
-            'distance_miles': 'mean',
-            'moving_time_hours': 'mean',
-            'average_speed_kmh': 'mean',
-            'average_speed_mph': 'mean'
-        }).reset_index()
-        
-        day_stats.columns = ['day', 'avg_activities', 'avg_distance_km', 'avg_distance_miles', 'avg_time_hours', 'avg_speed_kmh', 'avg_speed_mph']
+        ids, latitudes, longitudes = zip(*candidates)
+        offsets = geo.haversine_km(latitude, longitude, latitudes, longitudes)
+        order = np.argsort(offsets, kind='stable')
+        order = order[offsets[order] <= radius_km][:limit]
+        
+        # Only the activities returned are read in full
+        details = {
+            row['id']: row
+            for row in queryset.filter(id__in=[ids[index] for index in order]).values(
+                'id', 'name', 'activity_type', 'start_date', 'distance'
+            )
+        }
+        found = [details[ids[index]] for index in order.tolist()]
+        return to_rows(convert({
+            'id': [row['id'] for row in found],
+            'name': [row['name'] for row in found],
+            'type': [row['activity_type'] for row in found],
+            'date': [row['start_date'].isoformat() for row in found],
+            'latitude': np.asarray(latitudes, dtype=np.float64)[order],
+            'longitude': np.asarray(longitudes, dtype=np.float64)[order],
+            'distance': [row['distance'] for row in found],
+            'offset': offsets[order] * 1000,
+        }, NEARBY_UNITS, units))
+    
+    @cached_analytics()
+    def get_start_locations(self, precision=6, limit=20):
+        """
+        Get the places activities most often start from
+        
+        Start points are counted per geohash cell (about 1.2 x 0.6 km at
+        precision 6) in one grouped query over the (user, start_geohash)
+        index, and adjacent busy cells are merged into one location.
+        
+        Args:
+            precision: Geohash precision of the counted cells
+            limit: Maximum number of locations returned
+        
+        Returns:
+            list: Locations busiest first, with their activity count and
+                the latitude and longitude of their center
+        """
+        cells = self.activities.exclude(start_geohash='').order_by().values(
+            cell=Substr('start_geohash', 1, precision)
+        ).annotate(count=Count('id'))
+        return geo.cluster_cells({row['cell']: row['count'] for row in cells})[:limit]
+    
+    @cached_analytics()
+    def get_courses(self, activity_type=None, min_activities=2, units=None):
+        """
+        Get the routes the user has repeated, most repeated first
+        
+        Activities are matched to courses as they are synced, so this is
+        one grouped query over the user's courses and their activities.
+        
+        Args:
+            activity_type: Only courses of this activity type
+            min_activities: Leave out courses done fewer times than this
+            units: 'metric' or 'imperial' to return only that unit system
+        
+        Returns:
+            list: Courses with their activity count, best moving time and
+                first and latest dates
+        """
+        if self.user is None or not courses.ensure_ready(self.user):
+            return []
         
-        # Reorder days of week
-        day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        day_stats['day'] = pd.Categorical(day_stats['day'], categories=day_order, ordered=True)
-        day_stats = day_stats.sort_values('day')
+        queryset = Course.objects.filter(user=self.user)
+        if activity_type:
+            queryset = queryset.filter(activity_type=activity_type)
+        rows = queryset.annotate(
+            activity_count=Count('activities'),
+            best_time=Min('activities__moving_time'),
+            first_date=Min('activities__start_date'),
+            last_date=Max('activities__start_date'),
+        ).filter(activity_count__gte=min_activities).order_by('-activity_count', '-last_date')
+        rows = value_columns(rows, [
+            'id', 'name', 'activity_type', 'distance', 'activity_count', 'best_time', 'first_date', 'last_date',
+        ])
+        
+        return to_rows(convert({
+            'id': rows['id'],
+            'name': rows['name'],
+            'type': rows['activity_type'],
+            'distance': rows['distance'],
+            'activities': rows['activity_count'],
+            'best_time': [format_duration(best_time) for best_time in rows['best_time']],
+            'first_date': [first_date.isoformat() for first_date in rows['first_date']],
+            'last_date': [last_date.isoformat() for last_date in rows['last_date']],
+        }, COURSE_UNITS, units))
+    
+    @cached_analytics()
+    def get_course_progression(self, course_id, units=None):
+        """
+        Get every effort on one course, oldest first, for a progression chart
+        
+        Args:
+            course_id: A course of the user's
+            units: 'metric' or 'imperial' to return only that unit system
+        
+        Returns:
+            dict: The course and its efforts, each flagged when it was the
+                fastest so far, or None if the user has no such course
+        """
+        if self.user is None or not courses.ensure_ready(self.user):
+            return None
+        course = Course.objects.filter(user=self.user, id=course_id).values('id', 'name', 'activity_type', 'distance').first()
+        if course is None:
+            return None
+        
+        rows = value_columns(self.activities.filter(course_id=course_id).order_by('start_date', 'id'), [
+            'id', 'name', 'start_date', 'distance', 'moving_time', 'average_speed', 'average_heartrate',
+        ])
+        times = np.asarray(rows['moving_time'], dtype=np.float64)
+        distances = np.asarray(rows['distance'], dtype=np.float64)
+        fastest = np.minimum.accumulate(times) if len(times) else times
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pace = np.where(distances > 0, times / distances, np.nan)
+        
+        efforts = to_rows(convert({
+            'id': rows['id'],
+            'name': rows['name'],
+            'date': [start_date.isoformat() for start_date in rows['start_date']],
+            'moving_time': rows['moving_time'],
+            'moving_time_formatted': [format_duration(moving_time) for moving_time in rows['moving_time']],
+            'average_speed': rows['average_speed'],
+            'pace': pace,
+            'average_heartrate': rows['average_heartrate'],
+            'fastest_so_far': times <= fastest,
+        }, EFFORT_UNITS, units))
+        
+        return {
+            'course': convert_row({
+                'id': course['id'],
+                'name': course['name'],
+                'type': course['activity_type'],
+                'distance': course['distance'],
+            }, COURSE_UNITS, units),
+            'efforts': efforts,
+        }
+    
+    @cached_analytics(time_sensitive=True)
+    def get_training_load(self, days=180):
+        """
+        Get daily training stress with fitness (CTL), fatigue (ATL) and form (TSB)
+        
+        The series is read from the stored daily training load, which is kept
+        current as activities are synced.
+        
+        Args:
+            days: Number of days up to and including today
+        
+        Returns:
+            dict: The thresholds activities are scored against, and one
+                point per day with load, fitness, fatigue and form
+        """
+        if self.user is None or not training_load.ensure_ready(self.user):
+            return {'ftp': None, 'threshold_heartrate': None, 'series': []}
+        thresholds = StravaProfile.objects.filter(user=self.user).values('ftp', 'threshold_heartrate').first()
+        
+        end = timezone.now().date()
+        dates, load, fitness, fatigue = training_load.get_series(self.user, end - timedelta(days=days - 1), end)
+        
+        series = [
+            {'date': day, 'load': day_load, 'fitness': day_fitness, 'fatigue': day_fatigue, 'form': day_form}
+            for day, day_load, day_fitness, day_fatigue, day_form in zip(
+                dates.astype(str).tolist(), load.tolist(), fitness.tolist(), fatigue.tolist(),
+                (fitness - fatigue).tolist(),
+            )
+        ]
+        return dict(thresholds, series=series)
+    
+    @cached_analytics(time_sensitive=True)
+    def get_dashboard(self, period='all', activity_type=None, weeks=12, units=None):
+        """
+        Get everything the dashboard charts need in one call
+        
+        Each section is a grouped query or a rollup read, and each is cached
+        on its own, so the bundle shares results with the single endpoints.
+        
+        Args:
+            period: Period for the summary stats and type breakdown
+            activity_type: Activity type for the stats and trends
+            weeks: Number of weeks in the weekly trends
+            units: 'metric' or 'imperial' to return only that unit system
+        
+        Returns:
+            dict: stats, breakdown, monthly_trends, weekly_trends, day_of_week
+        """
+        return {
+            'stats': self.get_summary_stats(period=period, activity_type=activity_type, units=units),
+            'breakdown': self.get_activity_type_breakdown(period=period, units=units),
+            'monthly_trends': self.get_monthly_trends(activity_type=activity_type, units=units),
+            'weekly_trends': self.get_weekly_trends(weeks=weeks, activity_type=activity_type, units=units),
+            'day_of_week': self.get_day_of_week_stats(activity_type=activity_type, units=units),
+        }
+    
+    @cached_analytics()
+    def get_facets(self):
+        """
+        Get the years, months and activity types the user has activities in
+        
+        Type counts are one grouped query answered from the (user, type,
+        start_date) index. Month counts come from the monthly rollups, or
+        from a grouped query when rollups are not available.
+        
+        Returns:
+            dict: total, years (newest first, each with its months) and types
+                (most frequent first)
+        """
+        type_counts = self.activities.order_by().values('activity_type').annotate(count=Count('id'))
+        types = sorted(
+            ({'type': group['activity_type'], 'count': group['count']} for group in type_counts),
+            key=lambda facet: (-facet['count'], facet['type']),
+        )
         
-        return day_stats.to_dict('records')
\ No newline at end of file
+        if self._use_summaries():
+            month_counts = (
+                (summary['period_start'].year, summary['period_start'].month, summary['total_activities'])
+                for summary in self._summaries('month').values('period_start', 'total_activities')
+            )
+        else:
+            month_counts = (
+                (group['year'], group['month'], group['count'])
+                for group in self.activities.order_by().values(
+                    year=F('local_year'), month=F('local_month')
+                ).annotate(count=Count('id'))
+            )
+        
+        years = {}
+        for year, month, count in month_counts:
+            years.setdefault(year, {})[month] = count
+        
+        return {
+            'total': sum(facet['count'] for facet in types),
+            'years': [
+                {
+                    'year': year,
+                    'count': sum(years[year].values()),
+                    'months': [{'month': month, 'count': years[year][month]} for month in sorted(years[year])],
+                }
+                for year in sorted(years, reverse=True)
+            ],
+            'types': types,
+        }
@@ -0,0 +1,109 @@
+import functools
+import hashlib
+import inspect
+import threading
+
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+
+from .models import StravaProfile
+
+
+CACHE_ALIAS = 'analytics'
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def cache_stats():
+    """
+    Return hit/miss counters for analytics results served by this process
+
+    Returns:
+        dict: hits, misses and hit ratio
+    """
+    with _lock:
+        hits, misses = _stats['hits'], _stats['misses']
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def get_generation(user):
+    """Return the user's current data generation (0 without a Strava profile)"""
+    generation = StravaProfile.objects.filter(user=user).values_list('data_generation', flat=True).first()
+    return generation or 0
+
+
+def bump_generation(user):
+    """Invalidate every cached analytics result for a user"""
+    StravaProfile.objects.filter(user=user).update(
+        data_generation=F('data_generation') + 1,
+        data_modified_at=timezone.now(),
+    )
+
+
+def make_key(user_id, generation, method, arguments, day=None):
+    """Build the cache key for one analytics call"""
+    digest = hashlib.md5(repr(arguments).encode()).hexdigest()
+    key = f'analytics:{user_id}:{generation}:{method}:{digest}'
+    if day is not None:
+        key += f':{day.isoformat()}'
+    return key
+
+
+def cached_analytics(time_sensitive=False):
+    """
+    Cache a StravaAnalytics method per (user, method, arguments, generation)
+
+    The generation is bumped by the sync pipeline whenever the user's
+    activities change, so entries never need explicit invalidation; stale
+    generations simply age out of the backend (LRU/TTL, as configured for
+    the 'analytics' cache in settings.CACHES).
+
+    Args:
+        time_sensitive: The result depends on the current date (rolling
+            "last N days" windows), so the key also includes today's date.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.user is None:
+                return method(self, *args, **kwargs)
+
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = sorted((name, value) for name, value in bound.arguments.items() if name != 'self')
+
+            key = make_key(
+                self.user.id,
+                self.generation,
+                method.__name__,
+                arguments,
+                day=timezone.now().date() if time_sensitive else None,
+            )
+
+            cache = caches[CACHE_ALIAS]
+            result = cache.get(key)
+            if result is not None:
+                _count('hits')
+                return result
+
+            _count('misses')
+            result = method(self, *args, **kwargs)
+            cache.set(key, result)
+            return result
+
+        return wrapper
+    return decorator
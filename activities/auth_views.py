@@ -7,7 +7,9 @@ import requests
 import os
 from datetime import datetime, timezone as dt_timezone
 from django.utils import timezone
+from .http_client import get_session
 from .models import StravaProfile
+from .sync_jobs import enqueue_sync
 
 def login_view(request):
     """Login page"""
@@ -103,7 +105,7 @@ def strava_callback(request):
     }
     
     try:
-        response = requests.post(token_url, data=token_data)
+        response = get_session().post(token_url, data=token_data)
         response.raise_for_status()
         token_info = response.json()
         
@@ -138,14 +140,14 @@ def sync_activities_view(request):
         messages.error(request, 'Please connect your Strava account first.')
         return redirect('strava_auth')
     
-    # Import here to avoid circular imports
-    from .strava_service import StravaService
+    # ?full=1 re-fetches the whole history; otherwise only new activities are fetched
+    full_resync = request.GET.get('full') == '1'
     
-    try:
-        service = StravaService(strava_profile)
-        activities_synced = service.sync_all_activities()
-        messages.success(request, f'Synced {activities_synced} activities from Strava!')
-    except Exception as e:
-        messages.error(request, f'Failed to sync activities: {str(e)}')
+    # The sync runs in the run_sync_worker process; the dashboard polls its progress
+    job, created = enqueue_sync(strava_profile, full=full_resync)
+    if created:
+        messages.success(request, 'Strava sync started. Your dashboard will update when it finishes.')
+    else:
+        messages.info(request, 'A Strava sync is already in progress.')
     
     return redirect('dashboard')
\ No newline at end of file
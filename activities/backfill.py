@@ -0,0 +1,142 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .http_client import get_session
+from .rate_limit import governor
+
+
+class ConcurrentBackfill:
+    """
+    Fetch /athlete/activities pages in parallel and save them in order
+
+    The caller's thread keeps a window of `workers` page requests in flight on
+    a thread pool and saves the results in page order as they arrive. Pool
+    threads only issue the HTTP request: the rate-limit budget is taken before
+    a page is dispatched, Strava's usage headers are recorded once it comes
+    back, and tokens are refreshed, all on the caller's thread, so the caller's
+    thread is the only one touching the database.
+
+    The first page shorter than `per_page` marks the end of the history: no
+    further pages are requested and any in-flight requests past it are
+    discarded.
+    """
+
+    def __init__(self, service, workers=4, queue_depth=8, per_page=200, after=None, limit=None):
+        """
+        Args:
+            service: StravaService used for fetching and saving
+            workers: Number of pages fetched concurrently
+            queue_depth: Maximum number of pages, beyond those in flight,
+                fetched ahead of the page being saved
+            per_page: Number of activities per page (max 200)
+            after: Unix timestamp to only fetch activities after this date
+            limit: Maximum number of activities to sync (None for all)
+        """
+        self.service = service
+        self.workers = max(1, workers)
+        self.queue_depth = max(1, queue_depth)
+        self.per_page = per_page
+        self.after = after
+        self.limit = limit
+        self.error = None
+
+        # Page number -> future of its HTTP response, for pages not yet saved
+        self._pending = {}
+        self._next_page = 1
+
+    def run(self):
+        """
+        Run the backfill until the last page has been saved
+
+        Returns:
+            tuple: (total processed, total newly created)
+        """
+        total_synced = 0
+        total_new = 0
+
+        # Refreshing now saves every page in flight from failing with a 401
+        if not self.service.ensure_fresh_token():
+            self.error = Exception("Failed to refresh access token")
+            print(f"Error syncing activities: {self.error}")
+            return total_synced, total_new
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='strava-page') as executor:
+            try:
+                while True:
+                    try:
+                        page, activities = self._next(executor)
+                    except Exception as e:
+                        self.error = e
+                        print(f"Error syncing activities: {e}")
+                        break
+                    if not activities:
+                        print("No more activities found")
+                        break
+
+                    batch = activities
+                    if self.limit:
+                        batch = activities[:self.limit - total_synced]
+
+                    created, updated = self.service.save_activities(batch)
+                    total_new += created
+                    total_synced += len(batch)
+
+                    print(f"Processed {len(batch)} activities from page {page} "
+                          f"({created} new, {updated} updated)")
+                    self.service.report_progress(page, total_synced, total_new)
+
+                    if self.limit and total_synced >= self.limit:
+                        break
+                    if len(activities) < self.per_page:
+                        print("Reached end of activities")
+                        break
+            finally:
+                for future in self._pending.values():
+                    future.cancel()
+                self._pending.clear()
+
+        return total_synced, total_new
+
+    def _next(self, executor):
+        """Keep the window full and return the next page in order, as (page, activities)"""
+        while True:
+            self._fill(executor)
+            page = min(self._pending)
+            future = self._pending[page]
+            if future.done():
+                del self._pending[page]
+                return page, self._receive(page, future)
+            wait([f for f in self._pending.values() if not f.done()], return_when=FIRST_COMPLETED)
+
+    def _fill(self, executor):
+        """Take budget for and dispatch pages until the window is full"""
+        while True:
+            in_flight = sum(not future.done() for future in self._pending.values())
+            if in_flight >= self.workers or len(self._pending) >= self.workers + self.queue_depth:
+                return
+            governor.acquire()
+            print(f"Fetching page {self._next_page}...")
+            self._pending[self._next_page] = executor.submit(
+                self._fetch, self._next_page, self.service.access_token
+            )
+            self._next_page += 1
+
+    def _fetch(self, page, access_token):
+        """Request a single page on a pool thread; plain HTTP, no database access"""
+        params = {'page': page, 'per_page': self.per_page}
+        if self.after:
+            params['after'] = self.after
+        return get_session().get(
+            f"{self.service.BASE_URL}/athlete/activities",
+            headers={'Authorization': f'Bearer {access_token}'},
+            params=params,
+        )
+
+    def _receive(self, page, future):
+        """Record a fetched page's rate-limit usage and return its activities"""
+        response = future.result()
+        governor.record(response.headers)
+        if response.status_code in (401, 429):
+            # Let the regular request path refresh the token or wait out the budget
+            return self.service.get_activities(page=page, per_page=self.per_page, after=self.after)
+        response.raise_for_status()
+        return response.json()
@@ -0,0 +1,342 @@
+import hashlib
+from collections import defaultdict
+
+import numpy as np
+from django.db import transaction
+
+from .geo import KM_PER_DEGREE, cell_size
+from .models import Activity, Course, CourseBucket, StravaProfile
+
+
+# Routes are compared as the sets of map cells they pass through, sampled
+# every SAMPLE_SPACING meters along the route. Precision 7 geohash cells
+# are about 150 m across: wide enough that GPS jitter rarely moves a
+# sample into another cell, narrow enough to tell neighboring streets apart.
+CELL_PRECISION = 7
+SAMPLE_SPACING = 50
+
+# MinHash signature length, split into BANDS bands of ROWS values for the
+# locality-sensitive hash index. Two routes with cell-set similarity s
+# share at least one bucket with probability 1 - (1 - s ** ROWS) ** BANDS:
+# about 0.89 at s = 0.6 and 0.12 at s = 0.3.
+NUM_HASHES = 64
+BANDS = 16
+ROWS = NUM_HASHES // BANDS
+
+# Fixed so that signatures stay comparable across processes and releases
+SIGNATURE_SEED = 20240617
+
+# Estimated cell-set similarity from which two routes are the same course
+MATCH_SIMILARITY = 0.6
+
+# Largest relative difference in distance between activities of one course
+DISTANCE_TOLERANCE = 0.15
+
+# Activity fields courses are matched on (rows also carry the id)
+SOURCE_FIELDS = ['name', 'activity_type', 'start_date', 'distance', 'summary_polyline']
+
+# Fields that change which course an activity belongs to
+ROUTE_FIELDS = ['activity_type', 'distance', 'summary_polyline']
+
+# Largest number of values in one IN (...) query
+QUERY_CHUNK = 500
+
+_rng = np.random.default_rng(SIGNATURE_SEED)
+_MULTIPLIERS = _rng.integers(1, 2 ** 63, NUM_HASHES, dtype=np.uint64) | np.uint64(1)
+_OFFSETS = _rng.integers(0, 2 ** 63, NUM_HASHES, dtype=np.uint64)
+
+
+def decode_polyline(encoded, precision=5):
+    """
+    Decode a Google encoded polyline
+
+    Returns:
+        numpy.ndarray: (points, 2) latitudes and longitudes in degrees
+    """
+    values, value, shift = [], 0, 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    values = np.array(values[:len(values) // 2 * 2], dtype=np.int64).reshape(-1, 2)
+    return np.cumsum(values, axis=0) / 10 ** precision
+
+
+def route_cells(points):
+    """
+    Map cells a route passes through
+
+    The route is resampled at even spacing first, so that long straight
+    segments between polyline points count every cell they cross.
+
+    Returns:
+        numpy.ndarray: Sorted unique uint64 cell ids
+    """
+    latitudes, longitudes = points[:, 0], points[:, 1]
+    # Equirectangular distances are accurate to well under a sample spacing
+    north = np.diff(latitudes) * KM_PER_DEGREE * 1000
+    east = np.diff(longitudes) * np.cos(np.radians(latitudes[1:])) * KM_PER_DEGREE * 1000
+    along = np.concatenate(([0.0], np.cumsum(np.hypot(north, east))))
+    if along[-1] > 0:
+        samples = np.arange(0, along[-1] + SAMPLE_SPACING, SAMPLE_SPACING)
+        latitudes = np.interp(samples, along, latitudes)
+        longitudes = np.interp(samples, along, longitudes)
+
+    height, width = cell_size(CELL_PRECISION)
+    rows = np.floor((latitudes + 90) / height).astype(np.uint64)
+    columns = np.floor((longitudes + 180) / width).astype(np.uint64)
+    return np.unique(rows << np.uint64(32) | columns)
+
+
+def _mix(values):
+    """Scramble uint64 values (the splitmix64 finalizer) so nearby cell ids hash independently"""
+    values = values ^ values >> np.uint64(33)
+    values = values * np.uint64(0xff51afd7ed558ccd)
+    values = values ^ values >> np.uint64(33)
+    values = values * np.uint64(0xc4ceb9fe1a85ec53)
+    return values ^ values >> np.uint64(33)
+
+
+def signature(cells):
+    """
+    MinHash signature of a set of cells
+
+    The share of equal values between two signatures estimates the Jaccard
+    similarity of their cell sets.
+
+    Returns:
+        numpy.ndarray: NUM_HASHES uint32 values
+    """
+    mixed = _mix(cells)
+    hashed = (_MULTIPLIERS[:, None] * mixed[None, :] + _OFFSETS[:, None]) >> np.uint64(32)
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def route_signature(encoded):
+    """Signature of an encoded polyline, or None for an empty route"""
+    if not encoded:
+        return None
+    points = decode_polyline(encoded)
+    if len(points) < 2:
+        return None
+    return signature(route_cells(points))
+
+
+def buckets(values):
+    """
+    Locality-sensitive hash buckets of a signature, one per band
+
+    Returns:
+        list: Signed 64-bit bucket ids, each covering its band's position
+    """
+    values = np.ascontiguousarray(values, dtype='<u4')
+    return [
+        int.from_bytes(
+            hashlib.blake2b(bytes([band]) + values[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).digest(),
+            'little', signed=True,
+        )
+        for band in range(BANDS)
+    ]
+
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of the routes of two signatures"""
+    return float(np.mean(first == second))
+
+
+def _similar_distance(first, second):
+    longer = max(first or 0, second or 0)
+    return longer > 0 and abs((first or 0) - (second or 0)) <= DISTANCE_TOLERANCE * longer
+
+
+def _load_index(user, wanted):
+    """Existing courses sharing any of the wanted buckets: bucket -> [Course]"""
+    wanted = list(wanted)
+    course_buckets = []
+    for start in range(0, len(wanted), QUERY_CHUNK):
+        course_buckets.extend(CourseBucket.objects.filter(
+            user=user, bucket__in=wanted[start:start + QUERY_CHUNK]
+        ).values_list('bucket', 'course_id'))
+
+    courses = {}
+    course_ids = list({course_id for _, course_id in course_buckets})
+    for start in range(0, len(course_ids), QUERY_CHUNK):
+        for course in Course.objects.filter(id__in=course_ids[start:start + QUERY_CHUNK]):
+            course.route = np.frombuffer(course.signature, dtype='<u4')
+            courses[course.id] = course
+
+    index = defaultdict(list)
+    for bucket, course_id in course_buckets:
+        index[bucket].append(courses[course_id])
+    return index
+
+
+def _assign(user, rows, existing=True):
+    """
+    Match activities to courses, creating a course for each new route
+
+    Each activity is only compared against the courses it shares an LSH
+    bucket with, so matching does not depend on how many courses there are.
+    Activities are matched oldest first, within the batch as well.
+
+    Args:
+        user: Owner of the activities
+        rows: Field dicts (SOURCE_FIELDS and id) of the activities
+        existing: Match against the user's stored courses too
+    """
+    prepared = []
+    for row in rows:
+        values = route_signature(row['summary_polyline'])
+        if values is not None:
+            prepared.append((row, values, buckets(values)))
+    if not prepared:
+        return
+
+    index = _load_index(user, {bucket for _, _, row_buckets in prepared for bucket in row_buckets}) if existing else defaultdict(list)
+
+    new_courses = []
+    matched = {}
+    for row, values, row_buckets in sorted(prepared, key=lambda item: item[0]['start_date']):
+        candidates = {id(course): course for bucket in row_buckets for course in index.get(bucket, ())}
+        best, best_similarity = None, MATCH_SIMILARITY
+        for course in candidates.values():
+            if course.activity_type != row['activity_type'] or not _similar_distance(course.distance, row['distance']):
+                continue
+            score = similarity(course.route, values)
+            if score >= best_similarity:
+                best, best_similarity = course, score
+
+        if best is None:
+            best = Course(
+                user=user, name=row['name'], activity_type=row['activity_type'],
+                distance=row['distance'], signature=values.astype('<u4').tobytes(),
+            )
+            best.route, best.route_buckets = values, row_buckets
+            new_courses.append(best)
+            for bucket in row_buckets:
+                index[bucket].append(best)
+        matched.setdefault(id(best), (best, []))[1].append(row['id'])
+
+    Course.objects.bulk_create(new_courses, batch_size=500)
+    CourseBucket.objects.bulk_create([
+        CourseBucket(course=course, user=user, bucket=bucket)
+        for course in new_courses for bucket in course.route_buckets
+    ], batch_size=1000)
+    for course, activity_ids in matched.values():
+        for start in range(0, len(activity_ids), QUERY_CHUNK):
+            Activity.objects.filter(id__in=activity_ids[start:start + QUERY_CHUNK]).update(course=course)
+
+
+def _is_ready(user_id):
+    return bool(StravaProfile.objects.filter(user_id=user_id).values_list('courses_ready', flat=True).first())
+
+
+def _seeded_by(user, rows):
+    """
+    Ids of the courses whose stored route came from one of the given activities
+
+    A course keeps the signature and distance of the activity it was first
+    seen in, so its seed is found by comparing those against the activities
+    as they were before they changed.
+
+    Args:
+        user: Owner of the activities
+        rows: Field dicts (SOURCE_FIELDS) of activities before a change
+    """
+    seeds = {}
+    for row in rows:
+        values = route_signature(row['summary_polyline'])
+        if values is not None:
+            seeds.setdefault(values.astype('<u4').tobytes(), []).append(row)
+    if not seeds:
+        return []
+
+    signatures = list(seeds)
+    course_ids = []
+    for start in range(0, len(signatures), QUERY_CHUNK):
+        for course_id, course_signature, activity_type, distance in Course.objects.filter(
+            user=user, signature__in=signatures[start:start + QUERY_CHUNK]
+        ).values_list('id', 'signature', 'activity_type', 'distance'):
+            if any(row['activity_type'] == activity_type and row['distance'] == distance
+                   for row in seeds[bytes(course_signature)]):
+                course_ids.append(course_id)
+    return course_ids
+
+
+def apply_changes(user, removed=(), added=()):
+    """
+    Match new activities and activities whose route changed to courses
+
+    A course whose first activity was re-routed or deleted no longer has
+    that route to match against, so it is dropped and its remaining
+    activities are matched again. Courses left without activities (after
+    deletes or re-matching) are removed along with their buckets.
+
+    Args:
+        user: Owner of the activities
+        removed: Field dicts (with id) of activities as they were before an
+            update or delete
+        added: Field dicts of activities as they are after a create or update
+    """
+    if not _is_ready(user.id):
+        # Matched from all activities when the user's courses are first read
+        return
+
+    before = {row['id']: row for row in removed if row.get('id') is not None}
+    after_ids = {row['id'] for row in added if row.get('id') is not None}
+    routed = [
+        row for row in added if row.get('id') is not None and (
+            row['id'] not in before
+            or any(before[row['id']].get(field) != row.get(field) for field in ROUTE_FIELDS)
+        )
+    ]
+    deleted = before.keys() - after_ids
+    if not routed and not deleted:
+        return
+
+    with transaction.atomic():
+        stale = _seeded_by(user, [before[row['id']] for row in routed if row['id'] in before]
+                           + [before[activity_id] for activity_id in deleted])
+        if stale:
+            routed_ids = {row['id'] for row in routed}
+            for start in range(0, len(stale), QUERY_CHUNK):
+                chunk = stale[start:start + QUERY_CHUNK]
+                routed.extend(
+                    row for row in Activity.objects.filter(course_id__in=chunk).values('id', *SOURCE_FIELDS)
+                    if row['id'] not in routed_ids
+                )
+                Course.objects.filter(id__in=chunk).delete()
+        if routed:
+            Activity.objects.filter(id__in=[row['id'] for row in routed]).update(course=None)
+            _assign(user, routed)
+        Course.objects.filter(user=user, activities__isnull=True).delete()
+
+
+def rebuild(user):
+    """Match all of a user's activities to courses from scratch"""
+    with transaction.atomic():
+        Course.objects.filter(user=user).delete()
+        rows = Activity.objects.filter(user=user).exclude(summary_polyline='').order_by().values(
+            'id', *SOURCE_FIELDS
+        ).iterator(chunk_size=2000)
+        _assign(user, rows, existing=False)
+        StravaProfile.objects.filter(user=user).update(courses_ready=True)
+
+
+def ensure_ready(user):
+    """
+    Make sure a user's activities have been matched to courses before they are read
+
+    Returns:
+        bool: True if the stored courses can be used for this user
+    """
+    ready = StravaProfile.objects.filter(user=user).values_list('courses_ready', flat=True).first()
+    if ready is None:
+        # Users without a Strava profile have no synced routes
+        return False
+    if not ready:
+        rebuild(user)
+    return True
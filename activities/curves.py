@@ -0,0 +1,409 @@
+from datetime import timedelta
+from itertools import product
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Activity, ActivityCurve, CurveEnvelope, StravaProfile
+from .streams import load_streams
+
+
+# Durations in seconds the curves are computed for: every second up to a
+# minute, then progressively coarser steps up to five hours
+DURATIONS = np.unique(np.concatenate([
+    np.arange(1, 60),
+    np.arange(60, 600, 15),
+    np.arange(600, 3600, 60),
+    np.arange(3600, 5 * 3600 + 1, 300),
+]))
+
+# Curve channel -> stream it is computed from
+CHANNELS = {
+    'power': 'watts',
+    'speed': 'distance',
+    'heartrate': 'heartrate',
+}
+
+# Envelope windows in days; 0 is the whole history
+WINDOWS = (0, 90, 365)
+
+# Scope of the envelopes across all activity types
+ALL_TYPES = ''
+
+# Activity fields the envelopes depend on (rows also carry the id)
+SOURCE_FIELDS = ['activity_type', 'start_date']
+
+# Gaps between samples longer than this (in seconds) are pauses, during
+# which no power is produced
+MAX_GAP = 10
+
+
+def _per_second(time, values, gap_value=None):
+    """
+    Resample a stream to one value per second, holding each sample until the next
+
+    Samples with no value are dropped first. With a gap_value, seconds more
+    than MAX_GAP after the last sample get that value instead.
+    """
+    valid = ~np.isnan(values)
+    time, values = time[valid], values[valid]
+    if len(time) < 2:
+        return None
+    seconds = np.arange(time[0], time[-1] + 1)
+    index = np.searchsorted(time, seconds, side='right') - 1
+    series = values[index]
+    if gap_value is not None:
+        series[seconds - time[index] > MAX_GAP] = gap_value
+    return series
+
+
+def _best_rise(cumulative):
+    """
+    Largest increase of a per-second cumulative series over each duration, per second
+
+    Each duration is one vectorized pass over the series (a sliding window
+    as the difference of two offset slices), so a curve costs O(n) per
+    duration whatever the duration.
+
+    Returns:
+        numpy.ndarray: float32 over DURATIONS, NaN where the series is too short
+    """
+    best = np.full(len(DURATIONS), np.nan, dtype=np.float32)
+    length = len(cumulative) - 1
+    for i, duration in enumerate(DURATIONS):
+        if duration > length:
+            break
+        best[i] = (cumulative[duration:] - cumulative[:-duration]).max() / duration
+    return best
+
+
+def compute(streams):
+    """
+    Compute the mean-maximal curves of one activity
+
+    Args:
+        streams: stream type -> array, as returned by load_streams
+
+    Returns:
+        dict: channel -> float32 array over DURATIONS, for each channel the
+            activity has data for
+    """
+    time = streams.get('time')
+    if time is None or len(time) < 2:
+        return {}
+    time = np.asarray(time, dtype=np.int64)
+
+    curves = {}
+    for channel, stream_type in CHANNELS.items():
+        values = streams.get(stream_type)
+        if values is None or len(values) != len(time):
+            continue
+        values = np.asarray(values, dtype=np.float64)
+
+        if channel == 'speed':
+            # Distance is already cumulative: the best speed over a duration
+            # is the most distance covered in it
+            valid = ~np.isnan(values)
+            if valid.sum() < 2:
+                continue
+            seconds = np.arange(time[valid][0], time[valid][-1] + 1)
+            cumulative = np.interp(seconds, time[valid], values[valid])
+        else:
+            series = _per_second(time, values, gap_value=0.0 if channel == 'power' else None)
+            if series is None:
+                continue
+            cumulative = np.concatenate(([0.0], np.cumsum(series)))
+
+        curve = _best_rise(cumulative)
+        if not np.isnan(curve).all():
+            curves[channel] = curve
+    return curves
+
+
+def _empty():
+    """An envelope with no values: (values, activity ids, start times)"""
+    return (
+        np.full(len(DURATIONS), np.nan, dtype=np.float32),
+        np.zeros(len(DURATIONS), dtype=np.int64),
+        np.zeros(len(DURATIONS), dtype=np.int64),
+    )
+
+
+def _unpack_curve(data):
+    return np.frombuffer(data, dtype='<f4')
+
+
+def _unpack(envelope):
+    """The arrays of a stored envelope, as writable copies"""
+    return (
+        np.frombuffer(envelope.values, dtype='<f4').copy(),
+        np.frombuffer(envelope.activity_ids, dtype='<i8').copy(),
+        np.frombuffer(envelope.start_times, dtype='<i8').copy(),
+    )
+
+
+def _pack(envelope, arrays):
+    values, activity_ids, start_times = arrays
+    envelope.values = values.astype('<f4').tobytes()
+    envelope.activity_ids = activity_ids.astype('<i8').tobytes()
+    envelope.start_times = start_times.astype('<i8').tobytes()
+
+
+def _merge(arrays, curve, activity_id, start_time):
+    """
+    Raise an envelope to a curve wherever the curve is better
+
+    Returns:
+        bool: Whether any duration changed; ties keep the current holder
+    """
+    values, activity_ids, start_times = arrays
+    better = (curve > values) | (np.isnan(values) & ~np.isnan(curve))
+    values[better] = curve[better]
+    activity_ids[better] = activity_id
+    start_times[better] = start_time
+    return bool(better.any())
+
+
+def _windows_for(start_date, now):
+    """Envelope windows an activity started at start_date falls into"""
+    return [window for window in WINDOWS if not window or start_date >= now - timedelta(days=window)]
+
+
+def _is_ready(user_id):
+    return bool(StravaProfile.objects.filter(user_id=user_id).values_list('curves_ready', flat=True).first())
+
+
+def add_activity(activity_id):
+    """
+    Compute an activity's curves from its stored streams and merge them into the user's envelopes
+
+    Only the new curves are compared against the envelopes, so adding an
+    activity never touches the rest of the history.
+
+    Returns:
+        dict: channel -> curve of the activity
+    """
+    activity = Activity.objects.filter(id=activity_id).values('user_id', 'activity_type', 'start_date').first()
+    if activity is None:
+        return {}
+    curves = compute(load_streams(activity_id, ['time', *CHANNELS.values()]))
+
+    with transaction.atomic():
+        ActivityCurve.objects.filter(activity_id=activity_id).delete()
+        ActivityCurve.objects.bulk_create([
+            ActivityCurve(activity_id=activity_id, channel=channel, values=curve.astype('<f4').tobytes())
+            for channel, curve in curves.items()
+        ])
+
+        user_id = activity['user_id']
+        if not curves or user_id is None or not _is_ready(user_id):
+            # Envelopes are built from all stored curves once the user's are first read
+            return curves
+
+        start_date = activity['start_date']
+        start_time = int(start_date.timestamp())
+        scopes = [ALL_TYPES, activity['activity_type']]
+        windows = _windows_for(start_date, timezone.now())
+        existing = {
+            (envelope.activity_type, envelope.channel, envelope.window_days): envelope
+            for envelope in CurveEnvelope.objects.select_for_update().filter(
+                user_id=user_id, activity_type__in=scopes, channel__in=list(curves), window_days__in=windows,
+            )
+        }
+
+        to_create, to_update = [], []
+        for scope, channel, window in product(scopes, curves, windows):
+            envelope = existing.get((scope, channel, window))
+            if envelope is None:
+                envelope = CurveEnvelope(user_id=user_id, activity_type=scope, channel=channel, window_days=window)
+                arrays = _empty()
+                _merge(arrays, curves[channel], activity_id, start_time)
+                _pack(envelope, arrays)
+                to_create.append(envelope)
+                continue
+            arrays = _unpack(envelope)
+            if _merge(arrays, curves[channel], activity_id, start_time):
+                _pack(envelope, arrays)
+                to_update.append(envelope)
+
+        if to_create:
+            CurveEnvelope.objects.bulk_create(to_create)
+        if to_update:
+            CurveEnvelope.objects.bulk_update(to_update, ['values', 'activity_ids', 'start_times', 'updated_at'])
+    return curves
+
+
+def apply_changes(user, removed=(), added=()):
+    """
+    Update a user's envelopes for changed or deleted activities
+
+    An envelope is rebuilt from the stored activity curves only if one of
+    its values was held by a removed activity, or an activity moved to
+    another type or date; otherwise nothing changes, since new activities
+    get their curves (and are merged) when their streams are fetched.
+    Rolling windows whose values have aged out are rebuilt along the way.
+
+    Args:
+        user: Owner of the activities
+        removed: Field dicts (with id) of activities as they were before an
+            update or delete
+        added: Field dicts of activities as they are after a create or update
+    """
+    after = {row['id']: row for row in added if row.get('id') is not None}
+    before = [row for row in removed if row.get('id') is not None]
+    if not _is_ready(user.id):
+        return
+
+    moved = any(
+        row['id'] in after and any(row[field] != after[row['id']][field] for field in SOURCE_FIELDS)
+        for row in before
+    )
+    if moved:
+        rebuild_envelopes(user)
+        return
+
+    # Updated activities keep their curves; only deleted ones can vacate a value
+    holders = np.array([row['id'] for row in before if row['id'] not in after], dtype=np.int64)
+    now = timezone.now()
+    stale = [
+        (envelope.activity_type, envelope.channel, envelope.window_days)
+        for envelope in CurveEnvelope.objects.filter(user=user)
+        if np.isin(np.frombuffer(envelope.activity_ids, dtype='<i8'), holders).any() or _expired(envelope, now)
+    ]
+    if stale:
+        rebuild_envelopes(user, keys=stale)
+
+
+def _expired(envelope, now):
+    """Whether a rolling-window envelope holds values of activities that have left the window"""
+    if not envelope.window_days:
+        return False
+    cutoff = int((now - timedelta(days=envelope.window_days)).timestamp())
+    activity_ids = np.frombuffer(envelope.activity_ids, dtype='<i8')
+    start_times = np.frombuffer(envelope.start_times, dtype='<i8')
+    return bool((start_times[activity_ids != 0] < cutoff).any())
+
+
+def expire_windows(user):
+    """Rebuild a user's rolling-window envelopes that hold values which have aged out"""
+    now = timezone.now()
+    stale = [
+        (envelope.activity_type, envelope.channel, envelope.window_days)
+        for envelope in CurveEnvelope.objects.filter(user=user, window_days__gt=0)
+        if _expired(envelope, now)
+    ]
+    if stale:
+        rebuild_envelopes(user, keys=stale)
+
+
+def _build_envelopes(user, keys=None, now=None):
+    """
+    Compute a user's envelopes from the stored activity curves, without storing them
+
+    Returns:
+        dict: (activity type, channel, window days) -> envelope arrays
+    """
+    rows = ActivityCurve.objects.filter(activity__user=user)
+    if keys is not None:
+        keys = set(keys)
+        rows = rows.filter(channel__in={channel for _, channel, _ in keys})
+    rows = rows.order_by('activity__start_date', 'activity_id').values_list(
+        'activity_id', 'activity__activity_type', 'activity__start_date', 'channel', 'values'
+    )
+
+    now = now or timezone.now()
+    envelopes = {}
+    for activity_id, activity_type, start_date, channel, data in rows.iterator(chunk_size=2000):
+        curve = _unpack_curve(data)
+        start_time = int(start_date.timestamp())
+        for scope, window in product((ALL_TYPES, activity_type), _windows_for(start_date, now)):
+            key = (scope, channel, window)
+            if keys is not None and key not in keys:
+                continue
+            if key not in envelopes:
+                envelopes[key] = _empty()
+            _merge(envelopes[key], curve, activity_id, start_time)
+    return envelopes
+
+
+def rebuild_envelopes(user, keys=None):
+    """
+    Recompute a user's envelopes from the stored activity curves
+
+    Args:
+        user: Owner of the envelopes
+        keys: Only rebuild these (activity type, channel, window days) envelopes
+    """
+    with transaction.atomic():
+        envelopes = _build_envelopes(user, keys)
+
+        existing = CurveEnvelope.objects.filter(user=user)
+        if keys is None:
+            existing.delete()
+        else:
+            for scope, channel, window in keys:
+                existing.filter(activity_type=scope, channel=channel, window_days=window).delete()
+
+        stored = []
+        for (scope, channel, window), arrays in envelopes.items():
+            envelope = CurveEnvelope(user=user, activity_type=scope, channel=channel, window_days=window)
+            _pack(envelope, arrays)
+            stored.append(envelope)
+        CurveEnvelope.objects.bulk_create(stored)
+
+
+def rebuild(user):
+    """Compute any missing activity curves from stored streams, then rebuild the envelopes"""
+    missing = Activity.objects.filter(
+        user=user, streams_synced_at__isnull=False, curves__isnull=True,
+    ).values_list('id', flat=True)
+    for activity_id in list(missing):
+        add_activity(activity_id)
+
+    rebuild_envelopes(user)
+    StravaProfile.objects.filter(user=user).update(curves_ready=True)
+
+
+def ensure_ready(user):
+    """
+    Make sure a user's envelopes are populated before they are read
+
+    Returns:
+        bool: True if the stored envelopes can be used for this user
+    """
+    ready = StravaProfile.objects.filter(user=user).values_list('curves_ready', flat=True).first()
+    if ready is None:
+        # Users without a Strava profile have no streams
+        return False
+    if not ready:
+        rebuild(user)
+    return True
+
+
+def get_envelope(user, channel, activity_type=ALL_TYPES, window_days=0):
+    """
+    Read one of a user's envelopes
+
+    Reads never write: a rolling window still holding values of activities
+    that have since dropped out of it is recomputed in memory, and stored
+    again by the next sync (see expire_windows).
+
+    Returns:
+        tuple: (values, activity ids, start times) arrays over DURATIONS
+    """
+    key = (activity_type, channel, window_days)
+    envelope = CurveEnvelope.objects.filter(
+        user=user, activity_type=activity_type, channel=channel, window_days=window_days,
+    ).first()
+    if envelope is None:
+        return _empty()
+    if _expired(envelope, timezone.now()):
+        return _build_envelopes(user, keys=[key]).get(key, _empty())
+    return _unpack(envelope)
+
+
+def get_activity_curve(activity_id, channel):
+    """The stored curve of one activity's channel, or None"""
+    data = ActivityCurve.objects.filter(activity_id=activity_id, channel=channel).values_list('values', flat=True).first()
+    return _unpack_curve(data) if data is not None else None
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+from django.db.models import CharField
+from django.db.models.functions import Cast
+
+
+# Columns read from the database, with the dtype each is stored in. Nullable
+# integer fields become float64 so a missing value can be NaN.
+BASE_COLUMNS = {
+    'id': np.int64,
+    'name': object,
+    'activity_type': object,
+    'start_date': None,
+    'distance': np.float64,
+    'moving_time': np.int64,
+    'elapsed_time': np.int64,
+    'average_speed': np.float64,
+    'max_speed': np.float64,
+    'total_elevation_gain': np.float64,
+    'average_heartrate': np.float64,
+    'max_heartrate': np.float64,
+    'calories': np.float64,
+}
+
+DAY_NAMES = np.array(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'], dtype=object)
+
+
+# Derived columns, computed on first access from the base columns
+DERIVED_COLUMNS = {
+    'distance_km': lambda f: f['distance'] / 1000,
+    'distance_miles': lambda f: f['distance'] / 1609.34,
+    'average_speed_kmh': lambda f: np.nan_to_num(f['average_speed']) * 3.6,
+    'average_speed_mph': lambda f: np.nan_to_num(f['average_speed']) * 2.237,
+    'max_speed_kmh': lambda f: np.nan_to_num(f['max_speed']) * 3.6,
+    'moving_time_hours': lambda f: f['moving_time'] / 3600,
+    'pace_min_per_km': lambda f: _pace(f['moving_time'], f['distance_km']),
+    'date': lambda f: np.asarray(f['start_date'].date),
+    'year': lambda f: np.asarray(f['start_date'].year),
+    'month': lambda f: np.asarray(f['start_date'].month),
+    'week': lambda f: f['start_date'].isocalendar()['week'].to_numpy(dtype=np.int64),
+    'day_of_week': lambda f: DAY_NAMES[np.asarray(f['start_date'].dayofweek)],
+}
+
+
+def _pace(moving_time, distance_km):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (moving_time / 60) / distance_km
+
+
+def value_columns(queryset, fields):
+    """
+    Read fields of a queryset as one tuple per field, in a single values_list pass
+
+    Returns:
+        dict: field -> tuple of values (empty without rows)
+    """
+    rows = list(queryset.values_list(*fields))
+    return dict(zip(fields, zip(*rows))) if rows else {field: () for field in fields}
+
+
+class ActivityFrame:
+    """
+    Column store for a user's activities
+
+    The base columns are read in a single pass over ``values_list`` tuples
+    into typed NumPy arrays, with all the timestamps parsed in one call. Derived columns
+    (unit conversions, calendar fields) are only computed the first time they
+    are asked for, so an aggregation pays for the columns it uses and no more.
+    """
+
+    def __init__(self, columns, length):
+        self._columns = columns
+        self._length = length
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        """Load the base columns of every activity in a queryset"""
+        names = list(BASE_COLUMNS)
+        # start_date is fetched as text and parsed in one vectorised call,
+        # instead of the ORM building a datetime object per row
+        fields = [name if name != 'start_date' else 'start_date_text' for name in names]
+        rows = list(
+            queryset.order_by()
+            .annotate(start_date_text=Cast('start_date', CharField()))
+            .values_list(*fields)
+        )
+        if not rows:
+            return cls({}, 0)
+
+        columns = {}
+        for name, values in zip(names, zip(*rows)):
+            dtype = BASE_COLUMNS[name]
+            if name == 'start_date':
+                columns[name] = pd.DatetimeIndex(pd.to_datetime(values, utc=True, format='ISO8601'))
+            elif dtype is object:
+                columns[name] = np.array(values, dtype=object)
+            else:
+                # None becomes NaN in float columns
+                columns[name] = np.array(values, dtype=dtype)
+        return cls(columns, len(rows))
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def empty(self):
+        return self._length == 0
+
+    def __contains__(self, name):
+        return name in BASE_COLUMNS or name in DERIVED_COLUMNS
+
+    def __getitem__(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            if name not in DERIVED_COLUMNS:
+                raise KeyError(name)
+            column = DERIVED_COLUMNS[name](self)
+            self._columns[name] = column
+        return column
+
+    def to_dataframe(self, columns=None):
+        """
+        Materialise a pandas DataFrame
+
+        Args:
+            columns: Column names to include (defaults to every base and
+                derived column)
+
+        Returns:
+            DataFrame: Empty if there are no activities
+        """
+        if self.empty:
+            return pd.DataFrame()
+        if columns is None:
+            columns = list(BASE_COLUMNS) + list(DERIVED_COLUMNS)
+        return pd.DataFrame({name: self[name] for name in columns}, copy=False)
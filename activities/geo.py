@@ -0,0 +1,189 @@
+import numpy as np
+
+
+# Geohash alphabet: each character adds 5 bits, alternating longitude and
+# latitude halvings, so that hashes sharing a prefix share a cell
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DECODE = {char: index for index, char in enumerate(BASE32)}
+
+# Characters stored per coordinate: a cell of about 38 x 19 m
+GEOHASH_PRECISION = 8
+
+# Sorts after every geohash character, for prefix range queries
+PREFIX_END = '~'
+
+# Most index ranges one nearby search reads
+MAX_SEARCH_CELLS = 16
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    Geohash of a point
+
+    Returns:
+        str: The geohash, or '' when either coordinate is missing
+    """
+    if latitude is None or longitude is None:
+        return ''
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        interval, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """Height and width in degrees of the cells of a geohash precision"""
+    return 180.0 / 2 ** _lat_bits(precision), 360.0 / 2 ** _lng_bits(precision)
+
+
+def _lat_bits(precision):
+    return 5 * precision // 2
+
+
+def _lng_bits(precision):
+    return (5 * precision + 1) // 2
+
+
+def _cell_index(geohash):
+    """Row and column of a geohash cell in the grid of its precision"""
+    bits = 0
+    for char in geohash:
+        bits = bits << 5 | DECODE[char]
+    total = 5 * len(geohash)
+    row = column = 0
+    # Bits alternate longitude, latitude, ... from the most significant
+    for position in range(total):
+        bit = bits >> (total - 1 - position) & 1
+        if position % 2:
+            row = row << 1 | bit
+        else:
+            column = column << 1 | bit
+    return row, column
+
+
+def _cell_geohash(row, column, precision):
+    """Geohash of the cell at a row and column of the grid of a precision"""
+    total = 5 * precision
+    lat_bits, lng_bits = _lat_bits(precision), _lng_bits(precision)
+    bits = 0
+    for position in range(total):
+        if position % 2:
+            lat_bits -= 1
+            bits = bits << 1 | row >> lat_bits & 1
+        else:
+            lng_bits -= 1
+            bits = bits << 1 | column >> lng_bits & 1
+    return ''.join(BASE32[bits >> shift & 31] for shift in range(total - 5, -1, -5))
+
+
+def search_prefixes(latitude, longitude, radius_km):
+    """
+    Geohash prefixes whose cells together cover a circle
+
+    Uses the finest precision at which the circle's bounding box is covered
+    by at most MAX_SEARCH_CELLS cells, so each prefix is a narrow index range.
+
+    Returns:
+        list: The prefixes, or [] when the circle is too large for prefixes
+            to narrow anything down
+    """
+    lat_span = radius_km / KM_PER_DEGREE
+    lng_span = lat_span / max(np.cos(np.radians(min(abs(latitude) + lat_span, 90.0))), 1e-9)
+    south, north = max(latitude - lat_span, -90.0), min(latitude + lat_span, 90.0)
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        last_row = 2 ** _lat_bits(precision) - 1
+        rows = range(min(int((south + 90) // height), last_row), min(int((north + 90) // height), last_row) + 1)
+        column_count = 2 ** _lng_bits(precision)
+        first_column = int((longitude - lng_span + 180) // width)
+        columns = int((longitude + lng_span + 180) // width) - first_column + 1
+        if columns >= column_count or len(rows) * columns > MAX_SEARCH_CELLS:
+            continue
+        return [
+            _cell_geohash(row, (first_column + offset) % column_count, precision)
+            for row in rows for offset in range(columns)
+        ]
+    return []
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """
+    Great-circle distances from one point to many
+
+    Args:
+        latitude, longitude: The point, in degrees
+        latitudes, longitudes: Arrays of points, in degrees
+
+    Returns:
+        numpy.ndarray: Distances in kilometers
+    """
+    lat1, lng1 = np.radians(latitude), np.radians(longitude)
+    lat2, lng2 = np.radians(np.asarray(latitudes, dtype=np.float64)), np.radians(np.asarray(longitudes, dtype=np.float64))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def cluster_cells(cell_counts):
+    """
+    Group counted geohash cells into clusters of adjacent cells
+
+    The busiest remaining cell starts each cluster and takes its unclaimed
+    neighbors, so clusters come out busiest first. Neighbors are found by
+    grid row and column, wrapping around in longitude.
+
+    Args:
+        cell_counts: geohash -> number of points in the cell, all of one
+            precision
+
+    Returns:
+        list: dicts with geohash (of the busiest cell), count, and the
+            count-weighted latitude and longitude of the cells' centers
+    """
+    if not cell_counts:
+        return []
+    precision = len(next(iter(cell_counts)))
+    height, width = cell_size(precision)
+    columns = 2 ** _lng_bits(precision)
+
+    names = {_cell_index(geohash): geohash for geohash in cell_counts}
+    counts = {cell: cell_counts[geohash] for cell, geohash in names.items()}
+    claimed = set()
+    clusters = []
+    for cell in sorted(counts, key=lambda cell: (-counts[cell], names[cell])):
+        if cell in claimed:
+            continue
+        row, column = cell
+        members = [
+            member for member in (
+                (row + row_step, (column + column_step) % columns)
+                for row_step in (-1, 0, 1) for column_step in (-1, 0, 1)
+            )
+            if member in counts and member not in claimed
+        ]
+        claimed.update(members)
+
+        total = sum(counts[member] for member in members)
+        clusters.append({
+            'geohash': names[cell],
+            'count': total,
+            'latitude': -90 + (sum(counts[member] * member[0] for member in members) / total + 0.5) * height,
+            'longitude': -180 + (sum(counts[member] * member[1] for member in members) / total + 0.5) * width,
+        })
+    return clusters
@@ -0,0 +1,105 @@
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+_lock = threading.Lock()
+_session = None
+_stats = {'requests': 0, 'new_connections': 0}
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count('new_connections')
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count('new_connections')
+        return super()._new_conn()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout and connection counters"""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        _count('requests')
+        return super().send(request, **kwargs)
+
+
+def _build_session():
+    """Create the shared session from the STRAVA_HTTP_* settings"""
+    pool_size = getattr(settings, 'STRAVA_HTTP_POOL_SIZE', 10)
+
+    # Idempotent requests are retried on 5xx and dropped connections; POSTs
+    # (token exchanges) only when the connection could not be opened at all.
+    retry = Retry(
+        total=getattr(settings, 'STRAVA_HTTP_RETRIES', 3),
+        backoff_factor=getattr(settings, 'STRAVA_HTTP_BACKOFF', 0.5),
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = PooledHTTPAdapter(
+        timeout=(
+            getattr(settings, 'STRAVA_HTTP_CONNECT_TIMEOUT', 5),
+            getattr(settings, 'STRAVA_HTTP_READ_TIMEOUT', 30),
+        ),
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """Return the process-wide keep-alive session used for all Strava calls"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def connection_stats():
+    """
+    Return counters for outbound requests and the connections they used
+
+    Returns:
+        dict: requests sent, new connections opened and connections reused
+    """
+    with _lock:
+        requests_sent = _stats['requests']
+        new_connections = _stats['new_connections']
+    return {
+        'requests': requests_sent,
+        'new_connections': new_connections,
+        'reused_connections': max(requests_sent - new_connections, 0),
+    }
@@ -0,0 +1,55 @@
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+
+from . import courses, curves, records, rollups, training_load
+from .analytics_cache import bump_generation
+
+
+# Activity fields the derived tables are maintained from
+TRACKED_FIELDS = list(dict.fromkeys(
+    rollups.SOURCE_FIELDS + records.SOURCE_FIELDS + curves.SOURCE_FIELDS + training_load.SOURCE_FIELDS
+    + courses.SOURCE_FIELDS
+))
+
+
+def activities_changed(user, removed=(), added=()):
+    """
+    Bring a user's derived data up to date after activities change
+
+    Called by the sync pipeline for every saved page and, through
+    activities_deleted, when activities are deleted, so that derived tables
+    are maintained incrementally rather than recomputed from the full history.
+
+    Args:
+        user: Owner of the activities
+        removed: Field dicts (TRACKED_FIELDS) of activities as they were
+            before an update or delete
+        added: Field dicts of activities as they are after a create or update
+    """
+    if user is None or not (removed or added):
+        return
+
+    rollups.apply_changes(user, removed=removed, added=added)
+    records.apply_changes(user, removed=removed, added=added)
+    curves.apply_changes(user, removed=removed, added=added)
+    training_load.apply_changes(user, removed=removed, added=added)
+    courses.apply_changes(user, removed=removed, added=added)
+    bump_generation(user)
+
+
+def activities_deleted(rows):
+    """
+    Remove deleted activities from their owners' derived data, once per owner
+
+    Args:
+        rows: Field dicts (id, user_id and TRACKED_FIELDS) of the activities
+            as they were before the delete
+    """
+    removed = defaultdict(list)
+    for row in rows:
+        removed[row['user_id']].append({field: row[field] for field in ['id', *TRACKED_FIELDS]})
+
+    users = User.objects.in_bulk(list(removed))
+    for user_id, user_rows in removed.items():
+        activities_changed(users.get(user_id), removed=user_rows)
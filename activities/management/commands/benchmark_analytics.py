@@ -0,0 +1,249 @@
+import json
+import random
+import time
+import tracemalloc
+from datetime import timedelta
+
+import pandas as pd
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.test import RequestFactory
+from django.utils import timezone
+
+from activities.analytics import StravaAnalytics
+from activities.models import Activity, local_date_fields
+from activities import responses, views
+
+
+ACTIVITY_TYPES = ['Run', 'Ride', 'Swim', 'Walk', 'Hike', 'WeightTraining']
+
+
+def legacy_dataframe(queryset):
+    """The list-of-dicts DataFrame loader the columnar loader replaced"""
+    activities_data = list(queryset.values(
+        'id', 'name', 'activity_type', 'start_date', 'distance',
+        'moving_time', 'elapsed_time', 'average_speed', 'max_speed',
+        'total_elevation_gain', 'average_heartrate', 'max_heartrate',
+        'calories'
+    ))
+
+    if not activities_data:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(activities_data)
+
+    df['distance_km'] = df['distance'] / 1000
+    df['distance_miles'] = df['distance'] / 1609.34
+    df['average_speed_kmh'] = df['average_speed'].fillna(0) * 3.6
+    df['average_speed_mph'] = df['average_speed'].fillna(0) * 2.237
+    df['max_speed_kmh'] = df['max_speed'].fillna(0) * 3.6
+    df['moving_time_hours'] = df['moving_time'] / 3600
+    df['pace_min_per_km'] = (df['moving_time'] / 60) / df['distance_km']
+
+    df['date'] = pd.to_datetime(df['start_date']).dt.date
+    df['year'] = pd.to_datetime(df['start_date']).dt.year
+    df['month'] = pd.to_datetime(df['start_date']).dt.month
+    df['week'] = pd.to_datetime(df['start_date']).dt.isocalendar().week
+    df['day_of_week'] = pd.to_datetime(df['start_date']).dt.day_name()
+
+    return df
+
+
+def legacy_monthly_trends(queryset):
+    df = legacy_dataframe(queryset)
+    df['year_month'] = pd.to_datetime(df['start_date']).dt.tz_localize(None).dt.to_period('M')
+    monthly_stats = df.groupby('year_month').agg({
+        'id': 'count',
+        'distance_km': 'sum',
+        'distance_miles': 'sum',
+        'moving_time_hours': 'sum',
+        'average_speed_kmh': 'mean',
+        'average_speed_mph': 'mean',
+        'calories': 'sum'
+    }).reset_index()
+    monthly_stats.columns = ['month', 'activities', 'distance_km', 'distance_miles', 'time_hours', 'avg_speed_kmh', 'avg_speed_mph', 'calories']
+    monthly_stats['month'] = monthly_stats['month'].astype(str)
+    return monthly_stats.to_dict('records')
+
+
+def legacy_day_of_week_stats(queryset):
+    df = legacy_dataframe(queryset)
+    day_stats = df.groupby('day_of_week').agg({
+        'id': 'count',
+        'distance_km': 'mean',
+        'distance_miles': 'mean',
+        'moving_time_hours': 'mean',
+        'average_speed_kmh': 'mean',
+        'average_speed_mph': 'mean'
+    }).reset_index()
+    day_stats.columns = ['day', 'avg_activities', 'avg_distance_km', 'avg_distance_miles', 'avg_time_hours', 'avg_speed_kmh', 'avg_speed_mph']
+    day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+    day_stats['day'] = pd.Categorical(day_stats['day'], categories=day_order, ordered=True)
+    day_stats = day_stats.sort_values('day')
+    return day_stats.to_dict('records')
+
+
+def uncached(method):
+    """Call an analytics method without going through the result cache"""
+    return getattr(method, '__wrapped__', method)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the analytics data paths against synthetic activity histories'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='1000,10000,100000',
+            help='Comma-separated numbers of activities to benchmark with',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Timing runs per measurement (the best run is reported)',
+        )
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+
+        for size in sizes:
+            # Everything is written inside a transaction that is rolled back
+            with transaction.atomic():
+                user = self.create_history(size)
+                self.run_benchmarks(user, size, options['repeat'])
+                transaction.set_rollback(True)
+
+    def create_history(self, size):
+        """Create a throwaway user with `size` synthetic activities"""
+        user = User.objects.create(username=f'benchmark-{time.monotonic_ns()}')
+        rng = random.Random(size)
+        now = timezone.now()
+
+        activities = []
+        for i in range(size):
+            moving_time = rng.randint(600, 3 * 3600)
+            start_date = now - timedelta(minutes=rng.randint(0, 10 * 365 * 24 * 60))
+            activities.append(Activity(
+                user=user,
+                strava_id=i + 1,
+                name=f'Activity {i}',
+                activity_type=rng.choice(ACTIVITY_TYPES),
+                start_date=start_date,
+                **local_date_fields(start_date),
+                distance=rng.uniform(1000, 100000),
+                moving_time=moving_time,
+                elapsed_time=moving_time + rng.randint(0, 900),
+                average_speed=rng.uniform(1, 12) if rng.random() > 0.05 else None,
+                max_speed=rng.uniform(5, 20),
+                total_elevation_gain=rng.uniform(0, 1500),
+                average_heartrate=rng.uniform(100, 170) if rng.random() > 0.3 else None,
+                max_heartrate=rng.uniform(150, 200),
+                calories=rng.randint(50, 2000) if rng.random() > 0.2 else None,
+            ))
+        Activity.objects.bulk_create(activities, batch_size=2000)
+        return user
+
+    def run_benchmarks(self, user, size, repeat):
+        analytics = StravaAnalytics(user)
+        queryset = Activity.objects.filter(user=user)
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f'{size} activities'))
+        self.compare('load', repeat,
+                     lambda: legacy_dataframe(queryset),
+                     lambda: analytics.get_activity_frame())
+        self.compare('load + derive all columns', repeat,
+                     lambda: legacy_dataframe(queryset),
+                     lambda: analytics.get_activities_dataframe())
+        self.compare('monthly trends', repeat,
+                     lambda: legacy_monthly_trends(queryset),
+                     lambda: uncached(StravaAnalytics.get_monthly_trends)(analytics))
+        self.compare('day-of-week stats', repeat,
+                     lambda: legacy_day_of_week_stats(queryset),
+                     lambda: uncached(StravaAnalytics.get_day_of_week_stats)(analytics))
+
+        for label, view, path in [
+            ('monthly trends', views.api_monthly_trends, '/api/monthly-trends/'),
+            ('weekly trends', views.api_weekly_trends, '/api/weekly-trends/?weeks=52'),
+            ('activities page', views.api_activities, f'/api/activities/?limit={views.MAX_ACTIVITIES_PAGE}'),
+        ]:
+            self.compare_payloads(label, repeat, user, view, path)
+
+        self.compare_encoders(user, repeat)
+
+    def compare(self, label, repeat, legacy, current):
+        before = self.best_of(legacy, repeat)
+        after = self.best_of(current, repeat)
+        speedup = before / after if after else float('inf')
+        self.stdout.write(
+            f'  {label:<28} legacy {before * 1000:9.1f} ms   '
+            f'current {after * 1000:9.1f} ms   {speedup:5.1f}x   '
+            f'peak memory {self.peak_memory(legacy):7.1f} -> {self.peak_memory(current):7.1f} MB'
+        )
+
+    def compare_payloads(self, label, repeat, user, view, path):
+        """Response size and time with both unit systems vs only one"""
+        factory = RequestFactory()
+        separator = '&' if '?' in path else '?'
+
+        def respond(units):
+            request = factory.get(f'{path}{separator}units={units}' if units else path)
+            request.user = user
+            return view(request)
+
+        for units in ('metric', 'imperial'):
+            before = len(respond(None).content)
+            after = len(respond(units).content)
+            before_time = self.best_of(lambda: respond(None), repeat)
+            after_time = self.best_of(lambda: respond(units), repeat)
+            self.stdout.write(
+                f'  {label + " (" + units + ")":<28} both   {before / 1000:9.1f} kB   '
+                f'{units:<8} {after / 1000:9.1f} kB   {before / after if after else float("inf"):5.1f}x   '
+                f'response {before_time * 1000:7.1f} -> {after_time * 1000:7.1f} ms'
+            )
+
+    def compare_encoders(self, user, repeat):
+        """Encoded size and time of every activity as rows or columns, per JSON backend"""
+        rows = views.activity_list_rows(
+            Activity.objects.filter(user=user).order_by('-start_date', '-id').values(*views.ACTIVITY_LIST_FIELDS)
+        )
+        frame = StravaAnalytics(user).get_activities_dataframe()
+        backends = [name for name in responses.BACKENDS if name != 'orjson' or responses.orjson is not None]
+
+        self.report_encoding('activity list (JsonResponse)', repeat,
+                             lambda: json.dumps({'activities': rows}, cls=DjangoJSONEncoder).encode())
+        for label, as_rows, as_columns in [
+            ('activity list', rows, responses.to_columns(rows)),
+            ('activity frame', frame.to_dict('records'), responses.to_columns(frame)),
+        ]:
+            for backend in backends:
+                for payload_format, payload in ((responses.ROWS, as_rows), (responses.COLUMNS, as_columns)):
+                    self.report_encoding(
+                        f'{label} {payload_format} ({backend})', repeat,
+                        lambda: responses.encode({'activities': payload}, backend),
+                    )
+
+    def report_encoding(self, label, repeat, encode):
+        size = len(encode())
+        self.stdout.write(
+            f'  {label:<36} {size / 1000:9.1f} kB   encode {self.best_of(encode, repeat) * 1000:7.1f} ms'
+        )
+
+    def peak_memory(self, func):
+        """Peak Python heap allocated while running func, in MB"""
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+
+    def best_of(self, func, repeat):
+        timings = []
+        for _ in range(max(1, repeat)):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
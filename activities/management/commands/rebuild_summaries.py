@@ -0,0 +1,28 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from activities import courses, curves, records, rollups, training_load
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ActivitySummary rollups, personal records, curve envelopes, training load and courses from the stored activities'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            help='Only rebuild summaries for this username',
+        )
+    
+    def handle(self, *args, **options):
+        users = User.objects.filter(strava_profile__isnull=False)
+        if options['user']:
+            users = users.filter(username=options['user'])
+        
+        for user in users:
+            rollups.rebuild(user)
+            records.rebuild(user)
+            curves.rebuild(user)
+            training_load.rebuild(user)
+            courses.rebuild(user)
+            self.stdout.write(f'Rebuilt summaries for {user.username}')
+        
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt summaries for {users.count()} users'))
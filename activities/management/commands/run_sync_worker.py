@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from activities.sync_jobs import SyncWorker
+
+
+class Command(BaseCommand):
+    help = 'Run queued Strava sync jobs'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=2,
+            help='Number of sync jobs run at the same time',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=2.0,
+            help='Seconds between polls of an empty queue',
+        )
+        parser.add_argument(
+            '--page-workers',
+            type=int,
+            default=1,
+            help='Number of activity pages fetched concurrently within a full resync',
+        )
+        parser.add_argument(
+            '--stale-after',
+            type=int,
+            default=30,
+            help='Minutes without progress after which a running job is requeued',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once the queue is empty instead of waiting for new jobs',
+        )
+    
+    def handle(self, *args, **options):
+        worker = SyncWorker(
+            concurrency=options['concurrency'],
+            poll_interval=options['poll_interval'],
+            page_workers=options['page_workers'],
+            stale_after=timedelta(minutes=options['stale_after']),
+            once=options['once'],
+        )
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Sync worker started with {worker.concurrency} slot(s)')
+        )
+        worker.run()
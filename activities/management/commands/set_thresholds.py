@@ -0,0 +1,24 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from activities import training_load
+
+
+class Command(BaseCommand):
+    help = "Set the FTP and threshold heart rate a user's training stress is scored against"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User to update')
+        parser.add_argument('--ftp', type=float, help='Functional threshold power in watts')
+        parser.add_argument('--threshold-heartrate', type=float, help='Lactate threshold heart rate in bpm')
+    
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username'], strava_profile__isnull=False).first()
+        if user is None:
+            raise CommandError(f"No connected Strava user named {options['username']!r}")
+        if options['ftp'] is None and options['threshold_heartrate'] is None:
+            raise CommandError('Give --ftp, --threshold-heartrate or both')
+        
+        training_load.set_thresholds(
+            user, ftp=options['ftp'], threshold_heartrate=options['threshold_heartrate'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt training load for {user.username}'))
@@ -1,4 +1,6 @@
 from django.core.management.base import BaseCommand
+from activities.fleet import sync_fleet
+from activities.http_client import connection_stats
 from activities.strava_service import StravaService
 
 
@@ -16,8 +18,49 @@ class Command(BaseCommand):
             type=int,
             help='Sync activities from last N days only',
         )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Re-fetch the entire history instead of only activities since the last sync',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of activity pages fetched concurrently during a full sync',
+        )
+        parser.add_argument(
+            '--all-users',
+            action='store_true',
+            help='Sync every connected Strava profile instead of the .env account',
+        )
+        parser.add_argument(
+            '--user-workers',
+            type=int,
+            default=4,
+            help='Number of profiles synced at the same time with --all-users',
+        )
+        parser.add_argument(
+            '--queue-depth',
+            type=int,
+            default=8,
+            help='Maximum number of fetched pages waiting to be written to the database',
+        )
+        parser.add_argument(
+            '--streams',
+            action='store_true',
+            help='Also fetch per-sample streams (heart rate, power, GPS...) for activities without them',
+        )
+        parser.add_argument(
+            '--streams-limit',
+            type=int,
+            help='Maximum number of activities to fetch streams for',
+        )
     
     def handle(self, *args, **options):
+        if options['all_users']:
+            return self.handle_fleet(options)
+        
         strava_service = StravaService()
         
         try:
@@ -31,8 +74,13 @@ class Command(BaseCommand):
                 # Sync recent activities only
                 total, new = strava_service.sync_recent_activities(days=options['recent'])
             else:
-                # Sync all activities
-                total, new = strava_service.sync_all_activities(limit=options['limit'])
+                # Incremental sync from the last cursor, or the full history
+                total, new = strava_service.sync_activities(
+                    full=options['full'],
+                    limit=options['limit'],
+                    workers=options['workers'],
+                    queue_depth=options['queue_depth'],
+                )
             
             self.stdout.write(
                 self.style.SUCCESS(
@@ -40,7 +88,60 @@ class Command(BaseCommand):
                 )
             )
             
+            if options['streams']:
+                fetched = strava_service.sync_streams(limit=options['streams_limit'])
+                self.stdout.write(self.style.SUCCESS(f'Fetched streams for {fetched} activities'))
+            
+            http = connection_stats()
+            self.stdout.write(
+                f"HTTP: {http['requests']} requests, {http['new_connections']} new connections, "
+                f"{http['reused_connections']} reused"
+            )
+            
         except Exception as e:
             self.stdout.write(
                 self.style.ERROR(f'Error syncing activities: {str(e)}')
-            )
\ No newline at end of file
+            )
+    
+    def handle_fleet(self, options):
+        """Sync every StravaProfile and print a throughput summary"""
+        results, seconds = sync_fleet(
+            user_workers=options['user_workers'],
+            full=options['full'],
+            page_workers=options['workers'],
+            queue_depth=options['queue_depth'],
+            streams=options['streams'],
+            streams_limit=options['streams_limit'],
+        )
+        
+        for result in results:
+            line = (
+                f'{result.username}: {result.processed} activities ({result.new} new), '
+                f'{result.pages} pages in {result.seconds:.1f}s ({result.rate:.1f}/s)'
+            )
+            if options['streams']:
+                line += f', streams for {result.streams}'
+            if result.error:
+                self.stdout.write(self.style.ERROR(f'{line} - {result.error}'))
+            else:
+                self.stdout.write(line)
+        
+        total = sum(result.processed for result in results)
+        new = sum(result.new for result in results)
+        pages = sum(result.pages for result in results)
+        failed = sum(1 for result in results if result.error)
+        rate = total / seconds if seconds else 0
+        
+        style = self.style.WARNING if failed else self.style.SUCCESS
+        self.stdout.write(
+            style(
+                f'Synced {len(results)} users ({failed} failed): {total} activities '
+                f'({new} new), {pages} pages in {seconds:.1f}s ({rate:.1f} activities/s)'
+            )
+        )
+        
+        http = connection_stats()
+        self.stdout.write(
+            f"HTTP: {http['requests']} requests, {http['new_connections']} new connections, "
+            f"{http['reused_connections']} reused"
+        )
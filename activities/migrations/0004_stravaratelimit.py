@@ -0,0 +1,27 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0003_stravaprofile_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StravaRateLimit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(default='default', max_length=50, unique=True)),
+                ('short_limit', models.IntegerField(default=100)),
+                ('short_usage', models.IntegerField(default=0)),
+                ('short_window_start', models.DateTimeField(blank=True, null=True)),
+                ('long_limit', models.IntegerField(default=1000)),
+                ('long_usage', models.IntegerField(default=0)),
+                ('long_window_start', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0004_stravaratelimit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='last_activity_start',
+            field=models.DateTimeField(blank=True, help_text='Latest activity start_date synced', null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='last_synced_at',
+            field=models.DateTimeField(blank=True, help_text='When the last successful sync finished', null=True),
+        ),
+    ]
@@ -0,0 +1,61 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def delete_summaries(apps, schema_editor):
+    # Summaries were never written before they became per-user; anything
+    # present cannot be attributed to a user and is rebuilt on first read.
+    ActivitySummary = apps.get_model('activities', 'ActivitySummary')
+    ActivitySummary.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0006_syncjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_summaries, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='activitysummary',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='activitysummary',
+            name='user',
+            field=models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, related_name='activity_summaries', to=settings.AUTH_USER_MODEL),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='activitysummary',
+            name='speed_sum',
+            field=models.FloatField(default=0, help_text='Sum of average speeds in m/s'),
+        ),
+        migrations.AddField(
+            model_name='activitysummary',
+            name='speed_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='activitysummary',
+            name='heartrate_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='activitysummary',
+            name='heartrate_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='activitysummary',
+            unique_together={('user', 'period_type', 'period_start')},
+        ),
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='summaries_ready',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0007_per_user_activity_summaries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='data_generation',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0008_stravaprofile_data_generation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'activity_type', 'start_date'], name='activities__user_id_069ddd_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0009_activity_user_type_start_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'start_date'], name='activities__user_id_d026b7_idx'),
+        ),
+    ]
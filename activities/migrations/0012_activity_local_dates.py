@@ -0,0 +1,98 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:46
+
+from datetime import timezone
+
+from django.db import migrations, models
+
+
+def backfill_local_dates(apps, schema_editor):
+    # Activities synced before this migration have no local start time, so
+    # their local calendar columns are taken from the UTC start time. The
+    # next full sync replaces them with the athlete's local dates.
+    Activity = apps.get_model('activities', 'Activity')
+    fields = ['local_date', 'local_year', 'local_month', 'iso_year', 'iso_week', 'weekday']
+    batch = []
+    # Read everything up front: rows are updated while they are being read
+    for activity in list(Activity.objects.filter(local_date__isnull=True).only('id', 'start_date')):
+        local_date = activity.start_date.astimezone(timezone.utc).date()
+        iso = local_date.isocalendar()
+        activity.local_date = local_date
+        activity.local_year = local_date.year
+        activity.local_month = local_date.month
+        activity.iso_year = iso.year
+        activity.iso_week = iso.week
+        activity.weekday = iso.weekday
+        batch.append(activity)
+        if len(batch) >= 2000:
+            Activity.objects.bulk_update(batch, fields)
+            batch = []
+    if batch:
+        Activity.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0011_personal_records'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='iso_week',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='iso_year',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='local_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='local_month',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='local_year',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='start_date_local',
+            field=models.DateTimeField(blank=True, help_text='Wall-clock start time, labelled UTC', null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='timezone_name',
+            field=models.CharField(blank=True, help_text="Strava time zone, e.g. '(GMT-08:00) America/Los_Angeles'", max_length=64),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='utc_offset',
+            field=models.IntegerField(blank=True, help_text='Offset from UTC in seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='weekday',
+            field=models.SmallIntegerField(blank=True, help_text='ISO weekday, Monday = 1', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'local_date'], name='activities__user_id_969fb1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'local_year', 'local_month'], name='activities__user_id_a92138_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'iso_year', 'iso_week'], name='activities__user_id_4928f2_idx'),
+        ),
+        migrations.RunPython(backfill_local_dates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0012_activity_local_dates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityStream',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stream_type', models.CharField(help_text="Strava stream key, e.g. 'heartrate'", max_length=20)),
+                ('encoding', models.CharField(help_text='How data is encoded, see activities/streams.py', max_length=20)),
+                ('sample_count', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='streams_synced_at',
+            field=models.DateTimeField(blank=True, help_text="When the activity's streams were last fetched", null=True),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'streams_synced_at'], name='activities__user_id_a19feb_idx'),
+        ),
+        migrations.AddField(
+            model_name='activitystream',
+            name='activity',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='streams', to='activities.activity'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='activitystream',
+            unique_together={('activity', 'stream_type')},
+        ),
+    ]
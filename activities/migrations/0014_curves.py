@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0013_activity_streams'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='curves_ready',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='ActivityCurve',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(max_length=20)),
+                ('values', models.BinaryField()),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='curves', to='activities.activity')),
+            ],
+            options={
+                'unique_together': {('activity', 'channel')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CurveEnvelope',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activity_type', models.CharField(blank=True, max_length=50)),
+                ('channel', models.CharField(max_length=20)),
+                ('window_days', models.PositiveSmallIntegerField(default=0, help_text='0 for the whole history')),
+                ('values', models.BinaryField()),
+                ('activity_ids', models.BinaryField()),
+                ('start_times', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='curve_envelopes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'activity_type', 'channel', 'window_days')},
+            },
+        ),
+    ]
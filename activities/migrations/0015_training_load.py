@@ -0,0 +1,45 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0014_curves'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='ftp',
+            field=models.FloatField(blank=True, help_text='Functional threshold power in watts', null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='threshold_heartrate',
+            field=models.FloatField(blank=True, help_text='Lactate threshold heart rate in bpm', null=True),
+        ),
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='training_load_ready',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='DailyTrainingLoad',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(help_text='Local date of the activities')),
+                ('load', models.FloatField(default=0, help_text="Sum of the day's training stress scores")),
+                ('fitness', models.FloatField(default=0, help_text='Chronic training load (CTL) after the day')),
+                ('fatigue', models.FloatField(default=0, help_text='Acute training load (ATL) after the day')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='training_load', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'date')},
+            },
+        ),
+    ]
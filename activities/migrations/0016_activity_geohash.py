@@ -0,0 +1,56 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:06
+
+from django.db import migrations, models
+from django.db.models import Q
+
+from activities.geo import encode_geohash
+
+
+def backfill_geohashes(apps, schema_editor):
+    # Activities synced before this migration have coordinates but no
+    # geohashes; the encoding is fixed, so it is safe to share with ingest
+    Activity = apps.get_model('activities', 'Activity')
+    fields = ['start_geohash', 'end_geohash']
+    located = Activity.objects.filter(
+        Q(start_latitude__isnull=False) | Q(end_latitude__isnull=False)
+    ).only('id', 'start_latitude', 'start_longitude', 'end_latitude', 'end_longitude')
+    batch = []
+    # Read everything up front: rows are updated while they are being read
+    for activity in list(located):
+        activity.start_geohash = encode_geohash(activity.start_latitude, activity.start_longitude)
+        activity.end_geohash = encode_geohash(activity.end_latitude, activity.end_longitude)
+        batch.append(activity)
+        if len(batch) >= 2000:
+            Activity.objects.bulk_update(batch, fields)
+            batch = []
+    if batch:
+        Activity.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0015_training_load'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='end_geohash',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='start_geohash',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'start_geohash'], name='activities__user_id_85e090_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'end_geohash'], name='activities__user_id_39560d_idx'),
+        ),
+        migrations.RunPython(backfill_geohashes, migrations.RunPython.noop),
+    ]
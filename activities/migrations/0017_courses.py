@@ -0,0 +1,55 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0016_activity_geohash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='summary_polyline',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='courses_ready',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='Course',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('activity_type', models.CharField(max_length=50)),
+                ('distance', models.FloatField(help_text='Distance in meters of the first activity')),
+                ('signature', models.BinaryField(help_text='uint32 MinHash values, see courses.NUM_HASHES')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='courses', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='course',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='activities', to='activities.course'),
+        ),
+        migrations.CreateModel(
+            name='CourseBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.BigIntegerField(help_text='Hash of one band of the signature and its position')),
+                ('course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='buckets', to='activities.course')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'bucket'], name='activities__user_id_860695_idx')],
+            },
+        ),
+    ]
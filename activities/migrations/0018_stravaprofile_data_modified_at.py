@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activities', '0017_courses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravaprofile',
+            name='data_modified_at',
+            field=models.DateTimeField(blank=True, help_text='When data_generation was last bumped', null=True),
+        ),
+    ]
@@ -1,7 +1,12 @@
-from django.db import models
+from datetime import timezone as dt_timezone
+
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .geo import encode_geohash
+
 
 class StravaProfile(models.Model):
     """Store user-specific Strava API credentials"""
@@ -11,6 +16,33 @@ class StravaProfile(models.Model):
     refresh_token = models.CharField(max_length=255)
     expires_at = models.DateTimeField()
     
+    # Incremental sync cursor
+    last_activity_start = models.DateTimeField(null=True, blank=True, help_text="Latest activity start_date synced")
+    last_synced_at = models.DateTimeField(null=True, blank=True, help_text="When the last successful sync finished")
+    
+    # Whether ActivitySummary rows have been built for this user
+    summaries_ready = models.BooleanField(default=False)
+    
+    # Whether PersonalRecord rows have been built for this user
+    records_ready = models.BooleanField(default=False)
+    
+    # Whether CurveEnvelope rows have been built for this user
+    curves_ready = models.BooleanField(default=False)
+    
+    # Thresholds training stress is scored against
+    ftp = models.FloatField(null=True, blank=True, help_text="Functional threshold power in watts")
+    threshold_heartrate = models.FloatField(null=True, blank=True, help_text="Lactate threshold heart rate in bpm")
+    
+    # Whether DailyTrainingLoad rows have been built for this user
+    training_load_ready = models.BooleanField(default=False)
+    
+    # Whether activities have been matched to Course rows for this user
+    courses_ready = models.BooleanField(default=False)
+    
+    # Bumped whenever the user's activities change; part of analytics cache keys
+    data_generation = models.PositiveBigIntegerField(default=0)
+    data_modified_at = models.DateTimeField(null=True, blank=True, help_text="When data_generation was last bumped")
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -18,6 +50,56 @@ class StravaProfile(models.Model):
         return f"{self.user.username} - Strava Profile"
 
 
+def format_duration(seconds):
+    """Format a number of seconds as HH:MM:SS"""
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def local_date_fields(start_date, start_date_local=None):
+    """
+    Return the precomputed local calendar columns of an activity
+    
+    Args:
+        start_date: UTC start time
+        start_date_local: Wall-clock start time in the athlete's time zone,
+            labelled as UTC the way Strava sends it; the UTC start time is
+            used when it is missing
+    
+    Returns:
+        dict: local_date, local_year, local_month, iso_year, iso_week, weekday
+    """
+    local_date = (start_date_local or start_date).astimezone(dt_timezone.utc).date()
+    iso = local_date.isocalendar()
+    return {
+        'local_date': local_date,
+        'local_year': local_date.year,
+        'local_month': local_date.month,
+        'iso_year': iso.year,
+        'iso_week': iso.week,
+        'weekday': iso.weekday,
+    }
+
+
+class ActivityQuerySet(models.QuerySet):
+    def delete(self):
+        """
+        Delete the activities, then update each owner's derived data once
+
+        Deleting a user cascades through the base manager instead, so an
+        account's derived rows are dropped along with it without being
+        maintained first.
+        """
+        from .ingest import TRACKED_FIELDS, activities_deleted
+
+        with transaction.atomic(using=self.db):
+            rows = list(self.values('id', 'user_id', *TRACKED_FIELDS))
+            deleted = super().delete()
+            activities_deleted(rows)
+        return deleted
+
+
 class Activity(models.Model):
     ACTIVITY_TYPES = [
         ('Run', 'Run'),
@@ -41,6 +123,20 @@ class Activity(models.Model):
     activity_type = models.CharField(max_length=50, choices=ACTIVITY_TYPES, default='Other')
     start_date = models.DateTimeField()
     
+    # Local start time: Strava's start_date_local is the athlete's wall-clock
+    # time with a 'Z' suffix, so it is stored labelled as UTC
+    start_date_local = models.DateTimeField(null=True, blank=True, help_text="Wall-clock start time, labelled UTC")
+    timezone_name = models.CharField(max_length=64, blank=True, help_text="Strava time zone, e.g. '(GMT-08:00) America/Los_Angeles'")
+    utc_offset = models.IntegerField(null=True, blank=True, help_text="Offset from UTC in seconds")
+    
+    # Local calendar parts, filled in at ingest so trends group on plain columns
+    local_date = models.DateField(null=True, blank=True)
+    local_year = models.SmallIntegerField(null=True, blank=True)
+    local_month = models.SmallIntegerField(null=True, blank=True)
+    iso_year = models.SmallIntegerField(null=True, blank=True)
+    iso_week = models.SmallIntegerField(null=True, blank=True)
+    weekday = models.SmallIntegerField(null=True, blank=True, help_text="ISO weekday, Monday = 1")
+    
     # Distance and time
     distance = models.FloatField(help_text="Distance in meters")
     moving_time = models.IntegerField(help_text="Moving time in seconds")
@@ -70,10 +166,25 @@ class Activity(models.Model):
     end_latitude = models.FloatField(null=True, blank=True)
     end_longitude = models.FloatField(null=True, blank=True)
     
+    # Geohashes of the start and end points, filled in at ingest so nearby
+    # searches are prefix ranges on an index ('' without coordinates)
+    start_geohash = models.CharField(max_length=12, blank=True, default='')
+    end_geohash = models.CharField(max_length=12, blank=True, default='')
+    
+    # Encoded route from the activity list (map.summary_polyline), and the
+    # course it was matched to (see activities/courses.py)
+    summary_polyline = models.TextField(blank=True, default='')
+    course = models.ForeignKey('Course', on_delete=models.SET_NULL, null=True, blank=True, related_name='activities')
+    
+    # Detailed per-sample data (see ActivityStream); null until fetched
+    streams_synced_at = models.DateTimeField(null=True, blank=True, help_text="When the activity's streams were last fetched")
+    
     # Metadata
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = ActivityQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-start_date']
         unique_together = ['user', 'strava_id']
@@ -82,11 +193,47 @@ class Activity(models.Model):
             models.Index(fields=['activity_type']),
             models.Index(fields=['user', 'strava_id']),
             models.Index(fields=['user']),
+            # Per-user date ranges and newest-first listings
+            models.Index(fields=['user', 'start_date']),
+            # Covers the per-user facet query (type and calendar counts)
+            models.Index(fields=['user', 'activity_type', 'start_date']),
+            # Local calendar filters and trend grouping
+            models.Index(fields=['user', 'local_date']),
+            models.Index(fields=['user', 'local_year', 'local_month']),
+            models.Index(fields=['user', 'iso_year', 'iso_week']),
+            # Activities still waiting for their streams
+            models.Index(fields=['user', 'streams_synced_at']),
+            # Nearby searches and start location clusters
+            models.Index(fields=['user', 'start_geohash']),
+            models.Index(fields=['user', 'end_geohash']),
         ]
     
     def __str__(self):
         return f"{self.name} - {self.activity_type} on {self.start_date.date()}"
     
+    def save(self, *args, **kwargs):
+        # Derived columns follow their source fields on every save; bulk
+        # writes fill them in themselves (see local_date_fields and
+        # geo.encode_geohash)
+        if self.start_date is not None:
+            for field, value in local_date_fields(self.start_date, self.start_date_local).items():
+                setattr(self, field, value)
+        self.start_geohash = encode_geohash(self.start_latitude, self.start_longitude)
+        self.end_geohash = encode_geohash(self.end_latitude, self.end_longitude)
+        super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        # Derived data is maintained here and in ActivityQuerySet.delete
+        # rather than by a post_delete signal, which would run per row
+        # (including when the owner is deleted) and prevent fast deletes
+        from .ingest import TRACKED_FIELDS, activities_deleted
+        
+        row = {field: getattr(self, field) for field in ['id', 'user_id', *TRACKED_FIELDS]}
+        with transaction.atomic():
+            deleted = super().delete(*args, **kwargs)
+            activities_deleted([row])
+        return deleted
+    
     @property
     def distance_km(self):
         """Return distance in kilometers"""
@@ -100,10 +247,7 @@ class Activity(models.Model):
     @property
     def moving_time_formatted(self):
         """Return moving time in HH:MM:SS format"""
-        hours = self.moving_time // 3600
-        minutes = (self.moving_time % 3600) // 60
-        seconds = self.moving_time % 60
-        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+        return format_duration(self.moving_time)
     
     @property
     def average_pace_per_km(self):
@@ -128,7 +272,7 @@ class Activity(models.Model):
 
 
 class ActivitySummary(models.Model):
-    """Summary statistics for different time periods"""
+    """Per-user summary statistics for different time periods, kept current on ingest"""
     
     PERIOD_CHOICES = [
         ('day', 'Day'),
@@ -137,6 +281,7 @@ class ActivitySummary(models.Model):
         ('year', 'Year'),
     ]
     
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='activity_summaries')
     period_type = models.CharField(max_length=10, choices=PERIOD_CHOICES)
     period_start = models.DateField()
     period_end = models.DateField()
@@ -164,12 +309,271 @@ class ActivitySummary(models.Model):
     # Calories
     total_calories = models.IntegerField(default=0)
     
+    # Sums and counts of non-null averages, for averaging across buckets
+    speed_sum = models.FloatField(default=0, help_text="Sum of average speeds in m/s")
+    speed_count = models.IntegerField(default=0)
+    heartrate_sum = models.FloatField(default=0)
+    heartrate_count = models.IntegerField(default=0)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
-        unique_together = ['period_type', 'period_start', 'period_end']
+        unique_together = ['user', 'period_type', 'period_start']
         ordering = ['-period_start']
     
     def __str__(self):
-        return f"{self.period_type} summary: {self.period_start} to {self.period_end}"
+        return f"{self.user.username} {self.period_type} summary: {self.period_start} to {self.period_end}"
+
+
+class StravaRateLimit(models.Model):
+    """Strava API request budget shared by every worker process"""
+    
+    key = models.CharField(max_length=50, unique=True, default='default')
+    
+    # 15-minute window
+    short_limit = models.IntegerField(default=100)
+    short_usage = models.IntegerField(default=0)
+    short_window_start = models.DateTimeField(null=True, blank=True)
+    
+    # Daily window
+    long_limit = models.IntegerField(default=1000)
+    long_usage = models.IntegerField(default=0)
+    long_window_start = models.DateTimeField(null=True, blank=True)
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return (f"{self.key}: {self.short_usage}/{self.short_limit} (15 min), "
+                f"{self.long_usage}/{self.long_limit} (day)")
+
+
+class SyncJob(models.Model):
+    """Queued Strava sync for one profile, run by the run_sync_worker command"""
+    
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    ACTIVE_STATUSES = [STATUS_QUEUED, STATUS_RUNNING]
+    
+    MODE_INCREMENTAL = 'incremental'
+    MODE_FULL = 'full'
+    MODE_CHOICES = [
+        (MODE_INCREMENTAL, 'Incremental'),
+        (MODE_FULL, 'Full resync'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sync_jobs')
+    profile = models.ForeignKey(StravaProfile, on_delete=models.CASCADE, related_name='sync_jobs')
+    mode = models.CharField(max_length=20, choices=MODE_CHOICES, default=MODE_INCREMENTAL)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    
+    # Progress
+    pages_fetched = models.IntegerField(default=0)
+    activities_processed = models.IntegerField(default=0)
+    activities_new = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    
+    worker = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+        constraints = [
+            # At most one queued or running job per profile
+            models.UniqueConstraint(
+                fields=['profile'],
+                condition=Q(status__in=['queued', 'running']),
+                name='one_active_sync_job_per_profile',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} {self.mode} sync ({self.status})"
+    
+    def as_dict(self):
+        """Return the job state for the sync status endpoint"""
+        return {
+            'id': self.id,
+            'mode': self.mode,
+            'status': self.status,
+            'pages_fetched': self.pages_fetched,
+            'activities_processed': self.activities_processed,
+            'activities_new': self.activities_new,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class PersonalRecord(models.Model):
+    """A user's best activity for one record, overall or for one activity type"""
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='personal_records')
+    # Blank for records across all activity types
+    activity_type = models.CharField(max_length=50, blank=True)
+    record = models.CharField(max_length=30)
+    
+    # Cleared when the record-holding activity is deleted, which marks the
+    # record for recomputation
+    activity = models.ForeignKey(Activity, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    value = models.FloatField(help_text="Distance (m), time (s), speed (m/s) or elevation (m)")
+    start_date = models.DateTimeField()
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ['user', 'activity_type', 'record']
+    
+    def __str__(self):
+        return f"{self.user.username} {self.activity_type or 'all'} {self.record}: {self.value}"
+
+
+class ActivityStream(models.Model):
+    """
+    One channel of an activity's per-sample data, such as heart rate
+    
+    All samples of the channel are stored as a single compressed binary
+    array rather than one row per sample; activities/streams.py encodes and
+    decodes them.
+    """
+    
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE, related_name='streams')
+    stream_type = models.CharField(max_length=20, help_text="Strava stream key, e.g. 'heartrate'")
+    encoding = models.CharField(max_length=20, help_text="How data is encoded, see activities/streams.py")
+    sample_count = models.IntegerField()
+    data = models.BinaryField()
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ['activity', 'stream_type']
+    
+    def __str__(self):
+        return f"{self.activity_id} {self.stream_type} ({self.sample_count} samples)"
+
+
+class ActivityCurve(models.Model):
+    """
+    Mean-maximal curve of one channel of an activity
+    
+    values holds the best average (power, speed or heart rate) over each of
+    curves.DURATIONS as a float32 array, NaN for durations longer than the
+    activity.
+    """
+    
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE, related_name='curves')
+    channel = models.CharField(max_length=20)
+    values = models.BinaryField()
+    
+    class Meta:
+        unique_together = ['activity', 'channel']
+    
+    def __str__(self):
+        return f"{self.activity_id} {self.channel} curve"
+
+
+class CurveEnvelope(models.Model):
+    """
+    A user's best mean-maximal values per duration, with the activity holding each
+    
+    Kept for all activity types together (blank activity_type) and for each
+    type, over the whole history (window_days = 0) or a rolling window.
+    """
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='curve_envelopes')
+    activity_type = models.CharField(max_length=50, blank=True)
+    channel = models.CharField(max_length=20)
+    window_days = models.PositiveSmallIntegerField(default=0, help_text="0 for the whole history")
+    
+    # Parallel arrays over curves.DURATIONS: float32 values, int64 activity
+    # ids (0 for none) and int64 activity start times (Unix seconds)
+    values = models.BinaryField()
+    activity_ids = models.BinaryField()
+    start_times = models.BinaryField()
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ['user', 'activity_type', 'channel', 'window_days']
+    
+    def __str__(self):
+        return f"{self.user.username} {self.activity_type or 'all'} {self.channel} ({self.window_days or 'all'} days)"
+
+
+class DailyTrainingLoad(models.Model):
+    """
+    Training stress of one day with activities, and the load averages after it
+    
+    Only days with scored activities are stored; between them fitness and
+    fatigue decay by a fixed factor per day, see activities/training_load.py.
+    """
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='training_load')
+    date = models.DateField(help_text="Local date of the activities")
+    load = models.FloatField(default=0, help_text="Sum of the day's training stress scores")
+    fitness = models.FloatField(default=0, help_text="Chronic training load (CTL) after the day")
+    fatigue = models.FloatField(default=0, help_text="Acute training load (ATL) after the day")
+    
+    class Meta:
+        unique_together = ['user', 'date']
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.date}: {self.load:.0f}"
+
+
+class Course(models.Model):
+    """
+    A route a user has done more than once, or may yet repeat
+    
+    Activities are matched to a course by comparing MinHash signatures of
+    the map cells their routes pass through; the signature stored here is
+    that of the activity the course was first seen in. If that activity is
+    re-routed or deleted the course is matched again from the rest.
+    """
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='courses')
+    name = models.CharField(max_length=200)
+    activity_type = models.CharField(max_length=50)
+    distance = models.FloatField(help_text="Distance in meters of the first activity")
+    signature = models.BinaryField(help_text="uint32 MinHash values, see courses.NUM_HASHES")
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.name} ({self.activity_type})"
+
+
+class CourseBucket(models.Model):
+    """
+    Locality-sensitive hash index over course signatures
+    
+    One row per band of a course's signature; routes that share any bucket
+    with a course are the only candidates compared against it.
+    """
+    
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='buckets')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    bucket = models.BigIntegerField(help_text="Hash of one band of the signature and its position")
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'bucket']),
+        ]
+    
+    def __str__(self):
+        return f"{self.course_id}: {self.bucket}"
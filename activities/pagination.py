@@ -0,0 +1,65 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """A pagination cursor that could not be decoded"""
+
+
+def encode_cursor(start_date, pk):
+    """Encode the (start_date, id) position of the last row on a page"""
+    raw = f'{start_date.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor
+
+    Raises:
+        InvalidCursor: The cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        start_date, pk = base64.urlsafe_b64decode(padded.encode()).decode().rsplit('|', 1)
+        return datetime.fromisoformat(start_date), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def keyset_page(queryset, cursor=None, limit=50):
+    """
+    Return one page of activities, newest first, after a cursor
+
+    Rows are ordered by (start_date, id) descending and the next page starts
+    strictly after the last row returned, so each page is an index range scan
+    however deep into the history it is, and rows synced between requests
+    do not shift later pages.
+
+    Args:
+        queryset: Activities (or their .values()) to paginate
+        cursor: Cursor returned with the previous page, or None for the first
+        limit: Maximum number of rows on the page
+
+    Returns:
+        tuple: (list of rows, cursor for the next page or None)
+    """
+    queryset = queryset.order_by('-start_date', '-id')
+    if cursor:
+        start_date, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(start_date__lt=start_date) | Q(start_date=start_date, id__lt=pk)
+        )
+
+    rows = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if isinstance(last, dict):
+            next_cursor = encode_cursor(last['start_date'], last['id'])
+        else:
+            next_cursor = encode_cursor(last.start_date, last.id)
+    return rows, next_cursor
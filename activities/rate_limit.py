@@ -0,0 +1,139 @@
+import time
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import StravaRateLimit
+
+
+class RateLimitExceeded(Exception):
+    """Raised when the Strava budget will not free up within the allowed wait"""
+
+
+class RateLimitGovernor:
+    """
+    Token bucket over Strava's 15-minute and daily request windows
+
+    The bucket lives in a StravaRateLimit row so that every gunicorn worker,
+    management command and sync thread draws from the same budget. Taking a
+    token is a single conditional UPDATE, which is atomic on both SQLite and
+    Postgres without explicit row locks. The X-RateLimit-Limit/Usage headers of
+    each response then overwrite the local estimate with Strava's own count.
+
+    Strava resets the short window on the quarter hour and the daily window at
+    midnight UTC, so the windows here are aligned the same way.
+    """
+
+    SHORT_WINDOW = timedelta(minutes=15)
+    LONG_WINDOW = timedelta(days=1)
+
+    def __init__(self, key='default', max_wait=SHORT_WINDOW.total_seconds() + 60):
+        """
+        Args:
+            key: Name of the shared budget row
+            max_wait: Longest time in seconds acquire() may block before giving up
+        """
+        self.key = key
+        self.max_wait = max_wait
+
+    @classmethod
+    def _window_starts(cls, now):
+        """Return the start of the current 15-minute and daily windows"""
+        day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        short_start = now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0)
+        return short_start, day_start
+
+    def _budget(self):
+        """Return the budget queryset, rolling expired windows over"""
+        now = timezone.now()
+        short_start, day_start = self._window_starts(now)
+
+        StravaRateLimit.objects.get_or_create(key=self.key)
+        budget = StravaRateLimit.objects.filter(key=self.key)
+
+        budget.exclude(short_window_start__gte=short_start).update(
+            short_usage=0, short_window_start=short_start
+        )
+        budget.exclude(long_window_start__gte=day_start).update(
+            long_usage=0, long_window_start=day_start
+        )
+        return budget
+
+    def try_acquire(self):
+        """Take one request from the budget without waiting"""
+        taken = self._budget().filter(
+            short_usage__lt=F('short_limit'),
+            long_usage__lt=F('long_limit'),
+        ).update(
+            short_usage=F('short_usage') + 1,
+            long_usage=F('long_usage') + 1,
+        )
+        return taken == 1
+
+    def seconds_until_available(self):
+        """Return how long until the exhausted window(s) reset"""
+        state = self._budget().get()
+        now = timezone.now()
+        short_start, day_start = self._window_starts(now)
+
+        if state.long_usage >= state.long_limit:
+            return (day_start + self.LONG_WINDOW - now).total_seconds()
+        if state.short_usage >= state.short_limit:
+            return (short_start + self.SHORT_WINDOW - now).total_seconds()
+        return 0
+
+    def acquire(self):
+        """
+        Take one request from the budget, waiting for a window reset if needed
+
+        Raises:
+            RateLimitExceeded: if the budget cannot free up within max_wait
+        """
+        waited = 0
+        while not self.try_acquire():
+            delay = self.seconds_until_available()
+            if waited + delay > self.max_wait:
+                raise RateLimitExceeded(
+                    f"Strava rate limit exhausted, next request possible in {int(delay)}s"
+                )
+            # Wake up just after the reset; the budget may have been refilled elsewhere
+            delay = max(delay, 1)
+            print(f"Strava rate limit reached, waiting {int(delay)}s...")
+            time.sleep(delay)
+            waited += delay
+
+    def record(self, headers):
+        """
+        Update the budget from the X-RateLimit headers of a Strava response
+
+        Both headers hold a "<15 minute>,<daily>" pair; responses without them
+        leave the local estimate untouched.
+        """
+        limits = self._parse_pair(headers.get('X-RateLimit-Limit'))
+        usage = self._parse_pair(headers.get('X-RateLimit-Usage'))
+        if not limits or not usage:
+            return
+
+        self._budget().update(
+            short_limit=limits[0],
+            long_limit=limits[1],
+            short_usage=usage[0],
+            long_usage=usage[1],
+        )
+
+    def exhaust(self):
+        """Mark the short window as used up after Strava answered 429"""
+        self._budget().update(short_usage=F('short_limit'))
+
+    @staticmethod
+    def _parse_pair(value):
+        try:
+            short, long = (int(part) for part in value.split(','))
+        except (AttributeError, ValueError):
+            return None
+        return short, long
+
+
+# Process-wide governor used by StravaService
+governor = RateLimitGovernor()
@@ -0,0 +1,219 @@
+from django.db import transaction
+from django.db.models import ExpressionWrapper, F, FloatField
+
+from .models import Activity, PersonalRecord, StravaProfile
+
+
+# Records kept for every activity type and across all types:
+# name -> (activity field, higher is better)
+RECORDS = {
+    'longest_distance': ('distance', True),
+    'longest_time': ('moving_time', True),
+    'fastest_speed': ('average_speed', True),
+    'most_elevation': ('total_elevation_gain', True),
+}
+
+# Standard distance bests, in meters. Without per-second streams the time
+# for a distance is estimated from the average pace of an activity at
+# least that long.
+DISTANCE_BESTS = {
+    'best_5k': 5000,
+    'best_10k': 10000,
+    'best_half_marathon': 21097.5,
+    'best_marathon': 42195,
+}
+
+# Activity types the distance bests are kept for
+DISTANCE_BEST_TYPES = ('Run',)
+
+# Activity fields records are computed from (rows also carry the id)
+SOURCE_FIELDS = [
+    'activity_type', 'start_date', 'distance', 'moving_time',
+    'average_speed', 'total_elevation_gain',
+]
+
+# Scope of the records across all activity types
+ALL_TYPES = ''
+
+
+def _candidates(row):
+    """Yield (scope, record, value, higher is better) for one activity"""
+    activity_type = row['activity_type']
+    for record, (field, higher) in RECORDS.items():
+        value = row[field]
+        if value is None:
+            continue
+        yield ALL_TYPES, record, value, higher
+        yield activity_type, record, value, higher
+
+    if activity_type in DISTANCE_BEST_TYPES and row['distance'] and row['moving_time']:
+        for record, meters in DISTANCE_BESTS.items():
+            if row['distance'] >= meters:
+                yield activity_type, record, row['moving_time'] * meters / row['distance'], False
+
+
+def _beats(candidate, higher, current):
+    """
+    Whether a candidate holder takes a record from the current one
+
+    Both are (value, activity id, start_date). A better value wins; on equal
+    values the earlier activity (by start date, then id) holds the record, so
+    the holder does not depend on the order activities were seen in.
+    """
+    if current is None:
+        return True
+    value, activity_id, start_date = candidate
+    current_value, current_id, current_start = current
+    if value != current_value:
+        return value > current_value if higher else value < current_value
+    return (start_date, activity_id) < (current_start, current_id)
+
+
+def _higher_is_better(name):
+    return RECORDS[name][1] if name in RECORDS else False
+
+
+def compute(rows):
+    """
+    Find every record in one pass over activity rows
+
+    Args:
+        rows: Field dicts (id and SOURCE_FIELDS) of activities
+
+    Returns:
+        dict: (scope, record) -> (value, activity id, start_date). Ties go to
+            the earlier activity, then the lower id.
+    """
+    best = {}
+    for row in rows:
+        for scope, record, value, higher in _candidates(row):
+            key = (scope, record)
+            candidate = (value, row['id'], row['start_date'])
+            if _beats(candidate, higher, best.get(key)):
+                best[key] = candidate
+    return best
+
+
+def apply_changes(user, removed=(), added=()):
+    """
+    Update a user's stored records for changed activities
+
+    New and updated activities are compared against the stored records and
+    only the records they beat are written. A record whose activity was
+    changed or deleted may no longer be the best, so just that record is
+    looked up again with one ordered query (see best_activity) instead of
+    recomputing every record from the whole history.
+
+    Must be called after the activity changes are written.
+
+    Args:
+        user: Owner of the activities
+        removed: Field dicts of activities as they were before an update or
+            delete (with their id)
+        added: Field dicts of activities as they are after a create or update
+    """
+    with transaction.atomic():
+        existing = {
+            (record.activity_type, record.record): record
+            for record in PersonalRecord.objects.select_for_update().filter(user=user)
+        }
+
+        to_create, to_update, to_delete = [], {}, []
+
+        removed_ids = {row['id'] for row in removed if row.get('id') is not None}
+        for key, record in list(existing.items()):
+            if record.activity_id is not None and record.activity_id not in removed_ids:
+                continue
+            # The holder was changed or deleted: look the record up again
+            best = best_activity(user, *key)
+            if best is None:
+                to_delete.append(existing.pop(key).id)
+                continue
+            record.value, record.activity_id, record.start_date = best
+            to_update[key] = record
+
+        for (scope, name), (value, activity_id, start_date) in compute(added).items():
+            record = existing.get((scope, name))
+            if record is None:
+                record = PersonalRecord(user=user, activity_type=scope, record=name)
+                to_create.append(record)
+            elif _beats((value, activity_id, start_date), _higher_is_better(name),
+                        (record.value, record.activity_id, record.start_date)):
+                to_update[scope, name] = record
+            else:
+                continue
+            record.value = value
+            record.activity_id = activity_id
+            record.start_date = start_date
+
+        if to_delete:
+            PersonalRecord.objects.filter(id__in=to_delete).delete()
+        if to_create:
+            PersonalRecord.objects.bulk_create(to_create)
+        if to_update:
+            PersonalRecord.objects.bulk_update(list(to_update.values()), ['value', 'activity', 'start_date'])
+
+
+def best_activity(user, scope, name):
+    """
+    Find the current holder of one record with a single ordered query
+
+    Args:
+        user: Owner of the activities
+        scope: Activity type, or ALL_TYPES
+        name: Key of RECORDS or DISTANCE_BESTS
+
+    Returns:
+        tuple: (value, activity id, start_date), or None if no activity qualifies
+    """
+    activities = Activity.objects.filter(user=user)
+    if scope != ALL_TYPES:
+        activities = activities.filter(activity_type=scope)
+
+    if name in RECORDS:
+        field, higher = RECORDS[name]
+        return activities.filter(**{f'{field}__isnull': False}).order_by(
+            f'-{field}' if higher else field, 'start_date', 'id'
+        ).values_list(field, 'id', 'start_date').first()
+
+    # Time for the distance at the activity's average pace; the best is the lowest pace
+    meters = DISTANCE_BESTS[name]
+    best = activities.filter(distance__gte=meters, moving_time__gt=0).annotate(
+        pace=ExpressionWrapper(F('moving_time') / F('distance'), output_field=FloatField())
+    ).order_by('pace', 'start_date', 'id').values_list('moving_time', 'distance', 'id', 'start_date').first()
+    if best is None:
+        return None
+    moving_time, distance, activity_id, start_date = best
+    return moving_time * meters / distance, activity_id, start_date
+
+
+def rebuild(user):
+    """Recompute all of a user's records from their activities"""
+    with transaction.atomic():
+        rows = Activity.objects.filter(user=user).order_by().values('id', *SOURCE_FIELDS).iterator(chunk_size=2000)
+        best = compute(rows)
+        PersonalRecord.objects.filter(user=user).delete()
+        PersonalRecord.objects.bulk_create([
+            PersonalRecord(
+                user=user, activity_type=scope, record=name,
+                value=value, activity_id=activity_id, start_date=start_date,
+            )
+            for (scope, name), (value, activity_id, start_date) in best.items()
+        ])
+        StravaProfile.objects.filter(user=user).update(records_ready=True)
+
+
+def ensure_ready(user):
+    """
+    Make sure a user's stored records are populated before they are read
+
+    Returns:
+        bool: True if the stored records can be used for this user
+    """
+    ready = StravaProfile.objects.filter(user=user).values_list('records_ready', flat=True).first()
+    if ready is None:
+        # Users without a Strava profile have no synced data to keep records for
+        return False
+    if not ready:
+        rebuild(user)
+    return True
@@ -0,0 +1,173 @@
+import datetime
+import decimal
+import json
+import math
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:  # Optional: the stdlib encoder is used without it
+    orjson = None
+
+
+ROWS = 'rows'
+COLUMNS = 'columns'
+FORMATS = (ROWS, COLUMNS)
+
+
+def _default(obj):
+    """Encode the NumPy, pandas and Django types the JSON backends don't know"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is pd.NaT or obj is pd.NA:
+        return None
+    if isinstance(obj, (pd.Timestamp, datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, pd.Period):
+        return str(obj)
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return obj.to_numpy().tolist()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _finite(obj):
+    """Replace NaN and infinite floats with None, through dicts, lists and tuples"""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(value) for value in obj]
+    return obj
+
+
+class AnalyticsJSONEncoder(json.JSONEncoder):
+    """Stdlib encoder that understands NumPy and pandas values"""
+
+    def default(self, obj):
+        return _finite(_default(obj))
+
+
+def encode_json(data):
+    """
+    Encode with the standard library, without whitespace
+
+    Non-finite floats become null, as orjson writes them, instead of the
+    NaN/Infinity tokens the stdlib emits by default, which are not JSON.
+    """
+    return json.dumps(_finite(data), cls=AnalyticsJSONEncoder, separators=(',', ':'), allow_nan=False).encode()
+
+
+def encode_orjson(data):
+    """Encode with orjson, which serializes NumPy arrays without copying them to lists"""
+    return orjson.dumps(data, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+BACKENDS = {
+    'json': encode_json,
+    'orjson': encode_orjson,
+}
+
+
+def get_encoder(name=None):
+    """
+    Return the function API responses are encoded with
+
+    Args:
+        name: 'json', 'orjson', a dotted path to a function taking the data
+            and returning bytes, or 'auto' (orjson when installed); defaults
+            to the API_JSON_BACKEND setting
+
+    Raises:
+        ImportError: The backend cannot be loaded
+    """
+    name = name or getattr(settings, 'API_JSON_BACKEND', 'auto')
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson' and orjson is None:
+        raise ImportError("API_JSON_BACKEND is 'orjson' but orjson is not installed")
+    if name in BACKENDS:
+        return BACKENDS[name]
+    return import_string(name)
+
+
+def encode(data, backend=None):
+    """Encode an API payload to JSON bytes"""
+    return get_encoder(backend)(data)
+
+
+def parse_format(value):
+    """
+    Validate a ?format= query parameter
+
+    Returns:
+        str: 'rows' (a list of objects, the default) or 'columns'
+
+    Raises:
+        ValueError: The value is not a known format
+    """
+    if not value:
+        return ROWS
+    if value not in FORMATS:
+        raise ValueError(f"Invalid format: {value!r} (expected one of {', '.join(FORMATS)})")
+    return value
+
+
+def to_columns(rows, fields=None):
+    """
+    Turn row objects into one array per field
+
+    Args:
+        rows: List of dicts or a DataFrame
+        fields: Fields to include; defaults to the keys of the first row
+
+    Returns:
+        dict: field -> list (or NumPy array, for a DataFrame) of values
+    """
+    if isinstance(rows, pd.DataFrame):
+        return {field: rows[field].to_numpy() for field in (fields or rows.columns)}
+    if fields is None:
+        fields = list(rows[0]) if rows else []
+    return {field: [row.get(field) for row in rows] for field in fields}
+
+
+def to_rows(columns):
+    """
+    Turn one array per field into row objects; the inverse of to_columns
+
+    Args:
+        columns: field -> list or NumPy array of values, all the same length
+
+    Returns:
+        list: One dict per row
+    """
+    fields = list(columns)
+    values = [column.tolist() if isinstance(column, np.ndarray) else column for column in columns.values()]
+    return [dict(zip(fields, row)) for row in zip(*values)]
+
+
+def shape(rows, payload_format):
+    """Rows as given, or as columns when payload_format is 'columns'"""
+    return to_columns(rows) if payload_format == COLUMNS else rows
+
+
+class ApiResponse(HttpResponse):
+    """
+    JSON response encoded with the configured API backend
+
+    Unlike JsonResponse any JSON value is accepted, and NumPy and pandas
+    values are encoded as plain numbers, strings and lists.
+    """
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=encode(data), **kwargs)
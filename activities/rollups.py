@@ -0,0 +1,189 @@
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Activity, ActivitySummary, StravaProfile
+
+
+PERIOD_TYPES = ('day', 'week', 'month', 'year')
+
+# Activity fields a summary bucket is derived from
+SOURCE_FIELDS = [
+    'activity_type', 'start_date', 'local_date', 'distance', 'moving_time', 'elapsed_time',
+    'total_elevation_gain', 'calories', 'average_speed', 'average_heartrate',
+]
+
+# Summary fields that are running totals
+TOTAL_FIELDS = [
+    'total_activities', 'run_count', 'ride_count', 'swim_count', 'other_count',
+    'total_distance', 'run_distance', 'ride_distance', 'swim_distance',
+    'total_moving_time', 'total_elapsed_time', 'total_elevation_gain',
+    'total_calories', 'speed_sum', 'speed_count', 'heartrate_sum',
+    'heartrate_count',
+]
+
+INTEGER_FIELDS = {
+    field.name for field in ActivitySummary._meta.get_fields()
+    if field.name in TOTAL_FIELDS and field.get_internal_type() == 'IntegerField'
+}
+
+# Which per-sport columns an activity type counts towards
+TYPE_COLUMNS = {
+    'Run': 'run',
+    'Ride': 'ride',
+    'EBikeRide': 'ride',
+    'Swim': 'swim',
+}
+
+
+def period_bounds(period_type, day):
+    """Return the (start, end) dates of the period containing a day"""
+    if period_type == 'day':
+        return day, day
+    if period_type == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6)
+    if period_type == 'month':
+        start = day.replace(day=1)
+        next_month = (start + timedelta(days=32)).replace(day=1)
+        return start, next_month - timedelta(days=1)
+    if period_type == 'year':
+        return date(day.year, 1, 1), date(day.year, 12, 31)
+    raise ValueError(f"Unknown period type: {period_type}")
+
+
+def _bucket_day(row):
+    """Return the date an activity is bucketed under (its local start date)"""
+    if row.get('local_date') is not None:
+        return row['local_date']
+    return row['start_date'].date()
+
+
+def _contribution(row):
+    """Return how much one activity adds to each total of its buckets"""
+    sport = TYPE_COLUMNS.get(row['activity_type'], 'other')
+    distance = row['distance'] or 0
+    values = {
+        'total_activities': 1,
+        f'{sport}_count': 1,
+        'total_distance': distance,
+        'total_moving_time': row['moving_time'] or 0,
+        'total_elapsed_time': row['elapsed_time'] or 0,
+        'total_elevation_gain': row['total_elevation_gain'] or 0,
+        'total_calories': row['calories'] or 0,
+    }
+    if sport != 'other':
+        values[f'{sport}_distance'] = distance
+    if row['average_speed'] is not None:
+        values['speed_sum'] = row['average_speed']
+        values['speed_count'] = 1
+    if row['average_heartrate'] is not None:
+        values['heartrate_sum'] = row['average_heartrate']
+        values['heartrate_count'] = 1
+    return values
+
+
+def _deltas(removed, added):
+    """Sum the signed contributions of activity rows per bucket"""
+    deltas = defaultdict(lambda: defaultdict(float))
+    for sign, rows in ((-1, removed), (1, added)):
+        for row in rows:
+            day = _bucket_day(row)
+            contribution = _contribution(row)
+            for period_type in PERIOD_TYPES:
+                key = (period_type,) + period_bounds(period_type, day)
+                for field, value in contribution.items():
+                    deltas[key][field] += sign * value
+    return deltas
+
+
+def apply_changes(user, removed=(), added=()):
+    """
+    Update a user's summary buckets for changed activities
+
+    Only the buckets the given activities fall into are read and written:
+    one SELECT for the touched buckets, then one bulk insert/update/delete.
+
+    Args:
+        user: Owner of the activities
+        removed: Field dicts (SOURCE_FIELDS) of activities as they were before
+            an update or delete
+        added: Field dicts of activities as they are after a create or update
+    """
+    deltas = _deltas(removed, added)
+    if not deltas:
+        return
+
+    with transaction.atomic():
+        starts = {period_start for _, period_start, _ in deltas}
+        existing = {
+            (summary.period_type, summary.period_start, summary.period_end): summary
+            for summary in ActivitySummary.objects.select_for_update().filter(
+                user=user, period_start__in=starts
+            )
+        }
+        _write(user, deltas, existing)
+
+
+def _write(user, deltas, existing):
+    """Apply bucket deltas on top of the existing summary rows"""
+    now = timezone.now()
+    to_create, to_update, to_delete = [], [], []
+
+    for key, delta in deltas.items():
+        summary = existing.get(key)
+        if summary is None:
+            if delta.get('total_activities', 0) <= 0:
+                # Removing from a bucket that was never built; nothing to do
+                continue
+            period_type, period_start, period_end = key
+            summary = ActivitySummary(
+                user=user, period_type=period_type,
+                period_start=period_start, period_end=period_end,
+            )
+            to_create.append(summary)
+        elif summary.total_activities + delta.get('total_activities', 0) <= 0:
+            to_delete.append(summary.id)
+            continue
+        else:
+            summary.updated_at = now
+            to_update.append(summary)
+
+        for field, value in delta.items():
+            updated = getattr(summary, field) + value
+            setattr(summary, field, int(round(updated)) if field in INTEGER_FIELDS else updated)
+
+    if to_delete:
+        ActivitySummary.objects.filter(id__in=to_delete).delete()
+    if to_create:
+        ActivitySummary.objects.bulk_create(to_create, batch_size=500)
+    if to_update:
+        ActivitySummary.objects.bulk_update(to_update, TOTAL_FIELDS + ['updated_at'], batch_size=500)
+
+
+def rebuild(user):
+    """Recompute all of a user's summary buckets from their activities"""
+    with transaction.atomic():
+        rows = Activity.objects.filter(user=user).values(*SOURCE_FIELDS).iterator(chunk_size=2000)
+        deltas = _deltas((), rows)
+        ActivitySummary.objects.filter(user=user).delete()
+        _write(user, deltas, {})
+        StravaProfile.objects.filter(user=user).update(summaries_ready=True)
+
+
+def ensure_ready(user):
+    """
+    Make sure a user's summaries are populated before they are read
+
+    Returns:
+        bool: True if the summaries can be used for this user
+    """
+    ready = StravaProfile.objects.filter(user=user).values_list('summaries_ready', flat=True).first()
+    if ready is None:
+        # Users without a Strava profile have no synced data to summarise
+        return False
+    if not ready:
+        rebuild(user)
+    return True
@@ -1,9 +1,17 @@
 import requests
-import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max
 from django.utils import timezone
-from .models import Activity, StravaProfile
+from . import curves
+from .analytics_cache import bump_generation
+from .geo import encode_geohash
+from .http_client import get_session
+from .ingest import TRACKED_FIELDS, activities_changed
+from .models import Activity, StravaProfile, local_date_fields
+from .rate_limit import governor
+from .streams import STREAM_TYPES, save_streams
 
 
 class StravaService:
@@ -11,8 +19,20 @@ class StravaService:
     
     BASE_URL = "https://www.strava.com/api/v3"
     
-    def __init__(self, strava_profile=None):
+    # Refresh tokens this long before they expire rather than waiting for a 401
+    TOKEN_REFRESH_MARGIN = timedelta(minutes=10)
+    
+    def __init__(self, strava_profile=None, progress_callback=None):
+        """
+        Args:
+            strava_profile: Profile whose tokens and activities are used
+                (None falls back to the .env tokens)
+            progress_callback: Optional callable invoked after every saved page
+                as progress_callback(page, total_processed, total_new)
+        """
         self.strava_profile = strava_profile
+        self.progress_callback = progress_callback
+        self.last_error = None
         if strava_profile:
             self.client_id = settings.STRAVA_CLIENT_ID
             self.client_secret = settings.STRAVA_CLIENT_SECRET
@@ -34,17 +54,22 @@ class StravaService:
         url = f"{self.BASE_URL}{endpoint}"
         
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = self._get(url, headers, params)
             
             if response.status_code == 401:
                 # Token expired, try to refresh
                 if self.refresh_access_token():
                     # Retry with new token
                     headers['Authorization'] = f'Bearer {self.access_token}'
-                    response = requests.get(url, headers=headers, params=params)
+                    response = self._get(url, headers, params)
                 else:
                     raise Exception("Failed to refresh access token")
             
+            if response.status_code == 429:
+                # Budget used up elsewhere (e.g. another app on the same client id)
+                governor.exhaust()
+                response = self._get(url, headers, params)
+            
             response.raise_for_status()
             return response.json()
             
@@ -52,6 +77,13 @@ class StravaService:
             print(f"Error making request to {url}: {e}")
             raise
     
+    def _get(self, url, headers, params):
+        """Issue a GET once the shared rate-limit budget allows it"""
+        governor.acquire()
+        response = get_session().get(url, headers=headers, params=params)
+        governor.record(response.headers)
+        return response
+    
     def refresh_access_token(self):
         """Refresh the access token using refresh token"""
         url = "https://www.strava.com/oauth/token"
@@ -64,17 +96,30 @@ class StravaService:
         }
         
         try:
-            response = requests.post(url, data=data)
+            response = get_session().post(url, data=data)
             response.raise_for_status()
             
             token_data = response.json()
             self.access_token = token_data['access_token']
             self.refresh_token = token_data['refresh_token']
             
-            # You should update your .env file with new tokens
-            print("Access token refreshed successfully")
-            print(f"New access token: {self.access_token}")
-            print(f"New refresh token: {self.refresh_token}")
+            if self.strava_profile:
+                # Persist the rotated tokens so the next sync starts from them
+                self.strava_profile.access_token = self.access_token
+                self.strava_profile.refresh_token = self.refresh_token
+                if 'expires_at' in token_data:
+                    self.strava_profile.expires_at = datetime.fromtimestamp(
+                        token_data['expires_at'], tz=dt_timezone.utc
+                    )
+                self.strava_profile.save(
+                    update_fields=['access_token', 'refresh_token', 'expires_at', 'updated_at']
+                )
+                print(f"Access token refreshed for {self.strava_profile.user.username}")
+            else:
+                # You should update your .env file with new tokens
+                print("Access token refreshed successfully")
+                print(f"New access token: {self.access_token}")
+                print(f"New refresh token: {self.refresh_token}")
             
             return True
             
@@ -82,6 +127,19 @@ class StravaService:
             print(f"Error refreshing access token: {e}")
             return False
     
+    def ensure_fresh_token(self, margin=TOKEN_REFRESH_MARGIN):
+        """
+        Refresh the profile's access token ahead of time if it expires soon
+        
+        Returns:
+            bool: False only if a needed refresh failed
+        """
+        if not self.strava_profile:
+            return True
+        if self.strava_profile.expires_at > timezone.now() + margin:
+            return True
+        return self.refresh_access_token()
+    
     def get_athlete_info(self):
         """Get current athlete information"""
         return self._make_request("/athlete")
@@ -112,6 +170,109 @@ class StravaService:
         """Get detailed information for a specific activity"""
         return self._make_request(f"/activities/{activity_id}")
     
+    def get_activity_streams(self, activity_id, keys=None):
+        """
+        Get the per-sample streams of an activity
+        
+        Args:
+            activity_id: Strava id of the activity
+            keys: Stream types to fetch (default: STREAM_TYPES)
+        
+        Returns:
+            dict: stream type -> {'data': [...], 'series_type', 'original_size', 'resolution'}
+        """
+        params = {
+            'keys': ','.join(keys or STREAM_TYPES),
+            'key_by_type': 'true',
+        }
+        return self._make_request(f"/activities/{activity_id}/streams", params)
+    
+    def sync_streams(self, limit=None):
+        """
+        Fetch and store streams for activities that have none yet, newest first
+        
+        Each activity's mean-maximal curves are computed from its streams as
+        they are stored and merged into the user's curve envelopes, and
+        rolling windows that have aged out are rebuilt at the end. Every
+        activity costs one request from the shared rate-limit budget, so a
+        long history is filled in over several runs; the activities done so
+        far are kept when the budget or a request fails.
+        
+        Args:
+            limit: Maximum number of activities to fetch streams for (None for all)
+        
+        Returns:
+            int: Number of activities whose streams were fetched
+        """
+        pending = Activity.objects.filter(streams_synced_at__isnull=True)
+        if self.strava_profile:
+            pending = pending.filter(user=self.strava_profile.user)
+        else:
+            pending = pending.filter(user__isnull=True)
+        pending = pending.order_by('-start_date').values_list('id', 'strava_id')
+        if limit:
+            pending = pending[:limit]
+        
+        fetched = 0
+        self.last_error = None
+        for activity_id, strava_id in list(pending):
+            try:
+                payload = self.get_activity_streams(strava_id)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    print(f"Error fetching streams: {e}")
+                    self.last_error = e
+                    break
+                # Manual activities have no streams
+                payload = {}
+            except Exception as e:
+                print(f"Error fetching streams: {e}")
+                self.last_error = e
+                break
+            
+            save_streams(activity_id, payload)
+            curves.add_activity(activity_id)
+            fetched += 1
+        
+        if fetched and self.strava_profile:
+            curves.expire_windows(self.strava_profile.user)
+            bump_generation(self.strava_profile.user)
+        
+        print(f"Stream sync complete! Activities fetched: {fetched}")
+        return fetched
+    
+    def sync_activities(self, full=False, limit=None, workers=1, queue_depth=8):
+        """
+        Sync activities, fetching only what is new since the last sync
+        
+        Falls back to a full history sync when the profile has no cursor yet
+        or when a full resync is requested explicitly. Only a full resync picks
+        up edits made on Strava to older activities.
+        
+        Args:
+            full: Re-fetch the entire history instead of syncing incrementally
+            limit: Maximum number of activities to sync (None for all)
+            workers: Number of pages fetched concurrently during a full sync
+            queue_depth: Maximum number of fetched pages waiting to be saved
+        """
+        cursor = self.strava_profile.last_activity_start if self.strava_profile else None
+        
+        if full or cursor is None:
+            if workers > 1:
+                return self.backfill_activities(workers=workers, queue_depth=queue_depth, limit=limit)
+            return self.sync_all_activities(limit=limit)
+        
+        print(f"Starting incremental sync from {cursor.isoformat()}...")
+        
+        # Strava's after= is exclusive, so step back a second to re-check the cursor activity
+        after_timestamp = int(cursor.timestamp()) - 1
+        total_synced, total_new, completed = self._sync_pages(after=after_timestamp, limit=limit)
+        if completed:
+            self._mark_synced()
+        
+        print(f"Incremental sync complete! Total processed: {total_synced}, New activities: {total_new}")
+        return total_synced, total_new
+    
     def sync_all_activities(self, limit=None):
         """
         Sync all activities from Strava to local database
@@ -121,31 +282,76 @@ class StravaService:
         """
         print("Starting activity sync...")
         
+        total_synced, total_new, completed = self._sync_pages(limit=limit)
+        if completed and not limit:
+            self._mark_synced()
+        
+        print(f"Sync complete! Total processed: {total_synced}, New activities: {total_new}")
+        return total_synced, total_new
+    
+    def backfill_activities(self, workers=4, queue_depth=8, limit=None, after=None):
+        """
+        Sync the full history, fetching several pages concurrently
+        
+        Args:
+            workers: Number of pages fetched concurrently
+            queue_depth: Maximum number of fetched pages waiting to be saved
+            limit: Maximum number of activities to sync (None for all)
+            after: Unix timestamp to only fetch activities after this date
+        """
+        from .backfill import ConcurrentBackfill
+        
+        print(f"Starting concurrent activity backfill ({workers} workers)...")
+        
+        backfill = ConcurrentBackfill(
+            self, workers=workers, queue_depth=queue_depth, after=after, limit=limit
+        )
+        total_synced, total_new = backfill.run()
+        self.last_error = backfill.error
+        if backfill.error is None and not limit:
+            self._mark_synced()
+        
+        print(f"Backfill complete! Total processed: {total_synced}, New activities: {total_new}")
+        return total_synced, total_new
+    
+    def _sync_pages(self, after=None, limit=None, per_page=200):
+        """
+        Page through /athlete/activities and bulk-save each page
+        
+        Args:
+            after: Unix timestamp to only fetch activities after this date
+            limit: Maximum number of activities to sync (None for all)
+            per_page: Number of activities per page (max 200)
+        
+        Returns:
+            tuple: (total processed, total newly created, whether every page was fetched)
+        """
         page = 1
-        per_page = 200
         total_synced = 0
         total_new = 0
+        self.last_error = None
         
         while True:
             print(f"Fetching page {page}...")
             
             try:
-                activities = self.get_activities(page=page, per_page=per_page)
+                activities = self.get_activities(page=page, per_page=per_page, after=after)
                 
                 if not activities:
                     print("No more activities found")
                     break
                 
-                for activity_data in activities:
-                    if limit and total_synced >= limit:
-                        break
-                    
-                    created = self.save_activity(activity_data)
-                    if created:
-                        total_new += 1
-                    total_synced += 1
+                batch = activities
+                if limit:
+                    batch = activities[:limit - total_synced]
                 
-                print(f"Processed {len(activities)} activities from page {page}")
+                created, updated = self.save_activities(batch)
+                total_new += created
+                total_synced += len(batch)
+                
+                print(f"Processed {len(batch)} activities from page {page} "
+                      f"({created} new, {updated} updated)")
+                self.report_progress(page, total_synced, total_new)
                 
                 if limit and total_synced >= limit:
                     break
@@ -156,32 +362,61 @@ class StravaService:
                 
                 page += 1
                 
-                # Rate limiting - Strava allows 100 requests per 15 minutes
-                time.sleep(0.2)
-                
             except Exception as e:
                 print(f"Error syncing activities: {e}")
-                break
+                self.last_error = e
+                return total_synced, total_new, False
         
-        print(f"Sync complete! Total processed: {total_synced}, New activities: {total_new}")
-        return total_synced, total_new
+        return total_synced, total_new, True
     
-    def save_activity(self, activity_data):
-        """
-        Save activity data to database
+    def report_progress(self, page, total_synced, total_new):
+        """Forward page progress to the progress callback, if any"""
+        if self.progress_callback:
+            self.progress_callback(page, total_synced, total_new)
+    
+    def _mark_synced(self):
+        """Advance the profile's sync cursor after a successful sync"""
+        if not self.strava_profile:
+            return
         
-        Returns:
-            bool: True if new activity was created, False if updated
-        """
-        strava_id = activity_data.get('id')
+        latest = Activity.objects.filter(
+            user=self.strava_profile.user
+        ).aggregate(latest=Max('start_date'))['latest']
         
+        self.strava_profile.last_activity_start = latest
+        self.strava_profile.last_synced_at = timezone.now()
+        self.strava_profile.save(update_fields=['last_activity_start', 'last_synced_at', 'updated_at'])
+    
+    # Fields compared when deciding whether an existing row needs rewriting
+    SYNCED_FIELDS = [
+        'name', 'activity_type', 'start_date', 'distance', 'moving_time',
+        'elapsed_time', 'average_speed', 'max_speed', 'total_elevation_gain',
+        'average_heartrate', 'max_heartrate', 'average_watts', 'max_watts',
+        'calories', 'start_latitude', 'start_longitude', 'end_latitude',
+        'end_longitude', 'start_date_local', 'timezone_name', 'utc_offset',
+        'local_date', 'local_year', 'local_month', 'iso_year', 'iso_week',
+        'weekday', 'start_geohash', 'end_geohash', 'summary_polyline',
+    ]
+    
+    @staticmethod
+    def _parse_datetime(value):
+        """Parse a Strava ISO 8601 timestamp into an aware datetime"""
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = timezone.make_aware(parsed)
+        return parsed
+    
+    def _activity_fields(self, activity_data):
+        """Map a Strava activity payload onto Activity model fields"""
         # Convert start_date to datetime
-        start_date_str = activity_data.get('start_date')
-        if start_date_str.endswith('Z'):
-            start_date_str = start_date_str[:-1] + '+00:00'
-        start_date = datetime.fromisoformat(start_date_str)
-        if start_date.tzinfo is None:
-            start_date = timezone.make_aware(start_date)
+        start_date = self._parse_datetime(activity_data.get('start_date'))
+        
+        # The athlete's wall-clock start time, sent with a 'Z' suffix
+        start_date_local = activity_data.get('start_date_local')
+        start_date_local = self._parse_datetime(start_date_local) if start_date_local else None
+        utc_offset = activity_data.get('utc_offset')
         
         # Prepare activity data
         activity_fields = {
@@ -199,31 +434,64 @@ class StravaService:
             'average_watts': activity_data.get('average_watts'),
             'max_watts': activity_data.get('max_watts'),
             'calories': activity_data.get('calories'),
+            'start_date_local': start_date_local,
+            'timezone_name': activity_data.get('timezone') or '',
+            'utc_offset': int(utc_offset) if utc_offset is not None else None,
+            **local_date_fields(start_date, start_date_local),
         }
         
-        # Add user if we have a strava_profile
-        if self.strava_profile:
-            activity_fields['user'] = self.strava_profile.user
-        
         # Handle start coordinates
         start_latlng = activity_data.get('start_latlng')
         if start_latlng and len(start_latlng) >= 2:
             activity_fields['start_latitude'] = start_latlng[0]
             activity_fields['start_longitude'] = start_latlng[1]
+            activity_fields['start_geohash'] = encode_geohash(start_latlng[0], start_latlng[1])
         
         # Handle end coordinates
         end_latlng = activity_data.get('end_latlng')
         if end_latlng and len(end_latlng) >= 2:
             activity_fields['end_latitude'] = end_latlng[0]
             activity_fields['end_longitude'] = end_latlng[1]
+            activity_fields['end_geohash'] = encode_geohash(end_latlng[0], end_latlng[1])
+        
+        # Simplified route, used to match repeated courses
+        summary_polyline = (activity_data.get('map') or {}).get('summary_polyline')
+        if summary_polyline is not None:
+            activity_fields['summary_polyline'] = summary_polyline
+        
+        return activity_fields
+    
+    def save_activity(self, activity_data):
+        """
+        Save activity data to database
+        
+        Returns:
+            bool: True if new activity was created, False if updated
+        """
+        strava_id = activity_data.get('id')
+        activity_fields = self._activity_fields(activity_data)
+        
+        # Add user if we have a strava_profile
+        if self.strava_profile:
+            activity_fields['user'] = self.strava_profile.user
         
         # Create or update activity
         if self.strava_profile:
-            activity, created = Activity.objects.update_or_create(
-                user=self.strava_profile.user,
-                strava_id=strava_id,
-                defaults=activity_fields
-            )
+            user = self.strava_profile.user
+            with transaction.atomic():
+                previous = Activity.objects.filter(
+                    user=user, strava_id=strava_id
+                ).values('id', *TRACKED_FIELDS).first()
+                activity, created = Activity.objects.update_or_create(
+                    user=user,
+                    strava_id=strava_id,
+                    defaults=activity_fields
+                )
+                activities_changed(
+                    user,
+                    removed=[previous] if previous else [],
+                    added=[self._tracked_row(activity)],
+                )
         else:
             # Fallback for backward compatibility 
             activity, created = Activity.objects.update_or_create(
@@ -238,6 +506,101 @@ class StravaService:
         
         return created
     
+    # Times a page is re-read and rewritten after losing an insert race
+    SAVE_ATTEMPTS = 3
+    
+    def save_activities(self, activities_data):
+        """
+        Save a page of activities with a constant number of queries
+        
+        Looks up the existing rows for the whole page in one query, inserts
+        new activities with bulk_create and rewrites only the rows whose
+        synced fields actually changed with bulk_update. The lookup runs in
+        the same transaction as the writes, so derived tables see every
+        activity's previous values exactly once.
+        
+        Args:
+            activities_data: List of activity payloads from get_activities
+        
+        Returns:
+            tuple: (number of activities created, number of activities updated)
+        """
+        user = self.strava_profile.user if self.strava_profile else None
+        
+        # Later duplicates of the same strava_id win, as with save_activity
+        incoming = {}
+        for activity_data in activities_data:
+            incoming[activity_data.get('id')] = self._activity_fields(activity_data)
+        
+        if not incoming:
+            return 0, 0
+        
+        for attempt in range(self.SAVE_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return self._write_activities(user, incoming)
+            except IntegrityError:
+                # A concurrent sync inserted some of these activities after
+                # they were looked up; look them up again and retry
+                if attempt == self.SAVE_ATTEMPTS - 1:
+                    raise
+    
+    def _existing_activities(self, user, strava_ids):
+        """Return the stored synced fields of activities by strava_id, locking their rows"""
+        existing_qs = Activity.objects.select_for_update().filter(strava_id__in=strava_ids)
+        if user is not None:
+            existing_qs = existing_qs.filter(user=user)
+        return {
+            row['strava_id']: row
+            for row in existing_qs.values('id', 'strava_id', *self.SYNCED_FIELDS)
+        }
+    
+    def _write_activities(self, user, incoming):
+        """Insert and update one page of activity fields; runs inside a transaction"""
+        existing = self._existing_activities(user, list(incoming))
+        
+        now = timezone.now()
+        to_create = []
+        to_update = []
+        
+        for strava_id, fields in incoming.items():
+            current = existing.get(strava_id)
+            if current is None:
+                to_create.append(Activity(user=user, strava_id=strava_id, **fields))
+                continue
+            
+            # Fields missing from the payload keep their stored value, and the
+            # derived columns follow whichever start times and points are kept
+            merged = {name: fields.get(name, current[name]) for name in self.SYNCED_FIELDS}
+            merged.update(local_date_fields(merged['start_date'], merged['start_date_local']))
+            merged['start_geohash'] = encode_geohash(merged['start_latitude'], merged['start_longitude'])
+            merged['end_geohash'] = encode_geohash(merged['end_latitude'], merged['end_longitude'])
+            if any(merged[name] != current[name] for name in self.SYNCED_FIELDS):
+                to_update.append(Activity(
+                    id=current['id'], user=user, strava_id=strava_id,
+                    updated_at=now, **merged
+                ))
+        
+        if to_create:
+            Activity.objects.bulk_create(to_create)
+        if to_update:
+            Activity.objects.bulk_update(to_update, self.SYNCED_FIELDS + ['updated_at'])
+        
+        activities_changed(
+            user,
+            removed=[existing[activity.strava_id] for activity in to_update],
+            added=[self._tracked_row(activity) for activity in to_create + to_update],
+        )
+        
+        return len(to_create), len(to_update)
+    
+    @staticmethod
+    def _tracked_row(activity):
+        """Return the fields derived tables are maintained from"""
+        row = {field: getattr(activity, field) for field in TRACKED_FIELDS}
+        row['id'] = activity.id
+        return row
+    
     def sync_recent_activities(self, days=7):
         """
         Sync activities from the last N days
@@ -245,44 +608,15 @@ class StravaService:
         Args:
             days: Number of days to look back
         """
-        from datetime import timedelta
-        
         # Calculate timestamp for N days ago
         days_ago = timezone.now() - timedelta(days=days)
         after_timestamp = int(days_ago.timestamp())
         
         print(f"Syncing activities from last {days} days...")
         
-        page = 1
-        total_synced = 0
-        total_new = 0
-        
-        while True:
-            try:
-                activities = self.get_activities(
-                    page=page, 
-                    per_page=200, 
-                    after=after_timestamp
-                )
-                
-                if not activities:
-                    break
-                
-                for activity_data in activities:
-                    created = self.save_activity(activity_data)
-                    if created:
-                        total_new += 1
-                    total_synced += 1
-                
-                if len(activities) < 200:
-                    break
-                
-                page += 1
-                time.sleep(0.2)  # Rate limiting
-                
-            except Exception as e:
-                print(f"Error syncing recent activities: {e}")
-                break
+        total_synced, total_new, completed = self._sync_pages(after=after_timestamp)
+        if completed:
+            self._mark_synced()
         
         print(f"Recent sync complete! Total processed: {total_synced}, New activities: {total_new}")
-        return total_synced, total_new
\ No newline at end of file
+        return total_synced, total_new
@@ -0,0 +1,123 @@
+import zlib
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Activity, ActivityStream
+
+
+# Streams fetched from Strava for every activity
+STREAM_TYPES = ['time', 'distance', 'latlng', 'altitude', 'heartrate', 'watts', 'cadence']
+
+# Encodings: name -> (little-endian dtype of the stored array, delta encoded).
+# Time is a steadily increasing count of seconds, so its deltas are nearly
+# all 1 and compress to almost nothing; everything else is float32, with
+# samples Strava leaves out (null) stored as NaN.
+DELTA_INT32 = 'delta-int32'
+FLOAT32 = 'float32'
+ENCODINGS = {
+    DELTA_INT32: ('<i4', True),
+    FLOAT32: ('<f4', False),
+}
+STREAM_ENCODINGS = {'time': DELTA_INT32}
+
+# Values per sample of the streams that are not a single number
+STREAM_WIDTHS = {'latlng': 2}
+
+COMPRESSION_LEVEL = 6
+
+
+def encode(stream_type, samples):
+    """
+    Pack one stream's samples into a compressed typed array
+
+    Args:
+        stream_type: Strava stream key, e.g. 'heartrate'
+        samples: Sample values as sent by Strava ([lat, lng] pairs for latlng)
+
+    Returns:
+        tuple: (encoding, sample count, compressed bytes)
+    """
+    encoding = STREAM_ENCODINGS.get(stream_type, FLOAT32)
+    dtype, delta = ENCODINGS[encoding]
+    if delta:
+        values = np.diff(np.asarray(samples, dtype=np.int64), prepend=0).astype(dtype)
+    else:
+        values = np.array(samples, dtype=np.float64).astype(dtype)
+    return encoding, len(samples), zlib.compress(values.tobytes(), COMPRESSION_LEVEL)
+
+
+def decode(stream_type, encoding, sample_count, data):
+    """
+    Unpack a stream stored by encode()
+
+    float32 streams are returned as read-only views over the decompressed
+    buffer, without copying; delta-encoded streams are summed back up.
+
+    Returns:
+        numpy.ndarray: One value per sample, or (samples, width) for latlng
+    """
+    dtype, delta = ENCODINGS[encoding]
+    values = np.frombuffer(zlib.decompress(data), dtype=dtype)
+    if delta:
+        values = np.cumsum(values, dtype=dtype)
+    width = STREAM_WIDTHS.get(stream_type, 1)
+    if width > 1:
+        values = values.reshape(sample_count, width)
+    return values
+
+
+def save_streams(activity_id, payload):
+    """
+    Replace an activity's stored streams with a Strava streams payload
+
+    Args:
+        activity_id: Activity the streams belong to
+        payload: Response of /activities/{id}/streams, either keyed by type
+            or as a list of streams; empty for activities without streams
+
+    Returns:
+        int: Number of streams stored
+    """
+    if isinstance(payload, list):
+        payload = {stream['type']: stream for stream in payload if 'type' in stream}
+
+    streams = []
+    for stream_type in STREAM_TYPES:
+        samples = (payload.get(stream_type) or {}).get('data')
+        if not samples:
+            continue
+        encoding, sample_count, data = encode(stream_type, samples)
+        streams.append(ActivityStream(
+            activity_id=activity_id, stream_type=stream_type,
+            encoding=encoding, sample_count=sample_count, data=data,
+        ))
+
+    with transaction.atomic():
+        ActivityStream.objects.filter(activity_id=activity_id).delete()
+        ActivityStream.objects.bulk_create(streams)
+        Activity.objects.filter(id=activity_id).update(streams_synced_at=timezone.now())
+    return len(streams)
+
+
+def load_streams(activity_id, stream_types=None):
+    """
+    Load an activity's stored streams
+
+    Args:
+        activity_id: Activity to load
+        stream_types: Only load these streams (default: all stored)
+
+    Returns:
+        dict: stream type -> numpy.ndarray
+    """
+    stored = ActivityStream.objects.filter(activity_id=activity_id)
+    if stream_types is not None:
+        stored = stored.filter(stream_type__in=stream_types)
+    return {
+        stream_type: decode(stream_type, encoding, sample_count, data)
+        for stream_type, encoding, sample_count, data in stored.values_list(
+            'stream_type', 'encoding', 'sample_count', 'data'
+        )
+    }
@@ -0,0 +1,177 @@
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.db import IntegrityError, connections, transaction
+from django.utils import timezone
+
+from .models import SyncJob
+
+
+# Times enqueue_sync looks for an active job after losing an insert race
+ENQUEUE_ATTEMPTS = 3
+
+
+def enqueue_sync(strava_profile, full=False):
+    """
+    Queue a sync for a profile, reusing the queued or running job if there is one
+
+    A full resync requested while an incremental job is still queued upgrades
+    that job instead of adding a second one.
+
+    Returns:
+        tuple: (SyncJob, whether a new job was created)
+    """
+    mode = SyncJob.MODE_FULL if full else SyncJob.MODE_INCREMENTAL
+
+    for attempt in range(ENQUEUE_ATTEMPTS):
+        active = SyncJob.objects.filter(
+            profile=strava_profile, status__in=SyncJob.ACTIVE_STATUSES
+        ).first()
+        if active is not None:
+            break
+        try:
+            with transaction.atomic():
+                job = SyncJob.objects.create(
+                    user=strava_profile.user, profile=strava_profile, mode=mode
+                )
+            return job, True
+        except IntegrityError:
+            # Another request queued a job for this profile at the same time;
+            # look again, since that job may also have finished by now
+            if attempt == ENQUEUE_ATTEMPTS - 1:
+                raise
+
+    if full and active.mode != SyncJob.MODE_FULL:
+        SyncJob.objects.filter(id=active.id, status=SyncJob.STATUS_QUEUED).update(mode=SyncJob.MODE_FULL)
+        active.refresh_from_db()
+
+    return active, False
+
+
+def claim_next_job(worker_id):
+    """
+    Atomically move the oldest queued job to running
+
+    The status check in the UPDATE's WHERE clause acts as the row lock: of
+    several workers racing for the same job, only one sees a row updated.
+    """
+    candidates = SyncJob.objects.filter(
+        status=SyncJob.STATUS_QUEUED
+    ).order_by('created_at').values_list('id', flat=True)[:10]
+
+    for job_id in candidates:
+        now = timezone.now()
+        claimed = SyncJob.objects.filter(id=job_id, status=SyncJob.STATUS_QUEUED).update(
+            status=SyncJob.STATUS_RUNNING, worker=worker_id, started_at=now, heartbeat_at=now
+        )
+        if claimed:
+            return SyncJob.objects.select_related('profile__user').get(id=job_id)
+    return None
+
+
+def requeue_stale_jobs(stale_after):
+    """Put running jobs whose worker stopped sending heartbeats back on the queue"""
+    cutoff = timezone.now() - stale_after
+    return SyncJob.objects.filter(
+        status=SyncJob.STATUS_RUNNING, heartbeat_at__lt=cutoff
+    ).update(status=SyncJob.STATUS_QUEUED, worker='')
+
+
+def run_job(job, page_workers=1):
+    """Run a claimed job to completion, recording progress as pages are saved"""
+    from .strava_service import StravaService
+
+    def progress(page, total_synced, total_new):
+        SyncJob.objects.filter(id=job.id).update(
+            pages_fetched=page,
+            activities_processed=total_synced,
+            activities_new=total_new,
+            heartbeat_at=timezone.now(),
+        )
+
+    service = StravaService(job.profile, progress_callback=progress)
+    try:
+        total, new = service.sync_activities(
+            full=job.mode == SyncJob.MODE_FULL, workers=page_workers
+        )
+        error = service.last_error
+    except Exception as e:
+        total, new, error = None, None, e
+
+    fields = {
+        'status': SyncJob.STATUS_FAILED if error else SyncJob.STATUS_SUCCEEDED,
+        'error': str(error) if error else '',
+        'finished_at': timezone.now(),
+    }
+    if total is not None:
+        fields.update(activities_processed=total, activities_new=new)
+    SyncJob.objects.filter(id=job.id).update(**fields)
+
+
+class SyncWorker:
+    """Pull jobs off the SyncJob table with a fixed number of threads"""
+
+    def __init__(self, concurrency=2, poll_interval=2.0, page_workers=1,
+                 stale_after=timedelta(minutes=30), once=False):
+        """
+        Args:
+            concurrency: Number of jobs run at the same time
+            poll_interval: Seconds to wait before polling an empty queue again
+            page_workers: Pages fetched concurrently within a full resync
+            stale_after: Heartbeat age after which a running job is requeued
+            once: Exit once the queue is empty instead of polling forever
+        """
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.page_workers = page_workers
+        self.stale_after = stale_after
+        self.once = once
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+
+    def run(self):
+        """Run until stopped (or until the queue is drained with once=True)"""
+        requeued = requeue_stale_jobs(self.stale_after)
+        if requeued:
+            print(f"Requeued {requeued} stale sync job(s)")
+
+        threads = [
+            threading.Thread(target=self._loop, name=f'sync-worker-{i}', daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            print("Stopping after the running jobs finish...")
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        worker_id = f"{self.worker_id}:{threading.current_thread().name}"
+        try:
+            while not self._stop.is_set():
+                job = claim_next_job(worker_id)
+                if job is None:
+                    if self.once:
+                        break
+                    self._stop.wait(self.poll_interval)
+                    continue
+
+                print(f"[{worker_id}] Running {job}")
+                started = time.monotonic()
+                run_job(job, page_workers=self.page_workers)
+                job.refresh_from_db()
+                print(f"[{worker_id}] Finished {job} in {time.monotonic() - started:.1f}s")
+        finally:
+            connections.close_all()
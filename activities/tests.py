@@ -1,3 +1,1778 @@
-from django.test import TestCase
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import requests
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import IntegrityError, connection
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import (
+    courses, curves, fleet, geo, http_client, pagination, records, responses, rollups, streams, sync_jobs, training_load,
+    units, views,
+)
+from .analytics import StravaAnalytics
+from .analytics_cache import CACHE_ALIAS, bump_generation, cache_stats, get_generation
+from .backfill import ConcurrentBackfill
+from .ingest import TRACKED_FIELDS, activities_changed
+from .management.commands.benchmark_analytics import (
+    legacy_dataframe, legacy_day_of_week_stats, legacy_monthly_trends,
+)
+from .models import (
+    Activity, ActivitySummary, Course, CurveEnvelope, DailyTrainingLoad, PersonalRecord, StravaProfile,
+    StravaRateLimit, SyncJob, local_date_fields,
+)
+from .rate_limit import RateLimitExceeded, RateLimitGovernor, governor
+from .strava_service import StravaService
+
+
+# Plan lines that mean a table is read in full
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'^SCAN (?!CONSTANT ROW)(\w+)'),
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+}
+
+
+def create_strava_user(username, strava_user_id=1, **profile_fields):
+    """Create a user with a connected Strava profile whose token is still valid"""
+    user = User.objects.create_user(username)
+    StravaProfile.objects.create(
+        user=user, strava_user_id=strava_user_id, access_token='token', refresh_token='refresh',
+        expires_at=timezone.now() + timedelta(hours=6), **profile_fields,
+    )
+    return user
+
+
+class AnalyticsTestCase(TestCase):
+    """Starts every test with an empty analytics result cache"""
+
+    def setUp(self):
+        caches[CACHE_ALIAS].clear()
+
+
+class QueryPlanTests(AnalyticsTestCase):
+    """
+    Every query StravaAnalytics runs must reach its rows through an index
+
+    The analytics methods are run with their SQL captured, then each SELECT
+    that touches an activities table is EXPLAINed and the test fails if the
+    plan contains a full table scan. On PostgreSQL sequential scans are
+    disabled while explaining, so a Seq Scan in the plan means no index
+    could serve the query at all rather than that the planner preferred a
+    scan of a small test table.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # One user with rollups (has a Strava profile), one without, so both
+        # the summary-table and the raw-activity code paths are covered
+        cls.rollup_user = create_strava_user('rollups')
+        cls.raw_user = User.objects.create_user('raw')
+
+        now = timezone.now()
+        types = ['Run', 'Ride', 'Swim', 'Walk']
+        activities = []
+        for user in (cls.rollup_user, cls.raw_user):
+            for i in range(60):
+                start_date = now - timedelta(days=i * 7, hours=i)
+                activities.append(Activity(
+                    user=user,
+                    strava_id=i + 1,
+                    name=f'Activity {i}',
+                    activity_type=types[i % len(types)],
+                    start_date=start_date,
+                    **local_date_fields(start_date),
+                    distance=5000 + i * 100,
+                    moving_time=1800 + i * 30,
+                    elapsed_time=2000 + i * 30,
+                    average_speed=2.5 + (i % 5) * 0.5,
+                    max_speed=6.0,
+                    total_elevation_gain=50.0 + i,
+                    average_heartrate=140.0 if i % 3 else None,
+                    calories=400 if i % 4 else None,
+                ))
+        Activity.objects.bulk_create(activities)
+
+    @contextmanager
+    def capture_selects(self):
+        """Collect (sql, params) of every SELECT run inside the block"""
+        queries = []
+
+        def wrapper(execute, sql, params, many, context):
+            if sql.lstrip().upper().startswith('SELECT'):
+                queries.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            yield queries
+
+    def explain(self, sql, params):
+        """Return the query plan of a statement as text"""
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET enable_seqscan = off')
+                try:
+                    cursor.execute('EXPLAIN ' + sql, params)
+                    return '\n'.join(row[0] for row in cursor.fetchall())
+                finally:
+                    cursor.execute('RESET enable_seqscan')
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    def assert_indexed(self, label, func):
+        """Run func and fail if any activities query it makes scans a table"""
+        pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            self.skipTest(f'No query plan check for {connection.vendor}')
+
+        with self.capture_selects() as queries:
+            func()
+
+        checked = 0
+        for sql, params in queries:
+            if 'activities_' not in sql:
+                continue
+            checked += 1
+            plan = self.explain(sql, params)
+            scans = [
+                match.group(1) for line in plan.splitlines()
+                for match in [pattern.search(line.strip())] if match
+            ]
+            self.assertFalse(scans, f'{label} scans {", ".join(scans)}:\n{sql}\n{plan}')
+        self.assertTrue(checked, f'{label} ran no activity queries')
+
+    def check_analytics(self, user):
+        for period in ('all', 'week', 'month', 'year'):
+            for activity_type in (None, 'Run'):
+                self.assert_indexed(
+                    f'get_summary_stats({period}, {activity_type})',
+                    lambda: StravaAnalytics(user).get_summary_stats(period=period, activity_type=activity_type),
+                )
+            self.assert_indexed(
+                f'get_activity_type_breakdown({period})',
+                lambda: StravaAnalytics(user).get_activity_type_breakdown(period=period),
+            )
+
+        for activity_type in (None, 'Run'):
+            self.assert_indexed(
+                f'get_monthly_trends({activity_type})',
+                lambda: StravaAnalytics(user).get_monthly_trends(activity_type=activity_type),
+            )
+            self.assert_indexed(
+                f'get_weekly_trends({activity_type})',
+                lambda: StravaAnalytics(user).get_weekly_trends(weeks=12, activity_type=activity_type),
+            )
+            self.assert_indexed(
+                f'get_personal_records({activity_type})',
+                lambda: StravaAnalytics(user).get_personal_records(activity_type=activity_type),
+            )
+            self.assert_indexed(
+                f'get_day_of_week_stats({activity_type})',
+                lambda: StravaAnalytics(user).get_day_of_week_stats(activity_type=activity_type),
+            )
+            self.assert_indexed(
+                f'get_dashboard({activity_type})',
+                lambda: StravaAnalytics(user).get_dashboard(activity_type=activity_type),
+            )
+
+        self.assert_indexed('get_facets', lambda: StravaAnalytics(user).get_facets())
+        self.assert_indexed('get_curves', lambda: StravaAnalytics(user).get_curves(window_days=90))
+        self.assert_indexed('get_training_load', lambda: StravaAnalytics(user).get_training_load(days=90))
+        self.assert_indexed('get_nearby_activities', lambda: StravaAnalytics(user).get_nearby_activities(51.5, -0.12, 2))
+        self.assert_indexed('get_start_locations', lambda: StravaAnalytics(user).get_start_locations())
+        self.assert_indexed('get_courses', lambda: StravaAnalytics(user).get_courses(min_activities=1))
+
+    def test_rollup_queries_use_indexes(self):
+        self.check_analytics(self.rollup_user)
+
+    def test_raw_activity_queries_use_indexes(self):
+        self.check_analytics(self.raw_user)
+
+    def test_activity_list_queries_use_indexes(self):
+        self.client.force_login(self.raw_user)
+        for query in ('', 'type=Run', 'year=2024&month=3', 'from=2024-01-01&to=2024-06-30'):
+            def fetch_pages():
+                response = self.client.get(f'/api/activities/?limit=10&{query}')
+                cursor = response.json()['next_cursor']
+                if cursor:
+                    self.client.get(f'/api/activities/?limit=10&{query}&cursor={cursor}')
+
+            self.assert_indexed(f'api_activities({query})', fetch_pages)
+
+
+class UnitsTests(AnalyticsTestCase):
+    """?units= returns one unit system and leaves the default payload unchanged"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('units')
+        start_date = timezone.now() - timedelta(days=3)
+        Activity.objects.create(
+            user=cls.user, strava_id=1, name='Run', activity_type='Run',
+            start_date=start_date, distance=10000, moving_time=3000,
+            elapsed_time=3100, average_speed=10000 / 3000, total_elevation_gain=40.0,
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_single_unit_system(self):
+        for units, distance, speed, other in [
+            ('metric', 'distance_km', 'average_speed_kmh', 'distance_miles'),
+            ('imperial', 'distance_miles', 'average_speed_mph', 'distance_km'),
+        ]:
+            activity = self.client.get(f'/api/activities/?units={units}').json()['activities'][0]
+            self.assertAlmostEqual(activity[distance], {'metric': 10, 'imperial': 10000 / 1609.34}[units])
+            self.assertIn(speed, activity)
+            self.assertNotIn(other, activity)
+            self.assertNotIn('distance', activity)
+
+            month = self.client.get(f'/api/monthly-trends/?units={units}').json()['trends'][0]
+            self.assertIn(distance, month)
+            self.assertNotIn(other, month)
+            self.assertEqual(month['time_hours'], 3000 / 3600)
+
+    def test_default_has_both_unit_systems(self):
+        activity = self.client.get('/api/activities/').json()['activities'][0]
+        self.assertAlmostEqual(activity['distance_km'], 10)
+        self.assertAlmostEqual(activity['distance_miles'], 10000 / 1609.34)
+        stats = self.client.get('/api/stats/').json()
+        self.assertEqual(stats['total_distance'], 10000)
+        self.assertAlmostEqual(stats['avg_speed_mph'], 10000 / 3000 * 2.237)
+
+    def test_missing_values_stay_missing(self):
+        Activity.objects.create(
+            user=self.user, strava_id=2, name='Manual', activity_type='Workout',
+            start_date=timezone.now() - timedelta(days=5), distance=0, moving_time=1800, elapsed_time=1800,
+        )
+        manual = self.client.get('/api/activities/').json()['activities'][1]
+        self.assertEqual(manual['name'], 'Manual')
+        self.assertIsNone(manual['average_speed_kmh'])
+        self.assertIsNone(manual['average_speed_mph'])
+        self.assertEqual(manual['distance_km'], 0)
+
+        columns = units.convert(
+            {'pace': [300 / 1000, None, np.nan], 'speed': np.array([2.0, np.nan, 0.0])},
+            {'pace': ('pace', 'pace'), 'speed': ('speed', 'speed')}, 'metric',
+        )
+        self.assertEqual(columns, {'pace_min_per_km': [5.0, None, None], 'speed_kmh': [7.2, None, 0.0]})
+        self.assertEqual(units.readable('pace', None, 'pace'), {'pace_min_per_km': None, 'pace_min_per_mile': None})
+
+    def test_unknown_units_rejected(self):
+        self.assertEqual(self.client.get('/api/dashboard/?units=furlongs').status_code, 400)
+        self.assertEqual(self.client.get('/api/activities/?units=furlongs').status_code, 400)
+
+    def test_bad_weeks_rejected(self):
+        for path in ('/api/dashboard/?weeks=x', '/api/weekly-trends/?weeks=abc'):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 400, path)
+            self.assertIn('error', response.json())
+
+    def test_weeks_clamped(self):
+        for weeks, expected in (('0', 1), ('-3', 1), ('52', 52), ('100000', views.MAX_TREND_WEEKS)):
+            with mock.patch.object(StravaAnalytics, 'get_weekly_trends', return_value=[]) as trends:
+                self.assertEqual(self.client.get(f'/api/weekly-trends/?weeks={weeks}').status_code, 200)
+            self.assertEqual(trends.call_args.kwargs['weeks'], expected)
+
+
+class ResponseEncodingTests(TestCase):
+    """API payloads encode NumPy/pandas values and can be sent column-wise"""
+
+    def test_numpy_and_pandas_values(self):
+        payload = {
+            'count': np.int64(3),
+            'speed': np.float32(2.5),
+            'values': np.arange(3),
+            'month': pd.Period('2024-03', freq='M'),
+            'missing': pd.NaT,
+        }
+        for backend in responses.BACKENDS:
+            if backend == 'orjson' and responses.orjson is None:
+                continue
+            self.assertEqual(json.loads(responses.encode(payload, backend)), {
+                'count': 3, 'speed': 2.5, 'values': [0, 1, 2], 'month': '2024-03', 'missing': None,
+            })
+
+    def test_non_finite_floats_are_null(self):
+        payload = {
+            'nan': float('nan'),
+            'inf': np.float64('inf'),
+            'half': np.float32('nan'),
+            'values': np.array([1.5, np.nan, -np.inf]),
+            'rows': [{'pace': math.nan}, (2.0, float('-inf'))],
+        }
+        expected = b'{"nan":null,"inf":null,"half":null,"values":[1.5,null,null],"rows":[{"pace":null},[2.0,null]]}'
+        backends = [backend for backend in responses.BACKENDS if backend != 'orjson' or responses.orjson is not None]
+        for backend in backends:
+            self.assertEqual(responses.encode(payload, backend), expected, backend)
+
+    def test_columns_format(self):
+        user = User.objects.create_user('columns')
+        for i in range(3):
+            Activity.objects.create(
+                user=user, strava_id=i + 1, name=f'Activity {i}', activity_type='Run',
+                start_date=timezone.now() - timedelta(days=i), distance=1000 * (i + 1),
+                moving_time=600, elapsed_time=600, total_elevation_gain=0.0,
+            )
+        self.client.force_login(user)
+
+        rows = self.client.get('/api/activities/?units=metric').json()['activities']
+        columns = self.client.get('/api/activities/?units=metric&format=columns').json()['activities']
+        self.assertEqual(columns, {field: [row[field] for row in rows] for field in rows[0]})
+        self.assertEqual(columns['distance_km'], [1.0, 2.0, 3.0])
+        self.assertEqual(self.client.get('/api/activities/?format=csv').status_code, 400)
+
+
+class ConditionalRequestTests(AnalyticsTestCase):
+    """API endpoints answer revalidation with 304 until the user's data changes"""
+
+    ENDPOINTS = [
+        '/api/stats/', '/api/breakdown/', '/api/monthly-trends/', '/api/weekly-trends/',
+        '/api/personal-records/', '/api/day-of-week/', '/api/dashboard/', '/api/facets/',
+        '/api/activities/', '/api/curves/', '/api/training-load/',
+        '/api/activities/nearby/?lat=51.5&lng=-0.12', '/api/start-locations/', '/api/courses/',
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_strava_user('conditional', last_synced_at=timezone.now() - timedelta(hours=1))
+        cls.activity = Activity.objects.create(
+            user=cls.user, strava_id=1, name='Run', activity_type='Run',
+            start_date=timezone.now() - timedelta(days=2), distance=5000,
+            moving_time=1500, elapsed_time=1600, total_elevation_gain=10.0,
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_not_modified_before_analytics_run(self):
+        for path in self.ENDPOINTS:
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertIn('private', response['Cache-Control'])
+            self.assertTrue(response.has_header('Last-Modified'), path)
+
+            caches[CACHE_ALIAS].clear()
+            # Session and user lookups, the profile read and the activity count
+            with self.assertNumQueries(4):
+                revalidated = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(revalidated.status_code, 304, path)
+            self.assertIn('private', revalidated['Cache-Control'])
+
+    def test_etag_changes_with_data_and_query(self):
+        etag = self.client.get('/api/monthly-trends/')['ETag']
+        self.assertNotEqual(etag, self.client.get('/api/monthly-trends/?type=Run')['ETag'])
+
+        self.activity.delete()
+        response = self.client.get('/api/monthly-trends/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_last_modified_moves_with_stream_sync(self):
+        last_modified = self.client.get('/api/curves/')['Last-Modified']
+        response = self.client.get('/api/curves/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        payload = {'time': {'data': list(range(600))}, 'watts': {'data': [250] * 600}}
+        with mock.patch.object(StravaService, 'get_activity_streams', return_value=payload):
+            self.assertEqual(StravaService(self.user.strava_profile).sync_streams(), 1)
+
+        response = self.client.get('/api/curves/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['Last-Modified'], last_modified)
+
+    def test_last_modified_moves_with_generation(self):
+        last_modified = self.client.get('/api/stats/')['Last-Modified']
+        bump_generation(self.user)
+        response = self.client.get('/api/stats/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+
+class StreamStorageTests(TestCase):
+    """Streams round-trip through their compressed column encodings"""
+
+    def test_save_and_load(self):
+        user = User.objects.create_user('streams')
+        activity = Activity.objects.create(
+            user=user, strava_id=1, name='Ride', activity_type='Ride',
+            start_date=timezone.now(), distance=20000, moving_time=3600,
+            elapsed_time=3700, total_elevation_gain=100.0,
+        )
+        time = list(range(0, 7000, 2))
+        payload = {
+            'time': {'data': time},
+            'latlng': {'data': [[51.5 + i * 1e-5, -0.1 - i * 1e-5] for i in range(len(time))]},
+            'watts': {'data': [None] + [200] * (len(time) - 1)},
+            'heartrate': {'data': []},
+        }
+
+        self.assertEqual(streams.save_streams(activity.id, payload), 3)
+        loaded = streams.load_streams(activity.id)
+
+        self.assertEqual(sorted(loaded), ['latlng', 'time', 'watts'])
+        np.testing.assert_array_equal(loaded['time'], time)
+        self.assertEqual(loaded['latlng'].shape, (len(time), 2))
+        np.testing.assert_allclose(loaded['latlng'][-1], payload['latlng']['data'][-1], rtol=1e-6)
+        self.assertTrue(np.isnan(loaded['watts'][0]))
+        self.assertFalse(loaded['watts'].flags.owndata)
+        self.assertEqual(list(streams.load_streams(activity.id, ['time'])), ['time'])
+
+        activity.refresh_from_db()
+        self.assertIsNotNone(activity.streams_synced_at)
+
+
+class CurveTests(AnalyticsTestCase):
+    """Mean-maximal curves match a brute-force search and follow activity changes"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('curves')
+
+    def ride(self, strava_id, watts, days_ago=1):
+        activity = Activity.objects.create(
+            user=self.user, strava_id=strava_id, name='Ride', activity_type='Ride',
+            start_date=timezone.now() - timedelta(days=days_ago), distance=len(watts) * 8.0,
+            moving_time=len(watts), elapsed_time=len(watts), total_elevation_gain=0.0,
+        )
+        streams.save_streams(activity.id, {
+            'time': {'data': list(range(len(watts)))},
+            'distance': {'data': [i * 8.0 for i in range(len(watts))]},
+            'watts': {'data': watts},
+        })
+        curves.add_activity(activity.id)
+        bump_generation(self.user)
+        return activity
+
+    def test_compute_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        watts = rng.integers(100, 400, 900).astype(float)
+        computed = curves.compute({'time': np.arange(900), 'watts': watts, 'distance': np.arange(900) * 8.0})
+
+        for i, duration in enumerate(curves.DURATIONS):
+            if duration > 900:
+                self.assertTrue(np.isnan(computed['power'][i]))
+                continue
+            expected = max(watts[start:start + duration].mean() for start in range(900 - duration + 1))
+            self.assertAlmostEqual(float(computed['power'][i]), expected, places=2)
+        self.assertAlmostEqual(float(computed['speed'][0]), 8.0, places=4)
+
+    def test_envelope_follows_new_and_deleted_activities(self):
+        analytics = StravaAnalytics(self.user)
+        easy = self.ride(1, [150.0] * 600)
+        self.assertEqual({point['watts'] for point in analytics.get_curves()}, {150.0})
+
+        hard = self.ride(2, [300.0] * 120, days_ago=200)
+        points = {point['duration']: point for point in StravaAnalytics(self.user).get_curves()}
+        self.assertEqual(points[60]['watts'], 300.0)
+        self.assertEqual(points[60]['activity_id'], hard.id)
+        self.assertEqual(points[300]['activity_id'], easy.id)
+
+        recent = {point['duration']: point for point in StravaAnalytics(self.user).get_curves(window_days=90)}
+        self.assertEqual(recent[60]['activity_id'], easy.id)
+
+        hard.delete()
+        points = {point['duration']: point for point in StravaAnalytics(self.user).get_curves()}
+        self.assertEqual(points[60]['activity_id'], easy.id)
+
+        own = StravaAnalytics(self.user).get_curves(channel='speed', activity_id=easy.id, units='metric')
+        self.assertAlmostEqual(own[0]['speed_kmh'], 28.8, places=3)
+        self.assertNotIn('activity_id', own[0])
+
+    def test_reads_never_write_aged_out_windows(self):
+        easy = self.ride(1, [150.0] * 600)
+        hard = self.ride(2, [300.0] * 120, days_ago=60)
+        points = {point['duration']: point for point in StravaAnalytics(self.user).get_curves(window_days=90)}
+        self.assertEqual(points[60]['activity_id'], hard.id)
+
+        def stored_holders():
+            envelope = CurveEnvelope.objects.get(user=self.user, activity_type='', channel='power', window_days=90)
+            return set(np.frombuffer(envelope.activity_ids, dtype='<i8').tolist()) - {0}
+
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        later = timezone.now() + timedelta(days=40)
+        caches[CACHE_ALIAS].clear()
+        with mock.patch('django.utils.timezone.now', return_value=later), connection.execute_wrapper(record):
+            points = {point['duration']: point for point in StravaAnalytics(self.user).get_curves(window_days=90)}
+        self.assertEqual(points[60]['activity_id'], easy.id)
+        self.assertFalse([sql for sql in statements if sql.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE'))])
+        self.assertIn(hard.id, stored_holders())
+
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            curves.expire_windows(self.user)
+        self.assertEqual(stored_holders(), {easy.id})
+
+    def test_api_rejects_bad_parameters(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/api/curves/?channel=cadence').status_code, 400)
+        self.assertEqual(self.client.get('/api/curves/?window=30').status_code, 400)
+        self.assertEqual(self.client.get('/api/curves/?channel=heartrate&format=columns').status_code, 200)
+
+
+class TrainingLoadTests(AnalyticsTestCase):
+    """Daily training load updated incrementally matches a full rebuild"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('load', ftp=250, threshold_heartrate=170)
+
+    def workout(self, strava_id, days_ago, watts=None, heartrate=None):
+        start_date = timezone.now() - timedelta(days=days_ago)
+        return Activity.objects.create(
+            user=self.user, strava_id=strava_id, name='Workout', activity_type='Ride',
+            start_date=start_date, **local_date_fields(start_date), distance=30000,
+            moving_time=3600, elapsed_time=3600, total_elevation_gain=0.0,
+            average_watts=watts, average_heartrate=heartrate,
+        )
+
+    def stored(self):
+        return list(DailyTrainingLoad.objects.filter(user=self.user).order_by('date').values_list(
+            'date', 'load', 'fitness', 'fatigue'
+        ))
+
+    def test_stress_score(self):
+        row = {'moving_time': 3600, 'average_watts': 250, 'average_heartrate': 150}
+        self.assertAlmostEqual(training_load.stress_score(row, ftp=250, threshold_heartrate=170), 100)
+        self.assertAlmostEqual(training_load.stress_score(dict(row, average_watts=None), threshold_heartrate=150), 100)
+        self.assertIsNone(training_load.stress_score(row))
+
+    def test_incremental_matches_rebuild(self):
+        self.workout(1, 30, watts=200)
+        self.assertTrue(training_load.ensure_ready(self.user))
+        ingest = [(2, 20, 250, None), (3, 40, None, 160), (4, 20, 180, None), (5, 1, 300, None)]
+        for strava_id, days_ago, watts, heartrate in ingest:
+            activity = self.workout(strava_id, days_ago, watts, heartrate)
+            row = {field: getattr(activity, field) for field in TRACKED_FIELDS}
+            activities_changed(self.user, added=[dict(row, id=activity.id)])
+        Activity.objects.get(strava_id=4).delete()
+
+        incremental = self.stored()
+        training_load.rebuild(self.user)
+        rebuilt = self.stored()
+        self.assertEqual([row[0] for row in incremental], [row[0] for row in rebuilt])
+        np.testing.assert_allclose([row[1:] for row in incremental], [row[1:] for row in rebuilt])
+
+    def test_series_fills_days_between_activities(self):
+        self.workout(1, 10, watts=250)
+        result = StravaAnalytics(self.user).get_training_load(days=14)
+        series = result['series']
+
+        self.assertEqual(len(series), 14)
+        self.assertEqual(result['ftp'], 250)
+        active = [point for point in series if point['load']]
+        self.assertEqual(len(active), 1)
+        self.assertAlmostEqual(active[0]['fitness'], 100 / 42)
+        self.assertAlmostEqual(series[-1]['fatigue'], 100 / 7 * (6 / 7) ** 10)
+        self.assertAlmostEqual(series[-1]['form'], series[-1]['fitness'] - series[-1]['fatigue'])
+        self.assertEqual(series[0]['fitness'], 0)
+
+        self.client.force_login(self.user)
+        self.assertEqual(len(self.client.get('/api/training-load/?days=30&format=columns').json()['series']['date']), 30)
+        self.assertEqual(self.client.get('/api/training-load/?days=0').status_code, 400)
+
+
+class SpatialSearchTests(AnalyticsTestCase):
+    """Nearby searches over the geohash index find exactly the activities in range"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('spatial')
+        rng = np.random.default_rng(7)
+        self.points = np.column_stack([51.5 + rng.normal(0, 0.03, 300), -0.12 + rng.normal(0, 0.05, 300)])
+        start_date = timezone.now()
+        Activity.objects.bulk_create([
+            Activity(
+                user=self.user, strava_id=i, name='Run', activity_type='Run',
+                start_date=start_date, distance=5000, moving_time=1500, elapsed_time=1500,
+                start_latitude=latitude, start_longitude=longitude,
+                start_geohash=geo.encode_geohash(latitude, longitude),
+                **local_date_fields(start_date),
+            )
+            for i, (latitude, longitude) in enumerate(self.points.tolist())
+        ])
+
+    def test_geohash(self):
+        self.assertEqual(geo.encode_geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geo.encode_geohash(None, 10.4), '')
+        activity = Activity.objects.create(
+            user=self.user, strava_id=1000, name='Ride', activity_type='Ride',
+            start_date=timezone.now(), distance=1, moving_time=1, elapsed_time=1,
+            end_latitude=57.64911, end_longitude=10.40744,
+        )
+        self.assertEqual((activity.start_geohash, activity.end_geohash), ('', 'u4pruydq'))
+
+    def test_nearby_matches_brute_force(self):
+        offsets = geo.haversine_km(51.5, -0.12, self.points[:, 0], self.points[:, 1])
+        for radius_km in (0.5, 2, 5, 50):
+            found = StravaAnalytics(self.user).get_nearby_activities(51.5, -0.12, radius_km, limit=1000, units='metric')
+            self.assertEqual(len(found), int((offsets <= radius_km).sum()), radius_km)
+            distances = [activity['from_point_km'] for activity in found]
+            self.assertEqual(distances, sorted(distances))
+            self.assertTrue(all(distance <= radius_km for distance in distances))
+
+    def test_prefixes_cover_the_antimeridian(self):
+        prefixes = geo.search_prefixes(0.0, 179.999, 5)
+        self.assertTrue(any(geo.encode_geohash(0.0, -179.99).startswith(prefix) for prefix in prefixes))
+
+    def test_start_locations(self):
+        locations = StravaAnalytics(self.user).get_start_locations()
+        self.assertEqual(locations[0]['count'], max(location['count'] for location in locations))
+        self.assertAlmostEqual(locations[0]['latitude'], 51.5, delta=0.1)
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/api/start-locations/').status_code, 200)
+        self.assertEqual(self.client.get('/api/activities/nearby/?lat=51.5').status_code, 400)
+        self.assertEqual(self.client.get('/api/activities/nearby/?lat=95&lng=0').status_code, 400)
+        response = self.client.get('/api/activities/nearby/?lat=51.5&lng=-0.12&radius=2&format=columns')
+        self.assertIn('from_point_km', response.json()['activities'])
+
+
+def encode_polyline(points):
+    """Encode (latitude, longitude) points the way Strava's summary_polyline is"""
+    chars, previous = [], (0, 0)
+    for latitude, longitude in points:
+        current = (round(latitude * 1e5), round(longitude * 1e5))
+        for delta in (current[0] - previous[0], current[1] - previous[1]):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chars.append(chr((0x20 | value & 0x1f) + 63))
+                value >>= 5
+            chars.append(chr(value + 63))
+        previous = current
+    return ''.join(chars)
+
+
+class CourseMatchingTests(AnalyticsTestCase):
+    """Activities on the same route are grouped into one course"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('courses')
+        self.rng = np.random.default_rng(11)
+        self.loop = self.route(51.5, -0.12)
+        self.other = self.route(51.45, -0.2)
+        self.strava_id = 0
+
+    def route(self, latitude, longitude, points=120):
+        heading = np.cumsum(self.rng.normal(0, 0.3, points))
+        return np.column_stack([
+            latitude + np.cumsum(np.cos(heading) * 0.0008),
+            longitude + np.cumsum(np.sin(heading) * 0.0013),
+        ])
+
+    def record_run(self, route, moving_time, days_ago):
+        self.strava_id += 1
+        start_date = timezone.now() - timedelta(days=days_ago)
+        activity = Activity.objects.create(
+            user=self.user, strava_id=self.strava_id, name=f'Run {self.strava_id}', activity_type='Run',
+            start_date=start_date, distance=8000, moving_time=moving_time, elapsed_time=moving_time,
+            summary_polyline=encode_polyline(route + self.rng.normal(0, 0.00008, route.shape)),
+        )
+        row = {field: getattr(activity, field) for field in TRACKED_FIELDS}
+        activities_changed(self.user, added=[dict(row, id=activity.id)])
+        activity.refresh_from_db()
+        return activity
+
+    def test_polyline_round_trip(self):
+        points = np.round(self.loop, 5)
+        np.testing.assert_allclose(courses.decode_polyline(encode_polyline(points)), points, atol=1e-9)
+
+    def test_repeated_route_is_one_course(self):
+        self.record_run(self.loop, 2000, days_ago=30)
+        self.record_run(self.other, 2100, days_ago=25)
+        self.assertTrue(courses.ensure_ready(self.user))
+
+        # Matched incrementally once courses are built
+        self.record_run(self.loop, 1900, days_ago=20)
+        latest = self.record_run(self.loop, 1950, days_ago=10)
+        self.assertEqual(Course.objects.filter(user=self.user).count(), 2)
+
+        listed = StravaAnalytics(self.user).get_courses()
+        self.assertEqual([course['activities'] for course in listed], [3])
+
+        progression = StravaAnalytics(self.user).get_course_progression(latest.course_id)
+        self.assertEqual([effort['moving_time'] for effort in progression['efforts']], [2000, 1900, 1950])
+        self.assertEqual([effort['fastest_so_far'] for effort in progression['efforts']], [True, True, False])
+
+        # The only activity of a course takes the course with it
+        other = Activity.objects.get(user=self.user, strava_id=2)
+        other.delete()
+        self.assertEqual(Course.objects.filter(user=self.user).count(), 1)
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(f'/api/courses/{latest.course_id}/').status_code, 200)
+        self.assertEqual(self.client.get(f'/api/courses/{latest.course_id + 100}/').status_code, 404)
+
+
+    def course_groups(self):
+        """Activity ids grouped by course, checking each course's route is one of its own"""
+        groups = []
+        for course in Course.objects.filter(user=self.user):
+            members = list(course.activities.values_list('id', 'summary_polyline'))
+            self.assertIn(bytes(course.signature), [
+                courses.route_signature(polyline).astype('<u4').tobytes() for _, polyline in members
+            ])
+            groups.append(sorted(activity_id for activity_id, _ in members))
+        return sorted(groups)
+
+    def test_course_follows_its_first_activity(self):
+        first = self.record_run(self.loop, 2000, days_ago=30)
+        self.assertTrue(courses.ensure_ready(self.user))
+        repeats = [self.record_run(self.loop, 1900 + i, days_ago=20 - i) for i in range(3)]
+
+        # The activity the course was seen in first turns out to be another route
+        before = {field: getattr(first, field) for field in TRACKED_FIELDS}
+        first.summary_polyline = encode_polyline(self.other)
+        first.save()
+        activities_changed(
+            self.user, removed=[dict(before, id=first.id)],
+            added=[dict({field: getattr(first, field) for field in TRACKED_FIELDS}, id=first.id)],
+        )
+        groups = self.course_groups()
+        self.assertEqual(groups, sorted([[first.id], sorted(run.id for run in repeats)]))
+
+        # Deleting the new first activity of the repeated route keeps the rest together
+        repeats[0].delete()
+        groups = self.course_groups()
+        courses.rebuild(self.user)
+        self.assertEqual(groups, self.course_groups())
+        self.assertIn(sorted(run.id for run in repeats[1:]), groups)
+
+
+def strava_activity(strava_id, days_ago=1, **fields):
+    """An /athlete/activities payload entry as Strava sends it"""
+    start_date = (timezone.now() - timedelta(days=days_ago)).replace(microsecond=0)
+    return {
+        'id': strava_id,
+        'name': f'Activity {strava_id}',
+        'type': 'Run',
+        'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'start_date_local': start_date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'timezone': '(GMT+00:00) Europe/London',
+        'utc_offset': 0,
+        'distance': 5000.0 + strava_id,
+        'moving_time': 1500 + strava_id,
+        'elapsed_time': 1600 + strava_id,
+        'average_speed': 3.0,
+        'total_elevation_gain': 20.0,
+        'start_latlng': [51.5, -0.12],
+        'end_latlng': [51.51, -0.13],
+        **fields,
+    }
+
+
+def summary_rows(user):
+    """A user's ActivitySummary totals, for comparing against a rebuild"""
+    return list(ActivitySummary.objects.filter(user=user).order_by('period_type', 'period_start').values_list(
+        'period_type', 'period_start', *rollups.TOTAL_FIELDS
+    ))
+
+
+def record_rows(user):
+    """A user's PersonalRecord rows, for comparing against a rebuild"""
+    return sorted(PersonalRecord.objects.filter(user=user).values_list(
+        'activity_type', 'record', 'value', 'activity_id'
+    ))
+
+
+class SaveActivitiesTests(AnalyticsTestCase):
+    """A synced page is bulk upserted and derived tables see each change once"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('upsert')
+        self.service = StravaService(self.user.strava_profile)
+        rollups.rebuild(self.user)
+        records.rebuild(self.user)
+
+    def assert_derived_match_rebuild(self):
+        incremental = summary_rows(self.user), record_rows(self.user)
+        rollups.rebuild(self.user)
+        records.rebuild(self.user)
+        self.assertEqual(incremental, (summary_rows(self.user), record_rows(self.user)))
+
+    def test_created_and_updated_counts(self):
+        page = [strava_activity(i, days_ago=i) for i in range(1, 4)]
+        self.assertEqual(self.service.save_activities(page), (3, 0))
+
+        page[1] = dict(page[1], name='Renamed', distance=9000.0)
+        self.assertEqual(self.service.save_activities(page + [strava_activity(4)]), (1, 1))
+        self.assertEqual(Activity.objects.get(user=self.user, strava_id=2).distance, 9000.0)
+        self.assert_derived_match_rebuild()
+
+    def test_unchanged_rows_are_skipped(self):
+        page = [strava_activity(i) for i in range(1, 4)]
+        self.service.save_activities(page)
+        before = dict(Activity.objects.values_list('strava_id', 'updated_at'))
+        generation = StravaProfile.objects.get(user=self.user).data_generation
+
+        self.assertEqual(self.service.save_activities(page), (0, 0))
+        self.assertEqual(dict(Activity.objects.values_list('strava_id', 'updated_at')), before)
+        self.assertEqual(StravaProfile.objects.get(user=self.user).data_generation, generation)
+
+    def test_duplicate_id_in_page(self):
+        page = [strava_activity(1, distance=4000.0), strava_activity(1, distance=6000.0)]
+        self.assertEqual(self.service.save_activities(page), (1, 0))
+        self.assertEqual(Activity.objects.get(user=self.user).distance, 6000.0)
+        self.assert_derived_match_rebuild()
+
+    def test_insert_race_is_retried_as_update(self):
+        self.service.save_activities([strava_activity(1)])
+        read = self.service._existing_activities
+        lookups = []
+
+        def stale_first_read(user, strava_ids):
+            # The first lookup misses the row, as if another sync inserted
+            # it between the lookup and the insert
+            lookups.append(strava_ids)
+            return {} if len(lookups) == 1 else read(user, strava_ids)
+
+        with mock.patch.object(self.service, '_existing_activities', side_effect=stale_first_read):
+            self.assertEqual(self.service.save_activities([strava_activity(1, distance=7000.0)]), (0, 1))
+
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(Activity.objects.get(user=self.user).distance, 7000.0)
+        self.assert_derived_match_rebuild()
+
+
+class FakeStrava:
+    """
+    A local /athlete/activities server on a background thread
+
+    Serves `total` activities newest first in pages of the requested size,
+    optionally sleeping a random time per request so that concurrent pages
+    complete out of order, and records every page asked for. Every response
+    reports the requests made so far as its rate-limit usage.
+    """
+
+    def __init__(self, total, max_delay=0.0, full_pages_after=None):
+        """
+        Args:
+            total: Number of activities in the history
+            max_delay: Longest random delay in seconds before answering
+            full_pages_after: Keep serving full pages past the end of the
+                history from this page on, to check that fetching stops
+        """
+        self.total = total
+        self.max_delay = max_delay
+        self.full_pages_after = full_pages_after
+        self.requested = []
+        self._lock = threading.Lock()
+        self._random = random.Random(3)
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                page, per_page = int(query['page'][0]), int(query['per_page'][0])
+                with fake._lock:
+                    fake.requested.append(page)
+                    delay = fake._random.uniform(0, fake.max_delay)
+                time.sleep(delay)
+                with fake._lock:
+
+                    usage = len(fake.requested)
+                body = json.dumps(fake.page(page, per_page)).encode()
+                self.send_response(200)
+                self.send_header('X-RateLimit-Limit', '1000,100000')
+                self.send_header('X-RateLimit-Usage', f'{usage},{usage}')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def page(self, page, per_page):
+        first = (page - 1) * per_page
+        if self.full_pages_after and page >= self.full_pages_after:
+            ids = range(first, first + per_page)
+        else:
+            ids = range(first, min(first + per_page, self.total))
+        return [strava_activity(self.total - i, days_ago=i) for i in ids]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ConcurrentBackfillTests(AnalyticsTestCase):
+    """Pages fetched concurrently from a fake Strava server are saved as a serial sync saves them"""
+
+    PER_PAGE = 5
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('backfill')
+
+    def service(self, fake, user=None):
+        service = StravaService((user or self.user).strava_profile)
+        service.BASE_URL = fake.url
+        return service
+
+    def backfill(self, service, workers=4, queue_depth=2):
+        return ConcurrentBackfill(service, workers=workers, queue_depth=queue_depth, per_page=self.PER_PAGE)
+
+    def record_saves(self, service, backfill, fake, delay=0.0):
+        """Wrap save_activities to note, per page, its first id, the pages fetched ahead and the pages requested so far"""
+        saves = []
+        save = service.save_activities
+
+        def recording_save(batch):
+            waiting = sum(future.done() for future in backfill._pending.values())
+            saves.append((batch[0]['id'], waiting, len(fake.requested)))
+            time.sleep(delay)
+            return save(batch)
+
+        service.save_activities = recording_save
+        return saves
+
+    def test_pages_saved_in_order(self):
+        with FakeStrava(total=43, max_delay=0.05) as fake:
+            service = self.service(fake)
+            backfill = self.backfill(service)
+            saves = self.record_saves(service, backfill, fake)
+            self.assertEqual(backfill.run(), (43, 43))
+
+        self.assertIsNone(backfill.error)
+        self.assertEqual([first_id for first_id, _, _ in saves], list(range(43, 0, -self.PER_PAGE)))
+
+    def test_stops_at_first_short_page(self):
+        # Page 3 is short, but later pages would be full again
+        with FakeStrava(total=13, full_pages_after=4) as fake:
+            backfill = self.backfill(self.service(fake), workers=3)
+            self.assertEqual(backfill.run(), (13, 13))
+
+        self.assertEqual(Activity.objects.filter(user=self.user).count(), 13)
+        # Only pages already dispatched when page 3 arrived (at most three in
+        # flight and two fetched ahead) go past it
+        self.assertLessEqual(max(fake.requested), 3 + 3 + 2 - 1)
+
+    def test_queue_stays_bounded(self):
+        queue_depth, workers = 2, 4
+        with FakeStrava(total=100) as fake:
+            service = self.service(fake)
+            backfill = self.backfill(service, workers=workers, queue_depth=queue_depth)
+            saves = self.record_saves(service, backfill, fake, delay=0.02)
+            backfill.run()
+
+        self.assertEqual(len(saves), 20)
+        # Requested but not yet saved: the page being saved, pages in flight
+        # and pages fetched ahead
+        ahead = [requested - saved for saved, (_, _, requested) in enumerate(saves)]
+        self.assertLessEqual(max(ahead), workers + queue_depth)
+        self.assertLess(max(waiting for _, waiting, _ in saves), workers + queue_depth)
+
+    def test_pool_threads_only_do_http(self):
+        threads = set()
+        ensure_connection = BaseDatabaseWrapper.ensure_connection
+
+        def recording_ensure_connection(wrapper):
+            threads.add(threading.current_thread().name)
+            return ensure_connection(wrapper)
+
+        with FakeStrava(total=43, max_delay=0.02) as fake, \
+                mock.patch.object(BaseDatabaseWrapper, 'ensure_connection', recording_ensure_connection):
+            backfill = self.backfill(self.service(fake))
+            self.assertEqual(backfill.run(), (43, 43))
+
+        self.assertEqual(threads, {threading.current_thread().name})
+        # The real governor took a token per request and then followed Strava's usage headers
+        budget = StravaRateLimit.objects.get(key=governor.key)
+        self.assertEqual(budget.short_limit, 1000)
+        self.assertIn(budget.short_usage, range(1, len(fake.requested) + 1))
+
+    def test_exhausted_budget_stops_before_requesting(self):
+        governor.record({'X-RateLimit-Limit': '100,1000', 'X-RateLimit-Usage': '0,1000'})
+        with FakeStrava(total=43) as fake:
+            backfill = self.backfill(self.service(fake))
+            self.assertEqual(backfill.run(), (0, 0))
+
+        self.assertIsInstance(backfill.error, RateLimitExceeded)
+        self.assertEqual(fake.requested, [])
+
+    def test_same_result_as_serial_sync(self):
+        serial_user = create_strava_user('serial', strava_user_id=2)
+        with FakeStrava(total=37, max_delay=0.02) as fake:
+            serial = self.service(fake, serial_user)._sync_pages(per_page=self.PER_PAGE)
+            concurrent = self.backfill(self.service(fake), workers=3).run()
+
+        self.assertEqual(serial, (37, 37, True))
+        self.assertEqual(concurrent, serial[:2])
+        self.assertEqual(
+            sorted(Activity.objects.filter(user=self.user).values_list('strava_id', 'distance')),
+            sorted(Activity.objects.filter(user=serial_user).values_list('strava_id', 'distance')),
+        )
+
+
+class RateLimitGovernorTests(TestCase):
+    """The shared budget follows Strava's headers and both of its windows"""
+
+    def setUp(self):
+        self.now = datetime(2026, 3, 2, 10, 7, tzinfo=dt_timezone.utc)
+        clock = mock.patch('activities.rate_limit.timezone.now', side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.governor = RateLimitGovernor(key='test', max_wait=3600)
+        self.governor.record({'X-RateLimit-Limit': '3,5', 'X-RateLimit-Usage': '0,0'})
+
+    def take(self, count):
+        return [self.governor.try_acquire() for _ in range(count)]
+
+    def test_short_window(self):
+        self.assertEqual(self.take(4), [True, True, True, False])
+        self.assertEqual(self.governor.seconds_until_available(), 8 * 60)
+
+        # The 15-minute window resets on the quarter hour
+        self.now = self.now.replace(minute=15)
+        self.assertEqual(self.take(1), [True])
+
+    def test_daily_window(self):
+        self.take(3)
+        self.now = self.now.replace(minute=15)
+        self.assertEqual(self.take(3), [True, True, False])
+        self.assertEqual(self.governor.seconds_until_available(), (13 * 60 + 45) * 60)
+
+        # A new short window does not help once the day is used up
+        self.now = self.now.replace(minute=30)
+        self.assertEqual(self.take(1), [False])
+
+        self.now = datetime(2026, 3, 3, 0, 0, 1, tzinfo=dt_timezone.utc)
+        self.assertEqual(self.take(1), [True])
+
+    def test_record_overrides_local_count(self):
+        self.take(1)
+        self.governor.record({'X-RateLimit-Limit': '3,5', 'X-RateLimit-Usage': '3,3'})
+        self.assertEqual(self.take(1), [False])
+
+        # Responses without the headers leave the budget alone
+        self.governor.record({})
+        self.governor.record({'X-RateLimit-Limit': 'n/a', 'X-RateLimit-Usage': '0,0'})
+        budget = StravaRateLimit.objects.get(key='test')
+        self.assertEqual((budget.short_usage, budget.long_usage), (3, 3))
+
+    def test_exhaust_after_429(self):
+        self.governor.exhaust()
+        self.assertEqual(self.take(1), [False])
+
+    def test_acquire_waits_for_reset(self):
+        self.take(3)
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            self.now += timedelta(seconds=seconds)
+
+        with mock.patch('activities.rate_limit.time.sleep', side_effect=sleep):
+            self.governor.acquire()
+        self.assertEqual(sleeps, [8 * 60])
+        self.assertEqual(StravaRateLimit.objects.get(key='test').long_usage, 4)
+
+    def test_acquire_gives_up_past_max_wait(self):
+        self.take(3)
+        self.now = self.now.replace(minute=15)
+        self.take(2)
+        with mock.patch('activities.rate_limit.time.sleep') as sleep:
+            with self.assertRaises(RateLimitExceeded):
+                self.governor.acquire()
+        sleep.assert_not_called()
+
+
+class StatusServer:
+    """A local keep-alive HTTP server answering with a scripted list of statuses, then 200s"""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.hits = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake.hits += 1
+                status = fake.statuses.pop(0) if fake.statuses else 200
+                body = b'{}'
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@override_settings(STRAVA_HTTP_BACKOFF=0, STRAVA_HTTP_RETRIES=2)
+class HTTPClientTests(TestCase):
+    """The shared session keeps connections alive and retries server errors"""
+
+    def stats_since(self, before):
+        after = http_client.connection_stats()
+        return {name: after[name] - before[name] for name in before}
+
+    def test_connections_are_reused(self):
+        session = http_client._build_session()
+        before = http_client.connection_stats()
+        with StatusServer() as server:
+            for _ in range(5):
+                self.assertEqual(session.get(server.url).status_code, 200)
+        session.close()
+
+        self.assertEqual(self.stats_since(before), {'requests': 5, 'new_connections': 1, 'reused_connections': 4})
+
+    def test_server_errors_are_retried(self):
+        session = http_client._build_session()
+        before = http_client.connection_stats()
+        with StatusServer([503, 502]) as server:
+            self.assertEqual(session.get(server.url).status_code, 200)
+            self.assertEqual(server.hits, 3)
+
+            # Once the retries are used up the last error is returned
+            server.statuses = [500, 500, 500]
+            self.assertEqual(session.get(server.url).status_code, 500)
+            self.assertEqual(server.hits, 6)
+        session.close()
+
+        self.assertEqual(self.stats_since(before)['requests'], 2)
+
+    def test_default_timeout(self):
+        adapter = http_client._build_session().get_adapter('https://www.strava.com/')
+        self.assertEqual(adapter.timeout, (5, 30))
+        self.assertEqual(adapter.max_retries.total, 2)
+
+
+class IncrementalSyncTests(AnalyticsTestCase):
+    """The sync cursor only moves forward after a sync that fetched every page"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('cursor')
+        self.history = [strava_activity(i, days_ago=30 - i) for i in range(1, 6)]
+        self.calls = []
+
+    def get_activities(self, page=1, per_page=200, after=None, before=None):
+        """Serve self.history oldest first the way /athlete/activities filters on after="""
+        self.calls.append({'page': page, 'after': after})
+        matching = [
+            activity for activity in self.history
+            if after is None or StravaService._parse_datetime(activity['start_date']).timestamp() > after
+        ]
+        return matching[(page - 1) * per_page:page * per_page]
+
+    def sync(self, **kwargs):
+        profile = StravaProfile.objects.get(user=self.user)
+        service = StravaService(profile)
+        with mock.patch.object(service, 'get_activities', side_effect=self.get_activities):
+            result = service.sync_activities(**kwargs)
+        profile.refresh_from_db()
+        return result, profile, service
+
+    def test_cursor_advances(self):
+        (total, new), profile, _ = self.sync()
+        self.assertEqual((total, new), (5, 5))
+        self.assertEqual(self.calls[0]['after'], None)
+        latest = Activity.objects.get(user=self.user, strava_id=5).start_date
+        self.assertEqual(profile.last_activity_start, latest)
+        self.assertIsNotNone(profile.last_synced_at)
+
+        self.history.append(strava_activity(6, days_ago=2))
+        self.calls.clear()
+        (total, new), profile, _ = self.sync()
+        # The cursor activity itself is fetched again, then the new one
+        self.assertEqual(self.calls[0]['after'], int(latest.timestamp()) - 1)
+        self.assertEqual((total, new), (2, 1))
+        self.assertEqual(profile.last_activity_start, Activity.objects.get(user=self.user, strava_id=6).start_date)
+
+    def test_cursor_kept_when_sync_fails(self):
+        _, profile, _ = self.sync()
+        cursor, synced_at = profile.last_activity_start, profile.last_synced_at
+
+        self.history.append(strava_activity(6, days_ago=2))
+        self.get_activities = mock.Mock(side_effect=requests.exceptions.ConnectionError('offline'))
+        _, profile, service = self.sync()
+
+        self.assertIsInstance(service.last_error, requests.exceptions.ConnectionError)
+        self.assertEqual((profile.last_activity_start, profile.last_synced_at), (cursor, synced_at))
+
+    def test_limited_full_sync_leaves_cursor_unset(self):
+        (total, _), profile, _ = self.sync(limit=2)
+        self.assertEqual(total, 2)
+        self.assertIsNone(profile.last_activity_start)
+
+
+class SyncJobQueueTests(TestCase):
+    """A profile has at most one active job and each job is claimed by one worker"""
+
+    def setUp(self):
+        self.user = create_strava_user('queue')
+        self.profile = self.user.strava_profile
+
+    def test_enqueue_reuses_active_job(self):
+        job, created = sync_jobs.enqueue_sync(self.profile)
+        self.assertTrue(created)
+        self.assertEqual(sync_jobs.enqueue_sync(self.profile), (job, False))
+
+        # A full resync upgrades the queued job rather than adding one
+        upgraded, created = sync_jobs.enqueue_sync(self.profile, full=True)
+        self.assertEqual((upgraded.id, upgraded.mode, created), (job.id, SyncJob.MODE_FULL, False))
+        self.assertEqual(SyncJob.objects.count(), 1)
+
+        SyncJob.objects.filter(id=job.id).update(status=SyncJob.STATUS_SUCCEEDED)
+        next_job, created = sync_jobs.enqueue_sync(self.profile)
+        self.assertTrue(created)
+        self.assertNotEqual(next_job.id, job.id)
+
+    def test_running_job_is_not_upgraded(self):
+        job, _ = sync_jobs.enqueue_sync(self.profile)
+        SyncJob.objects.filter(id=job.id).update(status=SyncJob.STATUS_RUNNING)
+        active, created = sync_jobs.enqueue_sync(self.profile, full=True)
+        self.assertEqual((active.id, active.mode, created), (job.id, SyncJob.MODE_INCREMENTAL, False))
+
+    def test_enqueue_after_conflicting_job_finished(self):
+        create = SyncJob.objects.create
+        attempts = []
+
+        def lose_first_insert(**fields):
+            # The first insert loses to a job queued concurrently, which has
+            # finished by the time the active job is looked up again
+            attempts.append(fields)
+            if len(attempts) == 1:
+                raise IntegrityError('one_active_sync_job_per_profile')
+            return create(**fields)
+
+        with mock.patch.object(SyncJob.objects, 'create', side_effect=lose_first_insert):
+            job, created = sync_jobs.enqueue_sync(self.profile)
+        self.assertTrue(created)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(SyncJob.objects.get().id, job.id)
+
+    def test_claim_is_exclusive(self):
+        other = create_strava_user('queue-other', strava_user_id=2).strava_profile
+        first, _ = sync_jobs.enqueue_sync(self.profile)
+        second, _ = sync_jobs.enqueue_sync(other)
+        SyncJob.objects.filter(id=second.id).update(created_at=first.created_at + timedelta(seconds=1))
+
+        claimed = sync_jobs.claim_next_job('worker-a')
+        self.assertEqual((claimed.id, claimed.status, claimed.worker), (first.id, SyncJob.STATUS_RUNNING, 'worker-a'))
+        self.assertEqual(sync_jobs.claim_next_job('worker-b').id, second.id)
+        self.assertIsNone(sync_jobs.claim_next_job('worker-c'))
+
+    def test_claim_skips_job_taken_by_another_worker(self):
+        first, _ = sync_jobs.enqueue_sync(self.profile)
+        claim = SyncJob.objects.filter(id=first.id, status=SyncJob.STATUS_QUEUED)
+        raced = []
+
+        def other_worker_first(execute, sql, params, many, context):
+            # Another worker claims the job between the candidate SELECT and this UPDATE
+            if sql.startswith('UPDATE') and not raced:
+                raced.append(True)
+                claim.update(status=SyncJob.STATUS_RUNNING, worker='worker-b')
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(other_worker_first):
+            self.assertIsNone(sync_jobs.claim_next_job('worker-a'))
+        self.assertTrue(raced)
+        self.assertEqual(SyncJob.objects.get(id=first.id).worker, 'worker-b')
+
+
+@mock.patch('activities.fleet.connections', mock.Mock())
+class FleetSyncTests(TestCase):
+    """Fleet syncs refresh tokens that are about to expire before syncing"""
+
+    def setUp(self):
+        self.user = create_strava_user('fleet')
+        self.profile = StravaProfile.objects.select_related('user').get(user=self.user)
+
+    def token_response(self, status=200):
+        response = mock.Mock(status_code=status)
+        response.json.return_value = {
+            'access_token': 'new-token', 'refresh_token': 'new-refresh',
+            'expires_at': int((timezone.now() + timedelta(hours=6)).timestamp()),
+        }
+        if status >= 400:
+            response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=response)
+        return response
+
+    def sync_profile(self, token_status=200):
+        session = mock.Mock()
+        session.post.return_value = self.token_response(token_status)
+        with mock.patch('activities.strava_service.get_session', return_value=session), \
+                mock.patch.object(StravaService, 'sync_activities', return_value=(4, 1)) as sync:
+            result = fleet.sync_profile(self.profile)
+        return result, session, sync
+
+    def test_expiring_token_is_refreshed(self):
+        self.profile.expires_at = timezone.now() + timedelta(minutes=5)
+        result, session, sync = self.sync_profile()
+
+        self.assertEqual((result.processed, result.new, result.error), (4, 1, ''))
+        self.assertEqual(session.post.call_args.kwargs['data']['refresh_token'], 'refresh')
+        sync.assert_called_once()
+        stored = StravaProfile.objects.get(user=self.user)
+        self.assertEqual((stored.access_token, stored.refresh_token), ('new-token', 'new-refresh'))
+        self.assertGreater(stored.expires_at, timezone.now() + timedelta(hours=5))
+
+    def test_fresh_token_is_kept(self):
+        result, session, sync = self.sync_profile()
+        session.post.assert_not_called()
+        sync.assert_called_once()
+        self.assertEqual(result.error, '')
+
+    def test_failed_refresh_skips_sync(self):
+        self.profile.expires_at = timezone.now() - timedelta(minutes=1)
+        result, _, sync = self.sync_profile(token_status=400)
+        sync.assert_not_called()
+        self.assertEqual(result.error, 'Failed to refresh access token')
+        self.assertEqual(StravaProfile.objects.get(user=self.user).access_token, 'token')
+
+    def test_fleet_syncs_every_profile(self):
+        profiles = [self.profile, create_strava_user('another', strava_user_id=2).strava_profile]
+        with mock.patch.object(StravaService, 'sync_activities', return_value=(2, 2)):
+            results, _ = fleet.sync_fleet(user_workers=2, profiles=profiles)
+        self.assertEqual([(result.username, result.processed) for result in results], [('another', 2), ('fleet', 2)])
+
+
+class RollupTests(AnalyticsTestCase):
+    """Summary buckets maintained on ingest match a rebuild from the activities"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('rollup')
+        self.service = StravaService(self.user.strava_profile)
+        self.assertTrue(rollups.ensure_ready(self.user))
+
+    def test_incremental_matches_rebuild(self):
+        self.service.save_activities([
+            strava_activity(i, days_ago=i * 9, type=('Run', 'Ride', 'Swim', 'Hike')[i % 4],
+                            calories=300 if i % 2 else None, average_heartrate=150.0 if i % 3 else None)
+            for i in range(1, 25)
+        ])
+        # Moved to another week and type, changed in place, and deleted
+        self.service.save_activities([
+            strava_activity(3, days_ago=1, type='Ride'),
+            strava_activity(4, days_ago=36, distance=12345.0, average_speed=None),
+        ])
+        Activity.objects.get(user=self.user, strava_id=5).delete()
+        self.assertTrue(ActivitySummary.objects.filter(user=self.user, period_type='day').exists())
+
+        incremental = summary_rows(self.user)
+        rollups.rebuild(self.user)
+        self.assertEqual(len(incremental), len(summary_rows(self.user)))
+        for got, expected in zip(incremental, summary_rows(self.user)):
+            self.assertEqual(got[:2], expected[:2])
+            np.testing.assert_allclose(got[2:], expected[2:], err_msg=str(got[:2]))
+
+    def test_empty_buckets_are_removed(self):
+        self.service.save_activities([strava_activity(1, days_ago=400)])
+        self.assertEqual(ActivitySummary.objects.filter(user=self.user).count(), 4)
+        Activity.objects.get(user=self.user).delete()
+        self.assertFalse(ActivitySummary.objects.filter(user=self.user).exists())
+
+    def test_queryset_delete_updates_derived_data_once(self):
+        self.service.save_activities([strava_activity(i, days_ago=i * 5) for i in range(1, 11)])
+        records.rebuild(self.user)
+
+        with mock.patch('activities.ingest.activities_changed', wraps=activities_changed) as changed:
+            deleted, _ = Activity.objects.filter(user=self.user, strava_id__lte=6).delete()
+        self.assertEqual(deleted, 6)
+        changed.assert_called_once()
+        self.assertEqual(len(changed.call_args.kwargs['removed']), 6)
+
+        incremental = summary_rows(self.user), record_rows(self.user)
+        rollups.rebuild(self.user)
+        records.rebuild(self.user)
+        self.assertEqual(incremental, (summary_rows(self.user), record_rows(self.user)))
+
+    def test_deleting_the_owner_skips_derived_data(self):
+        def delete_user(username, count):
+            user = create_strava_user(username, strava_user_id=count)
+            StravaService(user.strava_profile).save_activities([strava_activity(i) for i in range(1, count + 1)])
+            with mock.patch('activities.ingest.activities_changed') as changed, CaptureQueriesContext(connection) as queries:
+                user.delete()
+            changed.assert_not_called()
+            self.assertFalse(Activity.objects.filter(user_id=user.id).exists())
+            self.assertFalse(ActivitySummary.objects.filter(user_id=user.id).exists())
+            return len(queries)
+
+        # The cascade costs the same whatever the number of activities
+        self.assertEqual(delete_user('small', 5), delete_user('large', 50))
+
+
+class AnalyticsCacheTests(AnalyticsTestCase):
+    """Analytics results are cached until the user's data generation moves"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('cached')
+        self.service = StravaService(self.user.strava_profile)
+        self.service.save_activities([strava_activity(i, days_ago=i) for i in range(1, 4)])
+
+    def stats_since(self, before):
+        after = cache_stats()
+        return after['hits'] - before['hits'], after['misses'] - before['misses']
+
+    def test_hit_and_miss(self):
+        before = cache_stats()
+        first = StravaAnalytics(self.user).get_day_of_week_stats(activity_type='Run')
+        # Only the generation is read on a hit
+        with self.assertNumQueries(1):
+            second = StravaAnalytics(self.user).get_day_of_week_stats(activity_type='Run')
+        self.assertEqual(first, second)
+        self.assertEqual(self.stats_since(before), (1, 1))
+
+        # Different arguments are cached separately
+        StravaAnalytics(self.user).get_day_of_week_stats(activity_type='Ride')
+        self.assertEqual(self.stats_since(before), (1, 2))
+
+    def test_ingest_bumps_generation(self):
+        generation = get_generation(self.user)
+        self.assertEqual(sum(day['avg_activities'] for day in StravaAnalytics(self.user).get_day_of_week_stats()), 3)
+
+        self.service.save_activities([strava_activity(4, days_ago=4)])
+        self.assertEqual(get_generation(self.user), generation + 1)
+        before = cache_stats()
+        self.assertEqual(sum(day['avg_activities'] for day in StravaAnalytics(self.user).get_day_of_week_stats()), 4)
+        self.assertEqual(self.stats_since(before), (0, 1))
+
+        Activity.objects.get(user=self.user, strava_id=4).delete()
+        self.assertEqual(get_generation(self.user), generation + 2)
+
+    def test_users_do_not_share_entries(self):
+        other = create_strava_user('uncached', strava_user_id=2)
+        StravaAnalytics(self.user).get_day_of_week_stats()
+        self.assertEqual(StravaAnalytics(other).get_day_of_week_stats(), [])
+
+
+class KeysetPaginationTests(AnalyticsTestCase):
+    """Activity pages follow (start_date, id) cursors without gaps or repeats"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('pages')
+        self.start_date = timezone.now().replace(microsecond=0) - timedelta(days=1)
+        # Several activities share a start time, so the id has to break ties
+        for i in range(11):
+            Activity.objects.create(
+                user=self.user, strava_id=i + 1, name=f'Activity {i}', activity_type='Run' if i % 3 else 'Ride',
+                start_date=self.start_date - timedelta(hours=i // 4), distance=1000, moving_time=600, elapsed_time=600,
+            )
+        self.client.force_login(self.user)
+
+    def test_cursor_round_trip(self):
+        cursor = pagination.encode_cursor(self.start_date, 42)
+        self.assertEqual(pagination.decode_cursor(cursor), (self.start_date, 42))
+        for bad in ('not-a-cursor', pagination.encode_cursor(self.start_date, 1)[:-3]):
+            with self.assertRaises(pagination.InvalidCursor):
+                pagination.decode_cursor(bad)
+
+    def test_ties_are_broken_by_id(self):
+        expected = list(Activity.objects.filter(user=self.user).order_by('-start_date', '-id').values_list('id', flat=True))
+        seen, cursor = [], None
+        while True:
+            rows, cursor = pagination.keyset_page(Activity.objects.filter(user=self.user), cursor, limit=3)
+            seen.extend(row.id for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+
+    def fetch_all(self, query=''):
+        ids, cursor, pages = [], '', 0
+        while True:
+            response = self.client.get(f'/api/activities/?limit=4&{query}&cursor={cursor}').json()
+            ids.extend(activity['id'] for activity in response['activities'])
+            pages += 1
+            cursor = response['next_cursor']
+            if not cursor:
+                return ids, pages, response['total']
+
+    def test_api_pages_cover_filtered_list(self):
+        ids, pages, total = self.fetch_all('type=Run')
+        expected = Activity.objects.filter(user=self.user, activity_type='Run').order_by('-start_date', '-id')
+        self.assertEqual(ids, list(expected.values_list('id', flat=True)))
+        self.assertEqual((pages, total), (2, 7))
+
+    def test_new_activities_do_not_shift_pages(self):
+        first = self.client.get('/api/activities/?limit=4').json()
+        Activity.objects.create(
+            user=self.user, strava_id=100, name='New', activity_type='Run', start_date=timezone.now(),
+            distance=1000, moving_time=600, elapsed_time=600,
+        )
+        second = self.client.get(f"/api/activities/?limit=4&cursor={first['next_cursor']}").json()
+        first_ids = [activity['id'] for activity in first['activities']]
+        second_ids = [activity['id'] for activity in second['activities']]
+        self.assertFalse(set(first_ids) & set(second_ids))
+        self.assertEqual(second_ids[0], Activity.objects.filter(user=self.user).order_by('-start_date', '-id')[5].id)
+
+    def test_bad_cursor_rejected(self):
+        self.assertEqual(self.client.get('/api/activities/?cursor=garbage').status_code, 400)
+
+
+class FacetTests(AnalyticsTestCase):
+    """Facet counts agree with the activities, from rollups or from a grouped query"""
+
+    def setUp(self):
+        super().setUp()
+        self.rollup_user = create_strava_user('facets')
+        StravaService(self.rollup_user.strava_profile).save_activities([
+            strava_activity(i, days_ago=i * 23, type=('Run', 'Ride', 'Run', 'Swim')[i % 4]) for i in range(1, 30)
+        ])
+        self.raw_user = User.objects.create_user('facets-raw')
+        for activity in Activity.objects.filter(user=self.rollup_user):
+            activity.pk, activity.user = None, self.raw_user
+            activity.save()
+
+    def expected(self, user):
+        activities = Activity.objects.filter(user=user)
+        years = {}
+        for year, month in activities.values_list('local_year', 'local_month'):
+            years.setdefault(year, Counter())[month] += 1
+        return years, Counter(activities.values_list('activity_type', flat=True))
+
+    def test_counts(self):
+        for user in (self.rollup_user, self.raw_user):
+            facets = StravaAnalytics(user).get_facets()
+            years, types = self.expected(user)
+
+            self.assertEqual(facets['total'], 29)
+            self.assertEqual([year['year'] for year in facets['years']], sorted(years, reverse=True))
+            for year in facets['years']:
+                self.assertEqual({month['month']: month['count'] for month in year['months']}, years[year['year']])
+                self.assertEqual(year['count'], sum(years[year['year']].values()))
+            self.assertEqual({facet['type']: facet['count'] for facet in facets['types']}, types)
+            self.assertEqual(facets['types'][0]['type'], 'Run')
+
+    def test_endpoint(self):
+        self.client.force_login(self.raw_user)
+        self.assertEqual(self.client.get('/api/facets/').json()['total'], 29)
+
+
+class PersonalRecordTests(AnalyticsTestCase):
+    """Records kept on ingest match a rebuild without rescanning the history"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('records')
+        self.service = StravaService(self.user.strava_profile)
+        self.assertTrue(records.ensure_ready(self.user))
+        self.history = [
+            strava_activity(i, days_ago=i, type='Run' if i % 3 else 'Ride', distance=3000.0 + i * 1000,
+                            moving_time=900 + i * 420, average_speed=2.5 + (i % 5) * 0.3,
+                            total_elevation_gain=None if i % 4 == 0 else 10.0 * i)
+            for i in range(1, 31)
+        ]
+        self.service.save_activities(self.history)
+
+    def assert_matches_rebuild(self):
+        incremental = record_rows(self.user)
+        records.rebuild(self.user)
+        rebuilt = record_rows(self.user)
+        self.assertEqual([row[:2] + row[3:] for row in incremental], [row[:2] + row[3:] for row in rebuilt])
+        np.testing.assert_allclose([row[2] for row in incremental], [row[2] for row in rebuilt])
+
+    def holder(self, scope, name):
+        return PersonalRecord.objects.get(user=self.user, activity_type=scope, record=name).activity
+
+    def test_ties_go_to_the_earliest_activity(self):
+        # The later activity is seen first, then an earlier one ties it
+        self.service.save_activities([strava_activity(101, days_ago=5, distance=50000.0)])
+        self.service.save_activities([strava_activity(102, days_ago=40, distance=50000.0)])
+        self.assertEqual(self.holder(records.ALL_TYPES, 'longest_distance').strava_id, 102)
+        self.assert_matches_rebuild()
+
+        # On the same start date the lower id holds it, whichever is saved last
+        self.service.save_activities([strava_activity(103, days_ago=50, moving_time=99999)])
+        self.service.save_activities([strava_activity(104, days_ago=50, moving_time=99999)])
+        first = Activity.objects.get(strava_id=103)
+        self.assertEqual(self.holder(records.ALL_TYPES, 'longest_time'), first)
+        self.assert_matches_rebuild()
+
+        # Once the holder is gone the record passes to the other tied activity
+        Activity.objects.get(strava_id=102).delete()
+        self.assertEqual(self.holder(records.ALL_TYPES, 'longest_distance').strava_id, 101)
+        self.assert_matches_rebuild()
+
+    def test_demoted_and_deleted_holders(self):
+        longest = self.holder(records.ALL_TYPES, 'longest_distance')
+        fastest_10k = self.holder('Run', 'best_10k')
+
+        with mock.patch('activities.records.rebuild') as rebuild:
+            # The longest activity turns out shorter, the fastest 10k is
+            # deleted, and a new activity sets a record of its own
+            self.service.save_activities([
+                dict(self.history[longest.strava_id - 1], distance=4000.0),
+                strava_activity(99, average_speed=9.0),
+            ])
+            Activity.objects.get(id=fastest_10k.id).delete()
+        rebuild.assert_not_called()
+
+        self.assertNotEqual(self.holder(records.ALL_TYPES, 'longest_distance').id, longest.id)
+        self.assertEqual(self.holder(records.ALL_TYPES, 'fastest_speed').strava_id, 99)
+        self.assert_matches_rebuild()
+
+    def test_record_dropped_with_last_qualifying_activity(self):
+        marathon = strava_activity(100, type='Run', distance=42500.0, moving_time=12000)
+        self.service.save_activities([marathon])
+        self.assertEqual(self.holder('Run', 'best_marathon').strava_id, 100)
+
+        self.service.save_activities([dict(marathon, distance=20000.0)])
+        self.assertFalse(PersonalRecord.objects.filter(user=self.user, record='best_marathon').exists())
+        self.assert_matches_rebuild()
+
+    def test_ties_go_to_the_earlier_activity(self):
+        self.service.save_activities([
+            strava_activity(200, days_ago=50, type='Swim', distance=1000.0),
+            strava_activity(201, days_ago=40, type='Swim', distance=1000.0),
+        ])
+        self.assertEqual(records.best_activity(self.user, 'Swim', 'longest_distance')[1],
+                         Activity.objects.get(user=self.user, strava_id=200).id)
+
+
+class SQLTrendTests(AnalyticsTestCase):
+    """Trends grouped in SQL have the shape and values of the pandas versions they replaced"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('trends')
+        rng = np.random.default_rng(5)
+        for i in range(80):
+            start_date = timezone.now() - timedelta(days=int(rng.integers(0, 400)), hours=int(rng.integers(0, 24)))
+            Activity.objects.create(
+                user=self.user, strava_id=i + 1, name=f'Activity {i}', activity_type=('Run', 'Ride')[i % 2],
+                start_date=start_date, distance=float(rng.uniform(1000, 40000)),
+                moving_time=int(rng.integers(600, 9000)), elapsed_time=9000,
+                average_speed=None if i % 7 == 0 else float(rng.uniform(2, 9)),
+                calories=None if i % 5 == 0 else int(rng.integers(100, 900)), total_elevation_gain=0.0,
+            )
+        self.activities = Activity.objects.filter(user=self.user)
+
+    def assert_rows_equal(self, got, expected):
+        self.assertEqual(len(got), len(expected))
+        for got_row, expected_row in zip(got, expected):
+            self.assertEqual(set(got_row), set(expected_row))
+            for field, value in expected_row.items():
+                if isinstance(value, str):
+                    self.assertEqual(got_row[field], value, field)
+                else:
+                    self.assertAlmostEqual(got_row[field], float(value), places=6, msg=field)
+
+    def test_monthly_trends(self):
+        self.assert_rows_equal(
+            StravaAnalytics(self.user).get_monthly_trends(), legacy_monthly_trends(self.activities)
+        )
+
+    def test_day_of_week_stats(self):
+        expected = legacy_day_of_week_stats(self.activities)
+        for row in expected:
+            row['day'] = str(row['day'])
+        self.assert_rows_equal(StravaAnalytics(self.user).get_day_of_week_stats(), expected)
+
+    def test_dataframe_columns(self):
+        frame = StravaAnalytics(self.user).get_activities_dataframe()
+        self.assertEqual(list(frame.columns), list(legacy_dataframe(self.activities).columns))
+
+
+class DerivedColumnTests(AnalyticsTestCase):
+    """Columns derived at ingest follow edits to the fields they come from"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_strava_user('derived')
+
+    def test_local_date_follows_start_time(self):
+        start_date = datetime(2026, 1, 4, 23, 30, tzinfo=dt_timezone.utc)
+        activity = Activity.objects.create(
+            user=self.user, strava_id=1, name='Run', activity_type='Run', start_date=start_date,
+            distance=5000, moving_time=1500, elapsed_time=1500,
+        )
+        self.assertEqual((activity.local_date, activity.iso_week, activity.weekday), (date(2026, 1, 4), 1, 7))
+
+        # Edited to start in a time zone where it is already Monday
+        activity.start_date_local = start_date + timedelta(hours=2)
+        activity.timezone_name = '(GMT+02:00) Europe/Athens'
+        activity.save()
+        activity.refresh_from_db()
+        self.assertEqual((activity.local_date, activity.iso_week, activity.weekday), (date(2026, 1, 5), 2, 1))
+
+        activity.start_date = start_date - timedelta(days=40)
+        activity.start_date_local = None
+        activity.save()
+        activity.refresh_from_db()
+        self.assertEqual((activity.local_date, activity.local_year, activity.local_month), (date(2025, 11, 25), 2025, 11))
+
+    def test_geohash_follows_coordinates(self):
+        activity = Activity.objects.create(
+            user=self.user, strava_id=1, name='Ride', activity_type='Ride', start_date=timezone.now(),
+            distance=1, moving_time=1, elapsed_time=1, start_latitude=57.64911, start_longitude=10.40744,
+        )
+        self.assertEqual(activity.start_geohash, 'u4pruydq')
+
+        activity.start_latitude, activity.start_longitude = 51.5, -0.12
+        activity.end_latitude, activity.end_longitude = 57.64911, 10.40744
+        activity.save()
+        activity.refresh_from_db()
+        self.assertEqual((activity.start_geohash, activity.end_geohash), (geo.encode_geohash(51.5, -0.12), 'u4pruydq'))
+
+        activity.start_latitude = activity.start_longitude = None
+        activity.save()
+        activity.refresh_from_db()
+        self.assertEqual(activity.start_geohash, '')
+
+    def test_bulk_update_moves_geohash(self):
+        service = StravaService(self.user.strava_profile)
+        service.save_activities([strava_activity(1)])
+        service.save_activities([strava_activity(1, start_latlng=[57.64911, 10.40744])])
+        activity = Activity.objects.get(user=self.user)
+        self.assertEqual((activity.start_latitude, activity.start_geohash), (57.64911, 'u4pruydq'))
+        self.assertEqual(StravaAnalytics(self.user).get_nearby_activities(57.64911, 10.40744)[0]['id'], activity.id)
+
+    def test_bulk_update_moves_local_date(self):
+        service = StravaService(self.user.strava_profile)
+        service.save_activities([strava_activity(1, days_ago=10)])
+        service.save_activities([strava_activity(1, days_ago=3)])
+        activity = Activity.objects.get(user=self.user)
+        self.assertEqual(activity.local_date, activity.start_date.date())
@@ -0,0 +1,251 @@
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+from django.db import transaction
+
+from .analytics_cache import bump_generation
+from .models import Activity, DailyTrainingLoad, StravaProfile
+
+
+# Time constants in days of the exponentially weighted load averages:
+# fitness (chronic training load) and fatigue (acute training load)
+FITNESS_DAYS = 42
+FATIGUE_DAYS = 7
+
+# Activity fields the stress scores are computed from
+SOURCE_FIELDS = ['start_date', 'local_date', 'moving_time', 'average_watts', 'average_heartrate']
+
+# Loads this close to zero are left over from removed activities
+EPSILON = 1e-6
+
+
+def stress_score(row, ftp=None, threshold_heartrate=None):
+    """
+    Training stress of one activity, where an hour at threshold scores 100
+
+    Scored from power (TSS) when the activity has power and an FTP is set,
+    otherwise from heart rate (hrTSS) against the threshold heart rate. The
+    average power stands in for normalized power, which is not synced.
+
+    Args:
+        row: Field dict with SOURCE_FIELDS
+        ftp: Functional threshold power in watts
+        threshold_heartrate: Lactate threshold heart rate in bpm
+
+    Returns:
+        float: The score, or None if the activity cannot be scored
+    """
+    if row['average_watts'] and ftp:
+        intensity = row['average_watts'] / ftp
+    elif row['average_heartrate'] and threshold_heartrate:
+        intensity = row['average_heartrate'] / threshold_heartrate
+    else:
+        return None
+    return (row['moving_time'] or 0) / 3600 * intensity ** 2 * 100
+
+
+def _day(row):
+    """Return the date an activity's load counts on (its local start date)"""
+    if row.get('local_date') is not None:
+        return row['local_date']
+    return row['start_date'].date()
+
+
+def _deltas(removed, added, ftp, threshold_heartrate):
+    """Sum the signed stress scores of activity rows per day"""
+    deltas = defaultdict(float)
+    for sign, rows in ((-1, removed), (1, added)):
+        for row in rows:
+            score = stress_score(row, ftp, threshold_heartrate)
+            if score is not None:
+                deltas[_day(row)] += sign * score
+    return deltas
+
+
+def _thresholds(user):
+    """Return (ftp, threshold heart rate, ready) of a user, or None without a profile"""
+    return StravaProfile.objects.filter(user=user).values_list(
+        'ftp', 'threshold_heartrate', 'training_load_ready'
+    ).first()
+
+
+def _roll_forward(user, previous, days, deltas):
+    """
+    Add load deltas to stored days and recompute the averages from the first change on
+
+    Args:
+        user: Owner of the rows
+        previous: The last stored day before the first change, or None
+        days: Stored days from the first change on, in date order
+        deltas: date -> load to add
+    """
+    stored = {day.date: day for day in days}
+    fitness_decay = 1 - 1 / FITNESS_DAYS
+    fatigue_decay = 1 - 1 / FATIGUE_DAYS
+
+    fitness = previous.fitness if previous else 0.0
+    fatigue = previous.fatigue if previous else 0.0
+    last_date = previous.date if previous else None
+
+    to_create, to_update, to_delete = [], [], []
+    for day_date in sorted(stored.keys() | deltas.keys()):
+        day = stored.get(day_date)
+        load = (day.load if day else 0.0) + deltas.get(day_date, 0.0)
+        if load < EPSILON:
+            if day is not None:
+                to_delete.append(day.id)
+            continue
+
+        gap = (day_date - last_date).days if last_date else 0
+        fitness = fitness * fitness_decay ** gap + load / FITNESS_DAYS
+        fatigue = fatigue * fatigue_decay ** gap + load / FATIGUE_DAYS
+        last_date = day_date
+
+        if day is None:
+            day = DailyTrainingLoad(user=user, date=day_date)
+            to_create.append(day)
+        else:
+            to_update.append(day)
+        day.load, day.fitness, day.fatigue = load, fitness, fatigue
+
+    if to_delete:
+        DailyTrainingLoad.objects.filter(id__in=to_delete).delete()
+    if to_create:
+        DailyTrainingLoad.objects.bulk_create(to_create, batch_size=500)
+    if to_update:
+        DailyTrainingLoad.objects.bulk_update(to_update, ['load', 'fitness', 'fatigue'], batch_size=500)
+
+
+def apply_changes(user, removed=(), added=()):
+    """
+    Update a user's daily training load for changed activities
+
+    Fitness and fatigue are recomputed from the last stored day before the
+    earliest changed date, so a newly synced activity only rewrites the
+    days from its own date on rather than the whole history.
+
+    Args:
+        user: Owner of the activities
+        removed: Field dicts (SOURCE_FIELDS) of activities as they were before
+            an update or delete
+        added: Field dicts of activities as they are after a create or update
+    """
+    thresholds = _thresholds(user)
+    if thresholds is None or not thresholds[2]:
+        # Built from all activities when the user's load is first read
+        return
+
+    deltas = _deltas(removed, added, *thresholds[:2])
+    deltas = {day: delta for day, delta in deltas.items() if abs(delta) >= EPSILON}
+    if not deltas:
+        return
+
+    start = min(deltas)
+    with transaction.atomic():
+        previous = DailyTrainingLoad.objects.filter(user=user, date__lt=start).order_by('-date').first()
+        days = list(
+            DailyTrainingLoad.objects.select_for_update().filter(user=user, date__gte=start).order_by('date')
+        )
+        _roll_forward(user, previous, days, deltas)
+
+
+def rebuild(user):
+    """Recompute all of a user's daily training load from their activities"""
+    thresholds = _thresholds(user)
+    if thresholds is None:
+        return
+
+    with transaction.atomic():
+        rows = Activity.objects.filter(user=user).order_by().values(*SOURCE_FIELDS).iterator(chunk_size=2000)
+        deltas = _deltas((), rows, *thresholds[:2])
+        DailyTrainingLoad.objects.filter(user=user).delete()
+        _roll_forward(user, None, [], deltas)
+        StravaProfile.objects.filter(user=user).update(training_load_ready=True)
+
+
+def ensure_ready(user):
+    """
+    Make sure a user's daily training load is populated before it is read
+
+    Returns:
+        bool: True if the stored training load can be used for this user
+    """
+    ready = StravaProfile.objects.filter(user=user).values_list('training_load_ready', flat=True).first()
+    if ready is None:
+        # Users without a Strava profile have no thresholds to score against
+        return False
+    if not ready:
+        rebuild(user)
+    return True
+
+
+def set_thresholds(user, ftp=None, threshold_heartrate=None):
+    """
+    Change the thresholds a user's activities are scored against
+
+    Every score depends on them, so the user's training load is rebuilt
+    and their cached analytics invalidated.
+
+    Args:
+        user: User with a Strava profile
+        ftp: Functional threshold power in watts, None to leave unchanged
+        threshold_heartrate: Threshold heart rate in bpm, None to leave unchanged
+    """
+    changes = {}
+    if ftp is not None:
+        changes['ftp'] = ftp
+    if threshold_heartrate is not None:
+        changes['threshold_heartrate'] = threshold_heartrate
+    if changes:
+        StravaProfile.objects.filter(user=user).update(**changes)
+        rebuild(user)
+        bump_generation(user)
+
+
+def get_series(user, start, end):
+    """
+    Read a user's daily load, fitness and fatigue, one value per calendar day
+
+    Only the stored days in the range and the last one before it are read;
+    the days between them are filled in with the decayed averages.
+
+    Args:
+        user: Owner of the training load
+        start: First date of the series
+        end: Last date of the series
+
+    Returns:
+        tuple: (dates, load, fitness, fatigue) NumPy arrays
+    """
+    previous = DailyTrainingLoad.objects.filter(user=user, date__lt=start).order_by('-date').values_list(
+        'date', 'load', 'fitness', 'fatigue'
+    ).first()
+    stored = list(DailyTrainingLoad.objects.filter(user=user, date__gte=start, date__lte=end).order_by('date').values_list(
+        'date', 'load', 'fitness', 'fatigue'
+    ))
+    if previous is not None:
+        stored.insert(0, previous)
+
+    dates = np.arange(np.datetime64(start, 'D'), np.datetime64(end + timedelta(days=1), 'D'))
+    load = np.zeros(len(dates))
+    if not stored:
+        return dates, load, np.zeros(len(dates)), np.zeros(len(dates))
+
+    stored_dates = np.array([row[0] for row in stored], dtype='datetime64[D]')
+    stored_values = np.array([row[1:] for row in stored], dtype=np.float64)
+
+    # Latest stored day on or before each date; -1 before the first one
+    index = np.searchsorted(stored_dates, dates, side='right') - 1
+    known = index >= 0
+    held = index[known]
+    gap = (dates[known] - stored_dates[held]).astype(np.int64)
+
+    fitness = np.zeros(len(dates))
+    fatigue = np.zeros(len(dates))
+    fitness[known] = stored_values[held, 1] * (1 - 1 / FITNESS_DAYS) ** gap
+    fatigue[known] = stored_values[held, 2] * (1 - 1 / FATIGUE_DAYS) ** gap
+    same_day = np.zeros(len(dates), dtype=bool)
+    same_day[known] = gap == 0
+    load[same_day] = stored_values[index[same_day], 0]
+    return dates, load, fitness, fatigue
@@ -0,0 +1,101 @@
+import numpy as np
+
+
+METRIC = 'metric'
+IMPERIAL = 'imperial'
+UNIT_SYSTEMS = (METRIC, IMPERIAL)
+
+# quantity -> unit system -> (key suffix, factor from the stored SI unit).
+# Distances are stored in meters, speeds in m/s, durations in seconds and
+# paces in seconds per meter.
+CONVERSIONS = {
+    'distance': {METRIC: ('km', 1 / 1000), IMPERIAL: ('miles', 1 / 1609.34)},
+    'speed': {METRIC: ('kmh', 3.6), IMPERIAL: ('mph', 2.237)},
+    'duration': {METRIC: ('hours', 1 / 3600), IMPERIAL: ('hours', 1 / 3600)},
+    'pace': {METRIC: ('min_per_km', 1000 / 60), IMPERIAL: ('min_per_mile', 1609.34 / 60)},
+}
+
+
+def parse_units(value):
+    """
+    Validate a ?units= query parameter
+
+    Returns:
+        str: 'metric' or 'imperial', or None (both) when not given
+
+    Raises:
+        ValueError: The value is not a known unit system
+    """
+    if not value:
+        return None
+    if value not in UNIT_SYSTEMS:
+        raise ValueError(f"Invalid units: {value!r} (expected one of {', '.join(UNIT_SYSTEMS)})")
+    return value
+
+
+def _systems(units):
+    return UNIT_SYSTEMS if units is None else (units,)
+
+
+def _with_missing(values, missing):
+    """A float array as a list, with None where the mask marks a missing value"""
+    values = values.tolist()
+    for index in np.flatnonzero(missing).tolist():
+        values[index] = None
+    return values
+
+
+def convert(columns, conversions, units=None, keep_source=False):
+    """
+    Replace SI columns with readable-unit columns
+
+    Each column is turned into one float array and scaled once per unit
+    system, before any row objects are built (see responses.to_rows).
+    Missing values (None or NaN) stay missing and are written back as None.
+
+    Args:
+        columns: field -> list or NumPy array of values
+        conversions: SI field -> (readable field prefix, quantity); e.g.
+            {'distance': ('distance', 'distance')} writes distance_km
+        units: 'metric', 'imperial' or None for both
+        keep_source: Leave the SI columns in place as well
+
+    Returns:
+        dict: columns, modified in place
+    """
+    for source, (prefix, quantity) in conversions.items():
+        values = np.asarray(columns[source] if keep_source else columns.pop(source), dtype=np.float64)
+        missing = np.isnan(values)
+        for system in _systems(units):
+            suffix, factor = CONVERSIONS[quantity][system]
+            columns[f'{prefix}_{suffix}'] = _with_missing(values * factor, missing)
+    return columns
+
+
+def convert_row(row, conversions, units=None, keep_source=False):
+    """
+    convert for a single result dict
+
+    Returns:
+        dict: row, modified in place
+    """
+    for source, (prefix, quantity) in conversions.items():
+        value = row[source] if keep_source else row.pop(source)
+        row.update(readable(prefix, value, quantity, units))
+    return row
+
+
+def readable(prefix, value, quantity, units=None):
+    """
+    Readable-unit fields of a single value
+
+    Returns:
+        dict: '<prefix>_<unit>' -> value for each requested unit system,
+            None for a missing value
+    """
+    missing = value is None or value != value
+    fields = {}
+    for system in _systems(units):
+        suffix, factor = CONVERSIONS[quantity][system]
+        fields[f'{prefix}_{suffix}'] = None if missing else value * factor
+    return fields
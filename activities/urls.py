@@ -18,6 +18,7 @@ urlpatterns = [
     path('', views.dashboard, name='dashboard'),
     
     # API endpoints
+    path('api/dashboard/', views.api_dashboard, name='api_dashboard'),
     path('api/stats/', views.api_stats, name='api_stats'),
     path('api/breakdown/', views.api_activity_breakdown, name='api_breakdown'),
     path('api/monthly-trends/', views.api_monthly_trends, name='api_monthly_trends'),
@@ -25,6 +26,14 @@ urlpatterns = [
     path('api/personal-records/', views.api_personal_records, name='api_personal_records'),
     path('api/day-of-week/', views.api_day_of_week_stats, name='api_day_of_week'),
     path('api/activities/', views.api_activities, name='api_activities'),
+    path('api/facets/', views.api_facets, name='api_facets'),
+    path('api/curves/', views.api_curves, name='api_curves'),
+    path('api/training-load/', views.api_training_load, name='api_training_load'),
+    path('api/activities/nearby/', views.api_nearby_activities, name='api_nearby_activities'),
+    path('api/start-locations/', views.api_start_locations, name='api_start_locations'),
+    path('api/courses/', views.api_courses, name='api_courses'),
+    path('api/courses/<int:course_id>/', views.api_course_progression, name='api_course_progression'),
+    path('api/sync/status/', views.api_sync_status, name='api_sync_status'),
     
     # Legal pages
     path('privacy/', views.privacy_policy, name='privacy_policy'),
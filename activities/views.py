@@ -1,11 +1,20 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse, HttpResponse
-from django.views.decorators.http import require_http_methods
+from django.http import HttpResponse
+from django.views.decorators.http import condition, require_http_methods
 from django.contrib.auth.decorators import login_required
+from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.db.models import Avg, Count, Sum
 from django.utils import timezone
-from datetime import timedelta
-from .models import Activity
+from datetime import date, timedelta
+from functools import wraps
+import hashlib
+from . import curves
+from .models import Activity, StravaProfile, SyncJob, format_duration
 from .analytics import StravaAnalytics
+from .pagination import keyset_page
+from .responses import ApiResponse, parse_format, shape, to_columns, to_rows
+from .units import convert, convert_row, parse_units
 
 
 def health_check(request):
@@ -73,111 +82,534 @@ def dashboard(request):
         return HttpResponse(f"Dashboard Error: {str(e)}", status=500)
 
 
+def response_options(request):
+    """
+    Read the ?units= and ?format= options of an endpoint returning lists
+    
+    Returns:
+        tuple: (units, payload format)
+    
+    Raises:
+        ValueError: An option has an unknown value
+    """
+    return parse_units(request.GET.get('units')), parse_format(request.GET.get('format'))
+
+
+# Longest weekly trend one request may ask for (ten years)
+MAX_TREND_WEEKS = 520
+
+
+def parse_weeks(request):
+    """
+    Read the ?weeks= option of the weekly trends, clamped to 1..MAX_TREND_WEEKS
+    
+    Raises:
+        ValueError: The value is not an integer
+    """
+    return min(max(int(request.GET.get('weeks', 12)), 1), MAX_TREND_WEEKS)
+
+
+def data_version(request):
+    """
+    Return what the user's API responses depend on, read once per request
+    
+    Returns:
+        tuple: (data generation, last data change or sync time, activity count)
+    """
+    if not hasattr(request, '_data_version'):
+        profile = StravaProfile.objects.filter(user=request.user).values(
+            'data_generation', 'data_modified_at', 'last_synced_at'
+        ).first() or {}
+        modified = [value for value in (profile.get('data_modified_at'), profile.get('last_synced_at')) if value]
+        request._data_version = (
+            profile.get('data_generation', 0),
+            max(modified) if modified else None,
+            Activity.objects.filter(user=request.user).count(),
+        )
+    return request._data_version
+
+
+def api_etag(request, *args, **kwargs):
+    """ETag for an API response: changes with the user's data, the path and query, and the day"""
+    generation, modified_at, count = data_version(request)
+    parts = [
+        request.user.id,
+        generation,
+        modified_at.isoformat() if modified_at else '',
+        count,
+        request.path,
+        sorted(request.GET.lists()),
+        # Periods such as the last 7 days and the weekly trends move daily
+        timezone.now().date().isoformat(),
+    ]
+    return hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def api_last_modified(request, *args, **kwargs):
+    """Last-Modified for an API response: the last data change or sync, or the start of today if later"""
+    modified_at = data_version(request)[1]
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(modified_at, today) if modified_at else today
+
+
+def conditional_api(view):
+    """
+    Answer conditional GETs of an API view before it runs
+    
+    The ETag and Last-Modified validators cost one profile read and an
+    indexed count, so a browser revalidating an unchanged response gets a
+    304 without any analytics work. Responses are marked private so that
+    only the user's browser caches them.
+    """
+    view = condition(etag_func=api_etag, last_modified_func=api_last_modified)(view)
+    
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            patch_cache_control(response, private=True, max_age=settings.API_CACHE_MAX_AGE, must_revalidate=True)
+        return response
+    
+    return wrapper
+
+
 @require_http_methods(["GET"])
 @login_required(login_url='/accounts/login/')
+@conditional_api
 def api_stats(request):
     """API endpoint for summary statistics"""
     period = request.GET.get('period', 'all')
     activity_type = request.GET.get('type', None)
+    try:
+        units = parse_units(request.GET.get('units'))
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
     
     analytics = StravaAnalytics(user=request.user)
-    stats = analytics.get_summary_stats(period=period, activity_type=activity_type)
+    stats = analytics.get_summary_stats(period=period, activity_type=activity_type, units=units)
     
-    return JsonResponse(stats)
+    return ApiResponse(stats)
 
 
 @require_http_methods(["GET"])
 @login_required(login_url='/accounts/login/')
+@conditional_api
 def api_activity_breakdown(request):
     """API endpoint for activity type breakdown"""
     period = request.GET.get('period', 'all')
+    try:
+        units, payload_format = response_options(request)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
     
     analytics = StravaAnalytics(user=request.user)
-    breakdown = analytics.get_activity_type_breakdown(period=period)
+    breakdown = analytics.get_activity_type_breakdown(period=period, units=units)
     
-    return JsonResponse({'breakdown': breakdown})
+    return ApiResponse({'breakdown': shape(breakdown, payload_format)})
 
 
 @require_http_methods(["GET"])
 @login_required(login_url='/accounts/login/')
+@conditional_api
 def api_monthly_trends(request):
     """API endpoint for monthly trends"""
     activity_type = request.GET.get('type', None)
+    try:
+        units, payload_format = response_options(request)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
     
     analytics = StravaAnalytics(user=request.user)
-    trends = analytics.get_monthly_trends(activity_type=activity_type)
+    trends = analytics.get_monthly_trends(activity_type=activity_type, units=units)
     
-    return JsonResponse({'trends': trends})
+    return ApiResponse({'trends': shape(trends, payload_format)})
 
 
 @require_http_methods(["GET"])
 @login_required(login_url='/accounts/login/')
+@conditional_api
 def api_weekly_trends(request):
     """API endpoint for weekly trends"""
-    weeks = int(request.GET.get('weeks', 12))
     activity_type = request.GET.get('type', None)
+    try:
+        units, payload_format = response_options(request)
+        weeks = parse_weeks(request)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
     
     analytics = StravaAnalytics(user=request.user)
-    trends = analytics.get_weekly_trends(weeks=weeks, activity_type=activity_type)
+    trends = analytics.get_weekly_trends(weeks=weeks, activity_type=activity_type, units=units)
     
-    return JsonResponse({'trends': trends})
+    return ApiResponse({'trends': shape(trends, payload_format)})
 
 
 @require_http_methods(["GET"])
 @login_required(login_url='/accounts/login/')
+@conditional_api
 def api_personal_records(request):
     """API endpoint for personal records"""
     activity_type = request.GET.get('type', None)
+    try:
+        units = parse_units(request.GET.get('units'))
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
     
     analytics = StravaAnalytics(user=request.user)
-    records = analytics.get_personal_records(activity_type=activity_type)
+    records = analytics.get_personal_records(activity_type=activity_type, units=units)
     
-    return JsonResponse({'records': records})
+    return ApiResponse({'records': records})
 
 
 @require_http_methods(["GET"])
 @login_required(login_url='/accounts/login/')
+@conditional_api
 def api_day_of_week_stats(request):
     """API endpoint for day of week statistics"""
     activity_type = request.GET.get('type', None)
+    try:
+        units, payload_format = response_options(request)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
     
     analytics = StravaAnalytics(user=request.user)
-    stats = analytics.get_day_of_week_stats(activity_type=activity_type)
+    stats = analytics.get_day_of_week_stats(activity_type=activity_type, units=units)
     
-    return JsonResponse({'stats': stats})
+    return ApiResponse({'stats': shape(stats, payload_format)})
 
 
 @require_http_methods(["GET"])
 @login_required(login_url='/accounts/login/')
-def api_activities(request):
-    """API endpoint for activity list with filtering"""
+@conditional_api
+def api_dashboard(request):
+    """API endpoint bundling the stats, breakdown and trends the dashboard loads"""
+    period = request.GET.get('period', 'all')
     activity_type = request.GET.get('type', None)
-    limit = int(request.GET.get('limit', 50))
+    try:
+        units, payload_format = response_options(request)
+        weeks = parse_weeks(request)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
     
-    queryset = Activity.objects.filter(user=request.user)
+    analytics = StravaAnalytics(user=request.user)
+    bundle = analytics.get_dashboard(period=period, activity_type=activity_type, weeks=weeks, units=units)
+    for section in ('breakdown', 'monthly_trends', 'weekly_trends', 'day_of_week'):
+        bundle[section] = shape(bundle[section], payload_format)
     
+    return ApiResponse(bundle)
+
+
+# Longest training load series one request may ask for, in days
+MAX_TRAINING_LOAD_DAYS = 3660
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+@conditional_api
+def api_training_load(request):
+    """
+    API endpoint for the daily training load chart
+    
+    ?days= sets how many days up to today are returned (default 180).
+    """
+    try:
+        _, payload_format = response_options(request)
+        days = int(request.GET.get('days', 180))
+        if not 1 <= days <= MAX_TRAINING_LOAD_DAYS:
+            raise ValueError(f"days must be between 1 and {MAX_TRAINING_LOAD_DAYS}")
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
+    
+    analytics = StravaAnalytics(user=request.user)
+    result = analytics.get_training_load(days=days)
+    
+    return ApiResponse(dict(result, series=shape(result['series'], payload_format)))
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+@conditional_api
+def api_curves(request):
+    """
+    API endpoint for mean-maximal (best effort) curves
+    
+    ?channel= power (default), speed or heartrate; ?window= 0 (all time,
+    default), 90 or 365 days; ?type= for one activity type; ?activity= for
+    the curve of one activity instead of the user's bests.
+    """
+    try:
+        units, payload_format = response_options(request)
+        channel = request.GET.get('channel', 'power')
+        if channel not in curves.CHANNELS:
+            raise ValueError(f"Invalid channel: {channel!r} (expected one of {', '.join(curves.CHANNELS)})")
+        window_days = int(request.GET.get('window', 0))
+        if window_days not in curves.WINDOWS:
+            raise ValueError(f"Invalid window: {window_days} (expected one of {', '.join(map(str, curves.WINDOWS))})")
+        activity_id = request.GET.get('activity')
+        activity_id = int(activity_id) if activity_id else None
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
+    
+    analytics = StravaAnalytics(user=request.user)
+    points = analytics.get_curves(
+        channel=channel,
+        activity_type=request.GET.get('type') or None,
+        window_days=window_days,
+        activity_id=activity_id,
+        units=units,
+    )
+    
+    return ApiResponse({'channel': channel, 'window_days': window_days, 'curve': shape(points, payload_format)})
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+@conditional_api
+def api_facets(request):
+    """API endpoint for the years, months and types available to filter on"""
+    analytics = StravaAnalytics(user=request.user)
+    return ApiResponse(analytics.get_facets())
+
+
+def filter_activities(queryset, params):
+    """
+    Apply the activity list filters from a query string
+    
+    Supports type, year, month and an inclusive from/to date range
+    (YYYY-MM-DD), all in the athlete's local time.
+    
+    Raises:
+        ValueError: A filter value could not be parsed
+    """
+    activity_type = params.get('type')
     if activity_type:
         queryset = queryset.filter(activity_type=activity_type)
     
-    activities = queryset[:limit]
-    
-    activity_data = []
-    for activity in activities:
-        activity_data.append({
-            'id': activity.id,
-            'name': activity.name,
-            'type': activity.activity_type,
-            'date': activity.start_date.isoformat(),
-            'distance_km': activity.distance_km,
-            'distance_miles': activity.distance_miles,
-            'moving_time': activity.moving_time_formatted,
-            'average_speed_kmh': activity.average_speed_kmh,
-            'average_speed_mph': activity.average_speed_mph,
-            'elevation_gain': activity.total_elevation_gain,
-            'calories': activity.calories,
-        })
-    
-    return JsonResponse({'activities': activity_data})
+    year = params.get('year')
+    if year:
+        queryset = queryset.filter(local_year=int(year))
+    
+    month = params.get('month')
+    if month:
+        queryset = queryset.filter(local_month=int(month))
+    
+    date_from = params.get('from')
+    if date_from:
+        queryset = queryset.filter(local_date__gte=date.fromisoformat(date_from))
+    
+    date_to = params.get('to')
+    if date_to:
+        queryset = queryset.filter(local_date__lte=date.fromisoformat(date_to))
+    
+    return queryset
+
+
+ACTIVITY_LIST_FIELDS = [
+    'id', 'name', 'activity_type', 'start_date', 'distance', 'moving_time',
+    'average_speed', 'total_elevation_gain', 'calories',
+]
+
+MAX_ACTIVITIES_PAGE = 1000
+
+# SI fields of the activity list -> (readable field prefix, quantity)
+ACTIVITY_UNITS = {
+    'distance': ('distance', 'distance'),
+    'average_speed': ('average_speed', 'speed'),
+}
+ACTIVITY_SUMMARY_UNITS = {
+    'total_distance': ('total_distance', 'distance'),
+    'total_time': ('total_time', 'duration'),
+    'avg_speed': ('avg_speed', 'speed'),
+}
+
+
+def activity_list_rows(rows, units=None):
+    """
+    Shape activity values() rows (ACTIVITY_LIST_FIELDS) for the activity list
+    
+    Args:
+        rows: Activity field dicts
+        units: 'metric' or 'imperial', or None for both
+    
+    Returns:
+        list: One dict per activity
+    """
+    columns = to_columns(rows, ACTIVITY_LIST_FIELDS)
+    return to_rows(convert({
+        'id': columns['id'],
+        'name': columns['name'],
+        'type': columns['activity_type'],
+        'date': [start_date.isoformat() for start_date in columns['start_date']],
+        'distance': columns['distance'],
+        'moving_time': [format_duration(moving_time) for moving_time in columns['moving_time']],
+        'average_speed': columns['average_speed'],
+        'elevation_gain': columns['total_elevation_gain'],
+        'calories': columns['calories'],
+    }, ACTIVITY_UNITS, units))
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+@conditional_api
+def api_activities(request):
+    """
+    API endpoint for activity list with filtering
+    
+    Filters (type, year, month, from, to) are applied in the database and
+    results are paged newest first with an opaque cursor: pass the
+    next_cursor of one response as ?cursor= to get the next page. total and
+    summary describe every activity matching the filters, not just the page.
+    Distances and speeds are given in both unit systems unless ?units=metric
+    or ?units=imperial picks one, and ?format=columns returns the activities
+    as one array per field.
+    """
+    try:
+        units, payload_format = response_options(request)
+        limit = min(max(int(request.GET.get('limit', 50)), 1), MAX_ACTIVITIES_PAGE)
+        queryset = filter_activities(Activity.objects.filter(user=request.user), request.GET)
+        rows, next_cursor = keyset_page(
+            queryset.values(*ACTIVITY_LIST_FIELDS), request.GET.get('cursor'), limit
+        )
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
+    
+    totals = queryset.aggregate(
+        total=Count('id'),
+        total_distance=Sum('distance'),
+        total_time=Sum('moving_time'),
+        avg_speed=Avg('average_speed'),
+    )
+    
+    activity_data = activity_list_rows(rows, units)
+    
+    summary = {
+        'total_distance': totals['total_distance'],
+        'total_time': totals['total_time'],
+        'avg_speed': totals['avg_speed'],
+    }
+    convert_row(summary, ACTIVITY_SUMMARY_UNITS, units)
+    
+    return ApiResponse({
+        'activities': shape(activity_data, payload_format),
+        'next_cursor': next_cursor,
+        'total': totals['total'],
+        'summary': summary,
+    })
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+@conditional_api
+def api_courses(request):
+    """
+    API endpoint for the routes the user has repeated
+    
+    ?type= limits the courses to one activity type and ?min= sets how many
+    activities a course needs to be listed (default 2).
+    """
+    try:
+        units, payload_format = response_options(request)
+        min_activities = max(int(request.GET.get('min', 2)), 1)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
+    
+    analytics = StravaAnalytics(user=request.user)
+    course_list = analytics.get_courses(
+        activity_type=request.GET.get('type') or None, min_activities=min_activities, units=units,
+    )
+    
+    return ApiResponse({'courses': shape(course_list, payload_format)})
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+@conditional_api
+def api_course_progression(request, course_id):
+    """API endpoint for every effort on one course, oldest first"""
+    try:
+        units, payload_format = response_options(request)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
+    
+    analytics = StravaAnalytics(user=request.user)
+    progression = analytics.get_course_progression(course_id, units=units)
+    if progression is None:
+        return ApiResponse({'error': 'Course not found'}, status=404)
+    
+    return ApiResponse(dict(progression, efforts=shape(progression['efforts'], payload_format)))
+
+
+# Largest radius of a nearby search, in kilometers
+MAX_NEARBY_RADIUS_KM = 500
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+@conditional_api
+def api_nearby_activities(request):
+    """
+    API endpoint for activities starting near a point, nearest first
+    
+    ?lat= and ?lng= (degrees) are required; ?radius= is in kilometers
+    (default 1), ?point=end searches end points instead of start points,
+    and ?type= and ?limit= narrow the results.
+    """
+    try:
+        units, payload_format = response_options(request)
+        latitude = float(request.GET['lat'])
+        longitude = float(request.GET['lng'])
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError("lat must be within [-90, 90] and lng within [-180, 180]")
+        radius_km = float(request.GET.get('radius', 1))
+        if not 0 < radius_km <= MAX_NEARBY_RADIUS_KM:
+            raise ValueError(f"radius must be greater than 0 and at most {MAX_NEARBY_RADIUS_KM} km")
+        point = request.GET.get('point', 'start')
+        if point not in ('start', 'end'):
+            raise ValueError(f"Invalid point: {point!r} (expected start or end)")
+        limit = min(max(int(request.GET.get('limit', 50)), 1), MAX_ACTIVITIES_PAGE)
+    except KeyError as e:
+        return ApiResponse({'error': f"Missing parameter: {e.args[0]}"}, status=400)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
+    
+    analytics = StravaAnalytics(user=request.user)
+    activities = analytics.get_nearby_activities(
+        latitude, longitude, radius_km=radius_km, point=point,
+        activity_type=request.GET.get('type') or None, limit=limit, units=units,
+    )
+    
+    return ApiResponse({'activities': shape(activities, payload_format)})
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+@conditional_api
+def api_start_locations(request):
+    """API endpoint for the places the user's activities most often start from"""
+    try:
+        _, payload_format = response_options(request)
+        limit = min(max(int(request.GET.get('limit', 20)), 1), 100)
+    except ValueError as e:
+        return ApiResponse({'error': str(e)}, status=400)
+    
+    analytics = StravaAnalytics(user=request.user)
+    return ApiResponse({'locations': shape(analytics.get_start_locations(limit=limit), payload_format)})
+
+
+@require_http_methods(["GET"])
+@login_required(login_url='/accounts/login/')
+def api_sync_status(request):
+    """API endpoint for the state of the user's latest Strava sync job"""
+    job = SyncJob.objects.filter(user=request.user).first()
+    
+    try:
+        last_synced_at = request.user.strava_profile.last_synced_at
+    except StravaProfile.DoesNotExist:
+        last_synced_at = None
+    
+    return ApiResponse({
+        'job': job.as_dict() if job else None,
+        'last_synced_at': last_synced_at.isoformat() if last_synced_at else None,
+    })
 
 
 def privacy_policy(request):
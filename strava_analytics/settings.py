@@ -154,6 +154,34 @@ DATABASES = {
 }
 
 
+# Caches
+# The 'analytics' cache holds per-user analytics results keyed by data
+# generation. Local memory is per process; point it at a file or database
+# cache to share results across gunicorn workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'analytics': {
+        'BACKEND': os.getenv('ANALYTICS_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('ANALYTICS_CACHE_LOCATION', 'analytics'),
+        'TIMEOUT': int(os.getenv('ANALYTICS_CACHE_TIMEOUT', '86400')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('ANALYTICS_CACHE_MAX_ENTRIES', '2000')),
+        },
+    },
+}
+
+# JSON encoder for the API views: 'auto' uses orjson when it is installed and
+# the standard library otherwise (see activities/responses.py)
+API_JSON_BACKEND = os.getenv('API_JSON_BACKEND', 'auto')
+
+# Seconds the browser may reuse an API response without revalidating it; at 0
+# it revalidates every time and gets a 304 while the data is unchanged
+API_CACHE_MAX_AGE = int(os.getenv('API_CACHE_MAX_AGE', '0'))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -199,6 +227,13 @@ STRAVA_CLIENT_SECRET = os.getenv('STRAVA_CLIENT_SECRET')
 STRAVA_ACCESS_TOKEN = os.getenv('STRAVA_ACCESS_TOKEN')
 STRAVA_REFRESH_TOKEN = os.getenv('STRAVA_REFRESH_TOKEN')
 
+# Shared keep-alive HTTP client for Strava calls
+STRAVA_HTTP_POOL_SIZE = int(os.getenv('STRAVA_HTTP_POOL_SIZE', '10'))
+STRAVA_HTTP_CONNECT_TIMEOUT = float(os.getenv('STRAVA_HTTP_CONNECT_TIMEOUT', '5'))
+STRAVA_HTTP_READ_TIMEOUT = float(os.getenv('STRAVA_HTTP_READ_TIMEOUT', '30'))
+STRAVA_HTTP_RETRIES = int(os.getenv('STRAVA_HTTP_RETRIES', '3'))
+STRAVA_HTTP_BACKOFF = float(os.getenv('STRAVA_HTTP_BACKOFF', '0.5'))
+
 # Logging configuration
 LOGGING = {
     'version': 1,